@@ -0,0 +1,47 @@
+"""Helpers shared by the benchmarks.
+
+Benchmarks are plain scripts; run them from the repository root, e.g.
+``PYTHONPATH=. python benchmarks/getExercises.py``.
+
+"""
+from __future__ import print_function
+
+import time
+
+
+def measure(f, repeat=5, number=1):
+    """Calls ``f`` ``number`` times in a row, ``repeat`` times over, and
+    returns the best time per call in seconds.
+
+    Taking the best time (not the average) filters out noise from
+    other processes on the machine.
+
+    """
+    best = None
+    for _ in xrange(repeat):
+        start = time.time()
+        for _ in xrange(number):
+            f()
+        elapsed = (time.time() - start) / number
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def percentile(values, fraction):
+    """Gets the given percentile (as a fraction) of some values.
+
+    """
+    ordered = sorted(values)
+    index = min(int(len(ordered) * fraction), len(ordered) - 1)
+    return ordered[index]
+
+
+def report(name, seconds, baseline=None):
+    """Prints a benchmark result, optionally comparing it to a baseline.
+
+    """
+    line = "{0:<48} {1:>12.6f}s".format(name, seconds)
+    if baseline is not None:
+        line += " ({0:.1f}x)".format(baseline / seconds)
+    print(line)
@@ -0,0 +1,154 @@
+"""TLS helpers shared by the handshake benchmarks.
+
+Handshakes are done in memory (using memory BIOs), between a client
+and a server context in the same process, so that the benchmarks
+measure TLS and merlyn, not the network.
+
+"""
+import os
+import shutil
+import tempfile
+
+from axiom.store import Store
+from merlyn.auth import ContextFactory, User
+from OpenSSL.crypto import FILETYPE_PEM, PKey, TYPE_RSA, X509
+from OpenSSL.crypto import dump_certificate, dump_privatekey
+from OpenSSL.SSL import Connection, Context, SSLv23_METHOD, WantReadError
+from OpenSSL.SSL import RECEIVED_SHUTDOWN, SENT_SHUTDOWN
+
+
+def makeCredentials(email, bits=2048, key=None):
+    """Makes a key and a self-signed certificate for the given e-mail
+    address. If a key is given, the certificate is for that key
+    instead of a new one.
+
+    """
+    if key is None:
+        key = PKey()
+        key.generate_key(TYPE_RSA, bits)
+
+    cert = X509()
+    cert.set_pubkey(key)
+    cert.set_serial_number(1)
+    cert.get_subject().CN = email
+    cert.get_subject().emailAddress = email
+    cert.gmtime_adj_notBefore(0)
+    cert.gmtime_adj_notAfter(60 * 60)
+    cert.set_issuer(cert.get_subject())
+    cert.sign(key, "sha256")
+    return key, cert
+
+
+class Endpoints(object):
+    """A merlyn server context factory, and a client context for a user
+    that is allowed to connect to it.
+
+    The store is a new in-memory store, unless one is given. Any
+    keyword arguments are passed to the server's context factory.
+
+    """
+    def __init__(self, store=None, **kwargs):
+        self.store = Store() if store is None else store
+        self.path = tempfile.mkdtemp()
+
+        key, cert = makeCredentials(b"server@example.com")
+        paths = {
+            "certificatePath": self._write("cert.pem",
+                                           dump_certificate(FILETYPE_PEM, cert)),
+            "keyPath": self._write("key.pem",
+                                   dump_privatekey(FILETYPE_PEM, key)),
+            "dhParametersPath": self._write("dhparam.pem", dhParameters)
+        }
+        paths.update(kwargs)
+        self.serverFactory = ContextFactory(self.store, **paths)
+
+        email = b"user@example.com"
+        User(store=self.store, email=email)
+        key, cert = makeCredentials(email)
+        self.clientContext = Context(SSLv23_METHOD)
+        self.clientContext.use_privatekey(key)
+        self.clientContext.use_certificate(cert)
+
+
+    def _write(self, name, content):
+        path = os.path.join(self.path, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+
+    def handshake(self, session=None):
+        """Does a handshake, resuming the given session if there is one.
+
+        Returns the client connection, which can be used to get the
+        (new) session.
+
+        """
+        server = Connection(self.serverFactory.getContext(), None)
+        server.set_accept_state()
+        client = Connection(self.clientContext, None)
+        client.set_connect_state()
+        if session is not None:
+            client.set_session(session)
+
+        _handshake(client, server)
+
+        # Pretend the connections were shut down cleanly; OpenSSL won't
+        # resume sessions of connections that weren't.
+        for conn in client, server:
+            conn.set_shutdown(SENT_SHUTDOWN | RECEIVED_SHUTDOWN)
+
+        return client
+
+
+
+def _handshake(client, server):
+    """Shuffles bytes between the client and server until both are done
+    with the handshake, and the client has processed anything the
+    server sent after it (like TLS 1.3 session tickets).
+
+    """
+    done = set()
+    while len(done) < 2:
+        for conn, peer in [(client, server), (server, client)]:
+            if conn not in done:
+                try:
+                    conn.do_handshake()
+                    done.add(conn)
+                except WantReadError:
+                    pass
+            _transfer(conn, peer)
+
+    try:
+        client.recv(1)
+    except WantReadError:
+        pass
+
+
+def _transfer(source, destination):
+    """Moves all pending bytes from one connection to the other.
+
+    """
+    while True:
+        try:
+            data = source.bio_read(65536)
+        except WantReadError:
+            return
+        destination.bio_write(data)
+
+
+
+dhParameters = b"""
+-----BEGIN DH PARAMETERS-----
+MIIBCAKCAQEAgWLYHAd3Dd7+b0FkahzLKgKoQTpgKsLLW24g4/qGpR1UcbWL6As2
+Dzjr8B5fWmHDR0GrsQzzWW/6XiIn/UoKHjzu6nZfbpJfa3h56GXjZ7Bqw7RWB2Cu
+x2g6VW0Ev8XeAv5PbjDdSSUvKF57cI/DPvv+ZbhYgZ+UNrxnpDSwyQd6GHBTDFsd
+zKUeBswZfdgI1L9c2nY1A7kG/JjI3iYmkMh+TAys0wmBd8OILUFBX6ZipeWc0pSp
+Gyt0LTFo/00WIzjlGKNxoK7UQhAbccMjVJ1QaGq06SIYwFjBx16NkLv7sFp2jvL8
+sIaDs8hc3QlKoc9BliXnguu9k1XrdbbTbwIBAg==
+-----END DH PARAMETERS-----
+"""
@@ -0,0 +1,70 @@
+"""Benchmarks broadcasting a command to many connections.
+
+Compares calling the command on every connection in one go, which
+blocks the reactor until it's done, with ``Factory.broadcast``, which
+does it cooperatively. Reports the longest time the reactor was
+blocked, as seen by a timer that should fire every millisecond.
+
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from axiom.store import Store
+from clarent.exercise import NotifySolved
+from merlyn.service import Factory
+from twisted.internet import defer, task
+from twisted.test.proto_helpers import StringTransport
+
+
+def connect(factory, count):
+    for _ in xrange(count):
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+
+
+def naive(factory, **kwargs):
+    for proto in factory.protocols:
+        proto.callRemote(NotifySolved, **kwargs)
+    return defer.succeed(None)
+
+
+@defer.inlineCallbacks
+def longestStall(reactor, broadcast):
+    """Runs the broadcast while a timer ticks every millisecond, and
+    returns the longest gap between ticks, and the total time taken.
+
+    """
+    ticks = [time.time()]
+    timer = task.LoopingCall(lambda: ticks.append(time.time()))
+    timer.start(0.001)
+    yield task.deferLater(reactor, 0.01, lambda: None)
+
+    start = time.time()
+    yield broadcast()
+    total = time.time() - start
+
+    yield task.deferLater(reactor, 0.01, lambda: None)
+    timer.stop()
+    gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+    defer.returnValue((max(gaps), total))
+
+
+@defer.inlineCallbacks
+def main(reactor, count):
+    factory = Factory(Store())
+    connect(factory, count)
+    kwargs = {"identifier": b"x", "title": u"Announcement"}
+
+    for name, broadcast in [("naive", lambda: naive(factory, **kwargs)),
+                            ("cooperative", lambda: factory.broadcast(
+                                NotifySolved, **kwargs))]:
+        stall, total = yield longestStall(reactor, broadcast)
+        print("{0:<12} {1} connections: longest stall {2:.6f}s, "
+              "total {3:.6f}s".format(name, count, stall, total))
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    task.react(main, [count])
@@ -0,0 +1,44 @@
+"""Compares two sets of results of ``benchmarks/endToEnd.py``.
+
+Usage: ``python benchmarks/compare.py OLD.json NEW.json``. Prints every
+result of both, and how many times better the new one is (rates are
+better when higher, latencies when lower).
+
+"""
+from __future__ import print_function
+
+import json
+import sys
+
+
+def flatten(results, prefix=""):
+    """Flattens nested results into (name, value) pairs.
+
+    """
+    for name, value in sorted(results.iteritems()):
+        if isinstance(value, dict):
+            for pair in flatten(value, prefix + name + "."):
+                yield pair
+        elif name != "count":
+            yield prefix + name, value
+
+
+def main(oldPath, newPath):
+    with open(oldPath) as f:
+        old = dict(flatten(json.load(f)["results"]))
+    with open(newPath) as f:
+        new = dict(flatten(json.load(f)["results"]))
+
+    for name in sorted(set(old) & set(new)):
+        if "_per_second" in name:
+            speedup = new[name] / old[name]
+        else:
+            speedup = old[name] / new[name]
+        print("{0:<40} {1:>14.6f} {2:>14.6f} ({3:.2f}x)"
+              .format(name, old[name], new[name], speedup))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("usage: {0} OLD.json NEW.json".format(sys.argv[0]))
+    main(*sys.argv[1:])
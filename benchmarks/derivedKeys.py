@@ -0,0 +1,34 @@
+"""Benchmarks deriving a per-exercise key from a user's secret.
+
+Compares looking up the secret and running HKDF every time (what an
+exercise generating a challenge on every request would otherwise do)
+with ``Secret.deriveKey``, which caches derived keys.
+
+"""
+from __future__ import print_function
+
+from axiom.store import Store
+from merlyn.auth import User
+from merlyn.exercise import Secret, _hkdf
+
+from _bench import measure, report
+
+
+def main(number=1000):
+    store = Store()
+    user = User(store=store, email=b"user@example.com")
+    Secret.forUser(user)
+
+    def uncached():
+        entropy = Secret.forUser(user).entropy
+        return _hkdf(entropy, 32, [b"key", b"exercise", b"label"])
+
+    old = measure(uncached, number=number)
+    new = measure(lambda: Secret.deriveKey(user, b"exercise", b"label"),
+                  number=number)
+    report("secret lookup and HKDF", old)
+    report("Secret.deriveKey (cached)", new, baseline=old)
+
+
+if __name__ == "__main__":
+    main()
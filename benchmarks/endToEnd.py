@@ -0,0 +1,354 @@
+"""Benchmarks a merlyn server end to end, over loopback TLS.
+
+Serves a ``service.Factory`` (over TLS, with the server's context
+factory) from this process, on a synthetic store, and has many
+simulated clients, each a different user, connect to it. Measures:
+
+- the rate of full TLS handshakes;
+- the latency percentiles of ``GetExercises`` and
+  ``GetExerciseDetails``;
+- solve throughput through ``exercise.solveAndNotify``, until the
+  clients have been notified;
+- the rate at which multiplexed channels are opened.
+
+The results are written as JSON (to stdout, or to ``--output``), so
+that runs can be compared between commits with
+``benchmarks/compare.py``. Run ``--help`` for the sizes of the
+synthetic store and the workload.
+
+"""
+from __future__ import print_function
+
+import json
+import platform
+import subprocess
+import sys
+import time
+
+from axiom.store import Store
+from clarent.exercise import GetExerciseDetails, GetExercises, NotifySolved
+from merlyn import service
+from merlyn.auth import User
+from merlyn.exercise import Exercise, getCatalog, solveAndNotify
+from merlyn.multiplexing import addToStore
+from merlyn.writequeue import WriteQueue
+from OpenSSL.crypto import PKey, TYPE_RSA
+from OpenSSL.SSL import Context, SSLv23_METHOD
+from twisted.internet import defer, endpoints, protocol, ssl, task
+from twisted.internet.interfaces import IHandshakeListener
+from twisted.protocols import amp
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.python import usage
+from txampext.multiplexing import Connect
+from zope import interface
+
+from _bench import percentile
+from _tls import Endpoints, makeCredentials
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["users", None, 50, "Number of users (and simulated clients)", int],
+        ["exercises", None, 100, "Number of exercises", int],
+        ["solved", None, 0.5,
+         "Fraction of the exercises every user has already solved", float],
+        ["store", None, None,
+         "Path of the store to create (default: in memory)"],
+        ["commit-interval", None, None,
+         "Milliseconds for which to group writes (default: don't)", int],
+        ["handshakes", None, 200, "Number of handshakes to do", int],
+        ["concurrency", None, 10, "Concurrent handshakes", int],
+        ["requests", None, 20,
+         "Requests of each command per client", int],
+        ["solves", None, 5, "Exercises to solve per client", int],
+        ["channels", None, 20, "Channels to open per client", int],
+        ["output", "o", "-", "File to write the results to (default: stdout)"]
+    ]
+
+    def postOptions(self):
+        solvable = self["exercises"] - int(self["exercises"] * self["solved"])
+        if self["solves"] > solvable:
+            raise usage.UsageError("Only {0} exercises are left to solve per "
+                                   "user.".format(solvable))
+
+
+def makeEchoFactory(store):
+    """Makes the multiplexed factory that channels are opened to.
+
+    """
+    return protocol.Factory.forProtocol(protocol.Protocol)
+
+
+def populate(store, userCount, exerciseCount, solvedFraction):
+    """Creates the users and exercises, and solves the given fraction of
+    the exercises for every user.
+
+    """
+    users = [User(store=store, email=b"user{0}@example.com".format(i))
+             for i in xrange(userCount)]
+    exercises = [Exercise(store=store, identifier=b"{0}".format(i),
+                          title=u"Exercise {0}".format(i),
+                          description=u"Description")
+                 for i in xrange(exerciseCount)]
+    for exercise in exercises[:int(exerciseCount * solvedFraction)]:
+        for user in users:
+            exercise.solvedBy(user)
+    addToStore(store, b"echo", b"{0}.makeEchoFactory".format(__name__))
+    return users, exercises
+
+
+class _ClientContextFactory(ssl.ClientContextFactory):
+    def __init__(self, context):
+        self._context = context
+
+
+    def getContext(self):
+        return self._context
+
+
+def clientContextFactory(email, key):
+    """Makes a client context factory with a certificate for the given
+    e-mail address.
+
+    """
+    key, cert = makeCredentials(email, key=key)
+    context = Context(SSLv23_METHOD)
+    context.use_privatekey(key)
+    context.use_certificate(cert)
+    return _ClientContextFactory(context)
+
+
+@interface.implementer(IHandshakeListener)
+class Client(amp.AMP):
+    """A simulated client.
+
+    """
+    def __init__(self):
+        amp.AMP.__init__(self)
+        self.handshakeDone = defer.Deferred()
+        self.onNotified = lambda: None
+
+
+    def handshakeCompleted(self):
+        self.handshakeDone.callback(self)
+
+
+    @NotifySolved.responder
+    def notifySolved(self, identifier, title):
+        self.onNotified()
+        return {}
+
+
+def connect(reactor, port, contextFactory):
+    """Connects a client, and waits for the handshake to complete.
+
+    """
+    endpoint = endpoints.SSL4ClientEndpoint(reactor, "127.0.0.1", port,
+                                            contextFactory)
+    d = endpoints.connectProtocol(endpoint, Client())
+    d.addCallback(lambda client: client.handshakeDone)
+    return d
+
+
+def runConcurrently(operations, concurrency):
+    """Runs the given functions returning Deferreds, at most
+    ``concurrency`` at a time.
+
+    """
+    semaphore = defer.DeferredSemaphore(concurrency)
+    return defer.gatherResults([semaphore.run(f) for f in operations])
+
+
+def timed(f, latencies):
+    """Calls ``f``, and records how long its Deferred took to fire.
+
+    """
+    start = time.time()
+    d = f()
+
+    @d.addCallback
+    def record(result):
+        latencies.append(time.time() - start)
+        return result
+
+    return d
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(latencies, 0.5),
+        "p90": percentile(latencies, 0.9),
+        "p99": percentile(latencies, 0.99),
+        "max": max(latencies)
+    }
+
+
+@defer.inlineCallbacks
+def measureHandshakes(reactor, port, contextFactories, count, concurrency):
+    """Does the given number of handshakes, cycling through the users,
+    and disconnects right after each.
+
+    """
+    def handshake(i):
+        contextFactory = contextFactories[i % len(contextFactories)]
+        d = connect(reactor, port, contextFactory)
+        d.addCallback(lambda client: client.transport.loseConnection())
+        return d
+
+    operations = [lambda i=i: handshake(i) for i in xrange(count)]
+    start = time.time()
+    yield runConcurrently(operations, concurrency)
+    defer.returnValue(count / (time.time() - start))
+
+
+@defer.inlineCallbacks
+def measureLatencies(clients, requests, command, argumentsFor):
+    """Has every client make the given number of requests, one after the
+    other, all clients at the same time.
+
+    """
+    latencies = []
+
+    @defer.inlineCallbacks
+    def makeRequests(client):
+        for i in xrange(requests):
+            call = lambda: client.callRemote(command, **argumentsFor(i))
+            yield timed(call, latencies)
+
+    yield defer.gatherResults([makeRequests(c) for c in clients])
+    defer.returnValue(summarize(latencies))
+
+
+def measureSolves(ampFactory, clients, users, exercises):
+    """Solves the given exercises for every user at once, and waits for
+    all clients to be notified.
+
+    """
+    total = len(users) * len(exercises)
+    done = defer.Deferred()
+    notified = [0]
+
+    def onNotified():
+        notified[0] += 1
+        if notified[0] == total:
+            done.callback(None)
+
+    for client in clients:
+        client.onNotified = onNotified
+
+    start = time.time()
+    for user in users:
+        proto, = ampFactory.connectionsFor(user)
+        for exercise in exercises:
+            solveAndNotify(proto, exercise)
+
+    done.addCallback(lambda _: total / (time.time() - start))
+    return done
+
+
+@defer.inlineCallbacks
+def measureChannels(clients, channels):
+    """Has every client open the given number of channels, all at once.
+
+    """
+    start = time.time()
+    yield defer.gatherResults([client.callRemote(Connect, factory=b"echo")
+                               for client in clients
+                               for _ in xrange(channels)])
+    defer.returnValue(len(clients) * channels / (time.time() - start))
+
+
+def _gitRevision():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "HEAD"])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.strip()
+
+
+@defer.inlineCallbacks
+def run(reactor, options):
+    store = Store(options["store"])
+    users, exercises = store.transact(populate, store, options["users"],
+                           options["exercises"], options["solved"])
+
+    tls = Endpoints(store)
+    ampFactory = service.Factory(store)
+    if options["commit-interval"] is not None:
+        ampFactory.writeQueue = WriteQueue(
+            store, maxDelay=options["commit-interval"] / 1000.0,
+            reactor=reactor)
+    tlsFactory = TLSMemoryBIOFactory(tls.serverFactory, False, ampFactory)
+    listeningPort = reactor.listenTCP(0, tlsFactory, interface="127.0.0.1")
+    port = listeningPort.getHost().port
+
+    key = PKey()
+    key.generate_key(TYPE_RSA, 2048)
+    contextFactories = [clientContextFactory(user.email, key)
+                        for user in users]
+
+    results = {}
+    try:
+        results["handshakes_per_second"] = yield measureHandshakes(
+            reactor, port, contextFactories, options["handshakes"],
+            options["concurrency"])
+
+        clients = yield runConcurrently(
+            [lambda f=f: connect(reactor, port, f) for f in contextFactories],
+            options["concurrency"])
+
+        results["get_exercises_seconds"] = yield measureLatencies(
+            clients, options["requests"], GetExercises,
+            lambda i: {"solved": bool(i % 2)})
+
+        identifiers = [e.identifier for e in getCatalog(store)]
+        results["get_exercise_details_seconds"] = yield measureLatencies(
+            clients, options["requests"], GetExerciseDetails,
+            lambda i: {"identifier": identifiers[i % len(identifiers)]})
+
+        results["solves_per_second"] = yield measureSolves(
+            ampFactory, clients, users, exercises[-options["solves"]:])
+
+        results["channel_opens_per_second"] = yield measureChannels(
+            clients, options["channels"])
+
+        for client in clients:
+            client.transport.loseConnection()
+    finally:
+        yield listeningPort.stopListening()
+        tls.close()
+
+    config = dict((p[0], options[p[0]]) for p in Options.optParameters
+                  if p[0] != "output")
+    report = {
+        "revision": _gitRevision(),
+        "time": time.time(),
+        "python": platform.python_version(),
+        "config": config,
+        "results": results
+    }
+
+    output = sys.stdout
+    if options["output"] != "-":
+        output = open(options["output"], "wb")
+    try:
+        json.dump(report, output, indent=2, sort_keys=True)
+        output.write("\n")
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+def main(reactor, *argv):
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        sys.exit("{0}\n{1}".format(options, e))
+    return run(reactor, options)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
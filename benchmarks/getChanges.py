@@ -0,0 +1,59 @@
+"""Benchmarks what a returning client costs the server.
+
+Compares getting all exercises again (``GetExercises``, once for
+solved and once for unsolved exercises) with getting only the changes
+since the client's last visit (``GetChanges``), when a few exercises
+were added and solved since.
+
+"""
+from __future__ import print_function
+
+import sys
+
+from merlyn.exercise import Exercise, _latestVersion
+
+from _bench import measure, report
+from getExercises import makeLocator
+
+
+def addChanges(locator, count):
+    """Adds and solves a few exercises, as if while the client was away.
+
+    """
+    def add():
+        for i in xrange(count):
+            exercise = Exercise(store=locator.store,
+                                identifier=b"new {0}".format(i),
+                                title=u"New exercise {0}".format(i),
+                                description=u"Description")
+            exercise.solvedBy(locator.user)
+
+    locator.store.transact(add)
+    locator.invalidateSolved()
+
+
+def getAll(locator):
+    return (locator.getExercises(solved=True),
+            locator.getExercises(solved=False))
+
+
+def getChanges(locator, since):
+    response = {"more": True, "version": since}
+    while response["more"]:
+        response = locator.getChanges(since=response["version"])
+
+
+def main(sizes=(10, 1000, 10000), changes=5):
+    for size in sizes:
+        locator = makeLocator(size)
+        since = _latestVersion(locator.store)
+        addChanges(locator, changes)
+
+        old = measure(lambda: getAll(locator))
+        new = measure(lambda: getChanges(locator, since))
+        report("everything, {0} exercises".format(size), old)
+        report("changes, {0} exercises".format(size), new, baseline=old)
+
+
+if __name__ == "__main__":
+    main(map(int, sys.argv[1:]) or (10, 1000, 10000))
@@ -0,0 +1,69 @@
+"""Benchmarks ``Locator.getExercises`` for catalogs of various sizes.
+
+Compares the old approach, which asks every exercise if it was solved
+(one query per exercise), with fetching the user's solved exercises
+in a single query.
+
+"""
+from __future__ import print_function
+
+import sys
+
+from axiom.store import Store
+from merlyn.auth import User
+from merlyn.exercise import Exercise, Locator
+
+from _bench import measure, report
+
+
+def makeLocator(exerciseCount, solvedFraction=0.5):
+    """Makes a locator for a fresh user in a new store with the given
+    number of exercises, some fraction of which has been solved.
+
+    """
+    store = Store()
+    locator = Locator()
+    locator.store = store
+    locator.user = user = User(store=store, email=b"user@example.com")
+
+    def populate():
+        solvedCount = int(exerciseCount * solvedFraction)
+        for i in xrange(exerciseCount):
+            exercise = Exercise(store=store,
+                                identifier=b"{0}".format(i),
+                                title=u"Exercise {0}".format(i),
+                                description=u"Description {0}".format(i))
+            if i < solvedCount:
+                exercise.solvedBy(user)
+
+    store.transact(populate)
+    return locator
+
+
+def perExercise(locator, solved):
+    """Gets exercises the old way: one query per exercise.
+
+    """
+    return [e for e in locator.store.query(Exercise)
+            if e.wasSolvedBy(locator.user) == solved]
+
+
+def batched(locator, solved):
+    """Gets exercises the new way: one query for the solved set.
+
+    """
+    return list(locator._getExercises(solved))
+
+
+def main(sizes=(10, 1000, 10000)):
+    for size in sizes:
+        locator = makeLocator(size)
+        repeat = 5 if size < 10000 else 3
+        old = measure(lambda: perExercise(locator, False), repeat=repeat)
+        new = measure(lambda: batched(locator, False), repeat=repeat)
+        report("per-exercise, {0} exercises".format(size), old)
+        report("batched, {0} exercises".format(size), new, baseline=old)
+
+
+if __name__ == "__main__":
+    main(map(int, sys.argv[1:]) or (10, 1000, 10000))
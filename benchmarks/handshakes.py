@@ -0,0 +1,53 @@
+"""Benchmarks TLS handshakes with the merlyn server context.
+
+Compares full handshakes with resumed ones, using both the server's
+session cache and session tickets. TLS 1.3 resumptions still do an
+ephemeral key exchange, so the gains are larger when the client
+limits itself to TLS 1.2.
+
+"""
+from __future__ import print_function
+
+import sys
+
+from OpenSSL import SSL
+
+from _bench import measure, report
+from _tls import Endpoints
+
+
+def benchmark(endpoints, count, options=0):
+    """Measures full and resumed handshakes, with the given options set
+    on the client context.
+
+    """
+    def handshakeTime(session=None):
+        return measure(lambda: endpoints.handshake(session),
+                       repeat=3, number=count)
+
+    endpoints.clientContext.set_options(options)
+    full = handshakeTime()
+    ticket = handshakeTime(endpoints.handshake().get_session())
+
+    endpoints.clientContext.set_options(SSL.OP_NO_TICKET)
+    cached = handshakeTime(endpoints.handshake().get_session())
+
+    return full, cached, ticket
+
+
+def main(count=200):
+    noTLSv1_3 = getattr(SSL, "OP_NO_TLSv1_3", 0)
+    for name, options in [("default", 0), ("TLS 1.2", noTLSv1_3)]:
+        endpoints = Endpoints()
+        try:
+            full, cached, ticket = benchmark(endpoints, count, options)
+        finally:
+            endpoints.close()
+
+        report("{0}, full".format(name), full)
+        report("{0}, resumed (session cache)".format(name), cached, full)
+        report("{0}, resumed (session ticket)".format(name), ticket, full)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
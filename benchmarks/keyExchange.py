@@ -0,0 +1,43 @@
+"""Benchmarks full TLS 1.2 handshakes with ECDHE and DHE key exchange.
+
+The client only offers one ciphersuite at a time, so that the server
+is forced to use that key exchange. Everything runs in one thread, so
+the results are handshakes per second per core.
+
+"""
+from __future__ import print_function
+
+import sys
+
+from OpenSSL import SSL
+
+from _bench import measure, report
+from _tls import Endpoints
+
+
+ciphersuites = [
+    ("DHE (2048 bit)", b"DHE-RSA-AES128-SHA"),
+    ("ECDHE (prime256v1)", b"ECDHE-RSA-AES128-SHA"),
+]
+
+
+def main(count=200):
+    endpoints = Endpoints()
+    endpoints.clientContext.set_options(getattr(SSL, "OP_NO_TLSv1_3", 0))
+    try:
+        results = []
+        for name, ciphersuite in ciphersuites:
+            endpoints.clientContext.set_cipher_list(ciphersuite)
+            results.append(measure(endpoints.handshake,
+                                   repeat=3, number=count))
+    finally:
+        endpoints.close()
+
+    dhe = results[0]
+    for (name, _), seconds in zip(ciphersuites, results):
+        report(name, seconds, baseline=dhe)
+        print("  {0:.0f} handshakes/s/core".format(1 / seconds))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200)
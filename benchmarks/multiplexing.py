@@ -0,0 +1,33 @@
+"""Benchmarks looking up a multiplexed connection factory.
+
+Compares a fresh ``FactoryDict`` per lookup (what every connection
+used to do: query the store, dereference the name and build the
+factory) with the shared factory dict of the store.
+
+"""
+from __future__ import print_function
+
+from axiom.store import Store
+from merlyn.multiplexing import FactoryDict, addToStore, getFactoryDict
+
+from _bench import measure, report
+
+
+def main(factoryCount=100, number=1000):
+    store = Store()
+    for i in xrange(factoryCount):
+        addToStore(store, b"{0}".format(i), b"merlyn.service.Factory")
+
+    identifier = b"{0}".format(factoryCount // 2)
+    factoryDict = getFactoryDict(store)
+    factoryDict[identifier]
+
+    old = measure(lambda: FactoryDict(store)[identifier], number=number)
+    new = measure(lambda: factoryDict[identifier], number=number)
+    report("fresh factory dict, {0} factories".format(factoryCount), old)
+    report("shared factory dict, {0} factories".format(factoryCount), new,
+           baseline=old)
+
+
+if __name__ == "__main__":
+    main()
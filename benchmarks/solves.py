@@ -0,0 +1,73 @@
+"""Benchmarks how many solutions per second can be recorded on disk,
+each in its own transaction versus grouped by a write queue.
+
+Every SQLite transaction ends with an fsync, so the difference depends
+a lot on the disk the store is on. Run it against a path on the disk
+the server will use.
+
+"""
+from __future__ import print_function
+
+import sys
+import time
+
+from axiom.store import Store
+from merlyn.auth import User
+from merlyn.exercise import Exercise
+from merlyn.writequeue import WriteQueue
+from twisted.internet import defer, task
+
+
+def populate(store, userCount):
+    """Creates an exercise, and users to solve it.
+
+    """
+    exercise = Exercise(store=store, identifier=b"x",
+                        title=u"Exercise", description=u"Description")
+    users = [User(store=store, email=b"user{0}@example.com".format(i))
+             for i in xrange(userCount)]
+    return exercise, users
+
+
+def solveEach(exercise, users):
+    """Records every solution in its own transaction.
+
+    """
+    start = time.time()
+    for user in users:
+        exercise.store.transact(exercise.solvedBy, user)
+    return time.time() - start
+
+
+@defer.inlineCallbacks
+def solveQueued(reactor, exercise, users, maxSize):
+    """Records every solution through a write queue, as if all users
+    solved the exercise at once.
+
+    """
+    queue = WriteQueue(exercise.store, maxSize=maxSize, reactor=reactor)
+    start = time.time()
+    yield defer.gatherResults([queue.write(exercise.solvedBy, user)
+                               for user in users])
+    defer.returnValue(time.time() - start)
+
+
+@defer.inlineCallbacks
+def main(reactor, path, userCount=500):
+    store = Store(path)
+    exercise, users = store.transact(populate, store, userCount)
+
+    elapsed = solveEach(exercise, users)
+    print("{0:<32} {1:>10.1f} solves/s".format("one transaction each",
+                                               userCount / elapsed))
+
+    for maxSize in [10, 100]:
+        elapsed = yield solveQueued(reactor, exercise, users, maxSize)
+        name = "write queue, {0} per group".format(maxSize)
+        print("{0:<32} {1:>10.1f} solves/s".format(name, userCount / elapsed))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: {0} STORE_PATH".format(sys.argv[0]))
+    task.react(main, [sys.argv[1]])
@@ -0,0 +1,121 @@
+"""Benchmarks AMP responder latency under concurrent load, with and
+without a store thread.
+
+Simulates a steady stream of requests. Most come from connections
+that have already cached their user's solved exercises; the rest are
+from new connections, which have to fetch them from the store. Without
+a store thread, those fetches block the reactor, delaying every other
+request that arrives in the meantime.
+
+Keep in mind that the store thread still needs the GIL to turn rows
+into Python objects; it helps most when SQLite itself is slow (disk
+I/O, locks held by other processes), since SQLite releases the GIL.
+
+"""
+from __future__ import print_function
+
+import random
+import sys
+import time
+
+from axiom.store import Store
+from merlyn.auth import User
+from merlyn.exercise import Exercise, Locator, _Solution
+from merlyn.storethread import StoreThread
+from twisted.internet import defer, reactor, task
+
+from _bench import percentile
+
+
+def populate(store, userCount, exerciseCount):
+    """Creates exercises, and users that have solved all of them.
+
+    """
+    exercises = [Exercise(store=store,
+                          identifier=b"{0}".format(i),
+                          title=u"Exercise {0}".format(i),
+                          description=u"Description {0}".format(i))
+                 for i in xrange(exerciseCount)]
+
+    users = []
+    for i in xrange(userCount):
+        user = User(store=store, email=b"user{0}@example.com".format(i))
+        for exercise in exercises:
+            _Solution(store=store, who=user, what=exercise)
+        users.append(user)
+    return users
+
+
+def makeLocator(store, user, storeThread):
+    locator = Locator()
+    locator.store, locator.user = store, user
+    locator.storeThread = storeThread
+    return locator
+
+
+@defer.inlineCallbacks
+def simulate(store, users, storeThread, requests, rate, coldFraction):
+    """Sends requests at the given rate, and returns the latencies of
+    requests from warm and cold connections.
+
+    """
+    warm = [makeLocator(store, user, None) for user in users[:10]]
+    for locator in warm:
+        locator.solvedIDs
+
+    latencies = {"warm": [], "cold": []}
+    pending = []
+
+    def request(start):
+        if random.random() < coldFraction:
+            kind = "cold"
+            locator = makeLocator(store, random.choice(users), storeThread)
+            d = defer.maybeDeferred(locator.getExercises, solved=True)
+        else:
+            kind = "warm"
+            locator = random.choice(warm)
+            d = defer.maybeDeferred(locator.getExerciseDetails,
+                                    identifier=b"0")
+        d.addCallback(lambda _: latencies[kind].append(time.time() - start))
+        pending.append(d)
+
+    # Latencies are measured from when the request should have been
+    # sent, so that time spent waiting for a blocked reactor counts.
+    start = time.time()
+    for i in xrange(requests):
+        delay = i / rate
+        reactor.callLater(delay, request, start + delay)
+
+    yield task.deferLater(reactor, requests / rate, lambda: None)
+    yield defer.gatherResults(pending)
+    defer.returnValue(latencies)
+
+
+@defer.inlineCallbacks
+def main(userCount=200, exerciseCount=500, requests=1000, rate=200.0,
+         coldFraction=0.05):
+    store = Store(sys.argv[1] if len(sys.argv) > 1 else None)
+    users = store.transact(populate, store, userCount, exerciseCount)
+
+    storeThread = StoreThread(store.dbdir)
+    storeThread.start()
+
+    try:
+        for name, thread in [("reactor thread", None),
+                             ("store thread", storeThread)]:
+            random.seed(0)
+            latencies = yield simulate(store, users, thread, requests,
+                                       rate, coldFraction)
+            for kind in ["warm", "cold"]:
+                values = latencies[kind]
+                print("{0}, {1} connections: p50 {2:.6f}s p99 {3:.6f}s"
+                      .format(name, kind, percentile(values, 0.5),
+                              percentile(values, 0.99)))
+    finally:
+        yield storeThread.stop()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: {0} STORE_PATH".format(sys.argv[0]))
+    task.react(lambda reactor: main())
@@ -0,0 +1,67 @@
+"""Benchmarks exporting and importing solutions with ``merlyn-admin``.
+
+Exports a store with many solutions to a file, and imports that file
+into a new store, reporting records per second and the peak memory use
+of the process.
+
+"""
+from __future__ import print_function
+
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+from axiom.store import Store
+from merlyn import admin
+from merlyn.auth import User
+from merlyn.exercise import Exercise, _Solution
+
+
+def populate(store, userCount, exerciseCount):
+    exercises = [Exercise(store=store, identifier=b"{0}".format(i),
+                          title=u"Exercise {0}".format(i),
+                          description=u"Description {0}".format(i))
+                 for i in xrange(exerciseCount)]
+    for i in xrange(userCount):
+        user = User(store=store, email=b"user{0}@example.com".format(i))
+        for exercise in exercises:
+            _Solution(store=store, who=user, what=exercise)
+
+
+def peakMemory():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def main(userCount=2000, exerciseCount=25):
+    path = tempfile.mkdtemp()
+    try:
+        source = Store(os.path.join(path, "source"))
+        source.transact(populate, source, userCount, exerciseCount)
+        records = userCount + exerciseCount + userCount * exerciseCount
+        print("{0} records, peak memory {1:.1f} MiB after populating"
+              .format(records, peakMemory()))
+
+        exportPath = os.path.join(path, "export.jsonl")
+        start = time.time()
+        with open(exportPath, "wb") as output:
+            admin.export(source, output)
+        elapsed = time.time() - start
+        print("export: {0:>10.1f} records/s, peak memory {1:.1f} MiB"
+              .format(records / elapsed, peakMemory()))
+
+        destination = Store(os.path.join(path, "destination"))
+        start = time.time()
+        with open(exportPath, "rb") as lines:
+            admin.importLines(destination, lines)
+        elapsed = time.time() - start
+        print("import: {0:>10.1f} records/s, peak memory {1:.1f} MiB"
+              .format(records / elapsed, peakMemory()))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,73 @@
+"""Benchmarks ``Exercise.wasSolvedBy`` with a large solution log.
+
+The store is populated with many solutions (by default a million),
+spread over many users and exercises. ``wasSolvedBy`` is then timed
+with the (who, what) index, with only the single-column indexes Axiom
+creates for reference attributes, and without any index at all.
+
+"""
+from __future__ import print_function
+
+import sys
+
+from axiom.store import Store
+from merlyn.auth import User
+from merlyn.exercise import Exercise, _Solution
+
+from _bench import measure, report
+
+
+def populate(store, solutionCount, exerciseCount=100):
+    """Creates ``exerciseCount`` exercises, and enough users solving all
+    of them to produce ``solutionCount`` solutions.
+
+    """
+    exercises = [Exercise(store=store,
+                          identifier=b"{0}".format(i),
+                          title=u"Exercise {0}".format(i),
+                          description=u"Description {0}".format(i))
+                 for i in xrange(exerciseCount)]
+
+    users = []
+    for i in xrange(solutionCount // exerciseCount):
+        user = User(store=store, email=b"user{0}@example.com".format(i))
+        for exercise in exercises:
+            _Solution(store=store, who=user, what=exercise)
+        users.append(user)
+
+    return users, exercises
+
+
+def dropIndex(store, *columns):
+    """Drops the index on the given solution columns.
+
+    """
+    name = store._indexNameOf(_Solution, columns)
+    store.executeSchemaSQL("DROP INDEX *DATABASE*.{0}".format(name))
+
+
+def main(solutionCount=10 ** 6):
+    store = Store(sys.argv[2] if len(sys.argv) > 2 else None)
+    users, exercises = store.transact(populate, store, solutionCount)
+    user, exercise = users[len(users) // 2], exercises[-1]
+    unsolved = User(store=store, email=b"lazy@example.com")
+
+    def check():
+        exercise.wasSolvedBy(user)
+        exercise.wasSolvedBy(unsolved)
+
+    compound = measure(check, number=100)
+    dropIndex(store, "who", "what")
+    single = measure(check, number=100)
+    dropIndex(store, "who")
+    dropIndex(store, "what")
+    unindexed = measure(check, number=10)
+
+    title = "wasSolvedBy, {0} solutions".format(solutionCount)
+    report(title + ", no index", unindexed)
+    report(title + ", single-column", single, baseline=unindexed)
+    report(title + ", (who, what)", compound, baseline=unindexed)
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10 ** 6)
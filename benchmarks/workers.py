@@ -0,0 +1,133 @@
+"""Benchmarks TLS handshake throughput of a real server with different
+numbers of worker processes.
+
+Starts ``twistd merlyn --workers N`` for each N, and has several
+client processes do full handshakes against it as fast as they can.
+Handshakes are mostly CPU, so throughput should scale with N, up to
+the number of cores (minus the ones the clients are using).
+
+This listens on the server's default ports (4430 and 8888), so make
+sure nothing else is using them.
+
+"""
+from __future__ import print_function
+
+import multiprocessing
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from axiom.store import Store
+from merlyn.auth import User
+from OpenSSL.crypto import FILETYPE_PEM, dump_certificate, dump_privatekey
+from OpenSSL.SSL import Connection, Context, SSLv23_METHOD
+
+from _tls import dhParameters, makeCredentials
+
+
+port = 4430
+
+
+def writeFiles(path):
+    """Writes a store with a user, the server's TLS files, and the user's
+    key and certificate to the given directory.
+
+    Returns the paths of the user's key and certificate.
+
+    """
+    email = b"user@example.com"
+    store = Store(os.path.join(path, "store"))
+    User(store=store, email=email)
+    store.close()
+
+    files = {"dhparam.pem": dhParameters}
+    for prefix, address in [("", b"server@example.com"), ("user-", email)]:
+        key, cert = makeCredentials(address)
+        files[prefix + "key.pem"] = dump_privatekey(FILETYPE_PEM, key)
+        files[prefix + "cert.pem"] = dump_certificate(FILETYPE_PEM, cert)
+
+    for name, content in files.iteritems():
+        with open(os.path.join(path, name), "wb") as f:
+            f.write(content)
+
+    return os.path.join(path, "user-key.pem"), os.path.join(path, "user-cert.pem")
+
+
+def startServer(path, workers):
+    """Starts a server with the given number of workers, and waits until
+    it is listening.
+
+    """
+    env = dict(os.environ)
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join([repository,
+                                         env.get("PYTHONPATH", "")])
+    arguments = [sys.executable, "-c",
+                 "from twisted.scripts.twistd import run; run()",
+                 "--nodaemon", "--pidfile=", "--logfile=server.log",
+                 "merlyn", "--store=store", "--workers={0}".format(workers)]
+    process = subprocess.Popen(arguments, cwd=path, env=env)
+
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    else:
+        process.terminate()
+        raise RuntimeError("server didn't start listening")
+
+    # Give the workers some time to start listening too.
+    time.sleep(2 * workers)
+    return process
+
+
+def handshakes(args):
+    """Does full handshakes for the given number of seconds, and returns
+    how many were done.
+
+    """
+    keyPath, certPath, seconds = args
+    context = Context(SSLv23_METHOD)
+    context.use_privatekey_file(keyPath)
+    context.use_certificate_file(certPath)
+
+    count = 0
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        skt = socket.create_connection(("127.0.0.1", port))
+        connection = Connection(context, skt)
+        connection.set_connect_state()
+        connection.do_handshake()
+        skt.close()
+        count += 1
+    return count
+
+
+def main(workerCounts=(1, 2, 4), clients=8, seconds=10.0):
+    path = tempfile.mkdtemp()
+    try:
+        keyPath, certPath = writeFiles(path)
+        pool = multiprocessing.Pool(clients)
+        for workers in workerCounts:
+            server = startServer(path, workers)
+            try:
+                counts = pool.map(handshakes,
+                                  [(keyPath, certPath, seconds)] * clients)
+            finally:
+                server.terminate()
+                server.wait()
+            print("{0} worker(s): {1:>10.1f} handshakes/s"
+                  .format(workers, sum(counts) / seconds))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main(map(int, sys.argv[1:]) or (1, 2, 4))
@@ -0,0 +1,457 @@
+"""Command-line administration of a merlyn store.
+
+Users, exercises and solutions can be exported to, and imported from,
+line-delimited JSON: one object per line, with a ``type`` key of
+``"user"``, ``"exercise"`` or ``"solution"``. Exports list users and
+exercises before the solutions that refer to them, so that they can be
+imported in order.
+
+Both directions stream: exports read the store in batches, and imports
+write it in batches, one transaction per batch. Neither keeps more
+than a batch (and a few bounded caches) in memory.
+
+Users can also be provisioned, with their secrets, from a roster of
+e-mail addresses (one per line), before they first connect.
+
+"""
+import json
+import sys
+import time
+from itertools import islice
+
+from axiom import queryutil as q, store
+from merlyn.auth import User
+from merlyn.batching import inBatches
+from merlyn.cache import LRUCache
+from merlyn.exercise import Exercise, Secret, _Solution
+from twisted.python import usage
+
+
+def _latestStoreID(store):
+    """Gets the largest store ID of any user, exercise or solution.
+
+    """
+    latest = 0
+    for itemClass in User, Exercise, _Solution:
+        query = store.query(itemClass, sort=itemClass.storeID.descending,
+                            limit=1)
+        latest = max([latest] + list(query.getColumn("storeID")))
+    return latest
+
+
+
+def _iterInBatches(store, itemClass, batchSize, maxStoreID):
+    """Iterates over all items of the given class, up to the given store
+    ID, loading them from the store one batch at a time.
+
+    """
+    lastStoreID = -1
+    while True:
+        inRange = q.AND(itemClass.storeID > lastStoreID,
+                        itemClass.storeID <= maxStoreID)
+        batch = list(store.query(itemClass, inRange,
+                                 sort=itemClass.storeID.ascending,
+                                 limit=batchSize))
+        if not batch:
+            return
+        for item in batch:
+            yield item
+        lastStoreID = batch[-1].storeID
+
+
+
+def _iterSolutionsInBatches(store, batchSize, maxStoreID):
+    """Iterates over the store IDs of who solved what, for all solutions up
+    to the given store ID, one batch at a time.
+
+    This doesn't load the solutions, or the users and exercises they
+    refer to.
+
+    """
+    lastStoreID = -1
+    while True:
+        inRange = q.AND(_Solution.storeID > lastStoreID,
+                        _Solution.storeID <= maxStoreID)
+        query = store.query(_Solution, inRange,
+                            sort=_Solution.storeID.ascending,
+                            limit=batchSize)
+        storeIDs = list(query.getColumn("storeID"))
+        if not storeIDs:
+            return
+        whos = query.getColumn("who", raw=True)
+        whats = query.getColumn("what", raw=True)
+        for who, what in zip(whos, whats):
+            yield who, what
+        lastStoreID = storeIDs[-1]
+
+
+
+def _lookup(cache, store, storeID, attribute):
+    """Gets an attribute of the item with the given store ID, from the
+    cache if it's there.
+
+    """
+    value = cache.get(storeID)
+    if value is None:
+        value = cache[storeID] = getattr(store.getItemByID(storeID), attribute)
+    return value
+
+
+
+def export(store, output, batchSize=1000, cacheSize=1024):
+    """Writes all users, exercises and solutions in the store to the given
+    file, one JSON object per line.
+
+    Since every batch is read in its own transaction, other processes
+    may add to the store during the export. Only the items that
+    existed when the export started are exported, so that no solution
+    refers to a user or exercise that isn't in the export. That works
+    because store IDs only ever increase, and solutions are always
+    added after the users and exercises they refer to.
+
+    """
+    maxStoreID = _latestStoreID(store)
+
+    for user in _iterInBatches(store, User, batchSize, maxStoreID):
+        _writeLine(output, type="user", email=user.email, digest=user.digest)
+
+    for exercise in _iterInBatches(store, Exercise, batchSize, maxStoreID):
+        _writeLine(output, type="exercise", identifier=exercise.identifier,
+                   title=exercise.title, description=exercise.description)
+
+    emails, identifiers = LRUCache(cacheSize), LRUCache(cacheSize)
+    for who, what in _iterSolutionsInBatches(store, batchSize, maxStoreID):
+        _writeLine(output, type="solution",
+                   user=_lookup(emails, store, who, "email"),
+                   exercise=_lookup(identifiers, store, what, "identifier"))
+
+
+
+def _writeLine(output, **fields):
+    output.write(json.dumps(fields, sort_keys=True) + "\n")
+
+
+
+class _Importer(object):
+    """Imports lines of an export into a store.
+
+    Users and exercises that already exist (by e-mail address and
+    identifier) are updated, and solutions that already exist are
+    skipped, so that exports can be merged into existing stores.
+
+    """
+    def __init__(self, store, cacheSize=1024):
+        self.store = store
+        self._users = LRUCache(cacheSize)
+        self._exercises = LRUCache(cacheSize)
+        self.counts = {"user": 0, "exercise": 0, "solution": 0}
+
+
+    def importLines(self, lines):
+        """Imports the given numbered lines, in the current transaction.
+
+        Solutions are recorded once all of the lines have been read, so
+        that the ones that already exist can be found together (see
+        ``_importSolutions``).
+
+        """
+        self._solutions = []
+        for number, line in lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            try:
+                fields = json.loads(line)
+                kind = fields.pop("type")
+                importer = getattr(self, "_import_" + kind)
+            except (ValueError, KeyError, AttributeError):
+                raise ValueError("line {0}: not a user, exercise or "
+                                 "solution".format(number))
+
+            importer(number, **fields)
+            self.counts[kind] += 1
+
+        self._importSolutions()
+
+
+    def _import_user(self, number, email, digest=None):
+        email = email.encode("utf-8")
+        user = self.store.findOrCreate(User, email=email)
+        if digest is not None:
+            user.digest = digest.encode("utf-8")
+        self._users[email] = user
+
+
+    def _import_exercise(self, number, identifier, title, description):
+        identifier = identifier.encode("utf-8")
+        exercise = self.store.findFirst(Exercise,
+                                        Exercise.identifier == identifier)
+        if exercise is None:
+            exercise = Exercise(store=self.store, identifier=identifier,
+                                title=title, description=description)
+        else:
+            exercise.title, exercise.description = title, description
+        self._exercises[identifier] = exercise
+
+
+    def _import_solution(self, number, user, exercise):
+        who = self._find(number, self._users, User, User.email, user)
+        what = self._find(number, self._exercises, Exercise,
+                          Exercise.identifier, exercise)
+        self._solutions.append((who, what))
+
+
+    def _importSolutions(self):
+        """Records the solutions read from the lines being imported, unless
+        they already exist.
+
+        The existing solutions are found with one query per as many of
+        the solvers as SQLite allows in one query (see
+        ``batching.inBatches``), instead of one query per solution.
+
+        """
+        users = dict((who.storeID, who) for who, _what in self._solutions)
+        existing = set()
+        for someUsers in inBatches(users.values()):
+            query = self.store.query(_Solution, _Solution.who.oneOf(someUsers),
+                                     sort=_Solution.storeID.ascending)
+            existing.update(zip(query.getColumn("who", raw=True),
+                                query.getColumn("what", raw=True)))
+
+        for who, what in self._solutions:
+            key = who.storeID, what.storeID
+            if key not in existing:
+                what.solvedBy(who)
+                existing.add(key)
+
+
+    def _find(self, number, cache, itemClass, attribute, value):
+        """Finds the item referred to by a solution on the given line.
+
+        """
+        value = value.encode("utf-8")
+        item = cache.get(value)
+        if item is None:
+            item = self.store.findFirst(itemClass, attribute == value)
+            if item is None:
+                raise ValueError("line {0}: no {1} {2!r}"
+                                 .format(number, attribute.attrname, value))
+            cache[value] = item
+        return item
+
+
+
+def importLines(store, lines, batchSize=1000):
+    """Imports the given lines of an export into the store, committing
+    every ``batchSize`` lines.
+
+    If a line can't be imported, ``ValueError`` is raised, and its
+    batch is rolled back; earlier batches stay committed.
+
+    Returns the number of users, exercises and solutions imported.
+
+    """
+    importer = _Importer(store)
+    numbered = enumerate(lines, 1)
+    while True:
+        batch = list(islice(numbered, batchSize))
+        if not batch:
+            return importer.counts
+        store.transact(importer.importLines, batch)
+
+
+
+def _provisionBatch(store, batch, counts):
+    """Provisions a batch of numbered roster lines, in the current
+    transaction.
+
+    The existing users and secrets for the whole batch are found with
+    one query each, per as many of them as SQLite allows in one query
+    (see ``batching.inBatches``).
+
+    """
+    emails = []
+    for number, line in batch:
+        email = line.strip()
+        if not email or email.startswith(b"#"):
+            continue
+        if b"@" not in email:
+            raise ValueError("line {0}: not an e-mail address".format(number))
+        emails.append(email)
+
+    users = {}
+    for someEmails in inBatches(emails):
+        query = store.query(User, User.email.oneOf(someEmails))
+        users.update((user.email, user) for user in query)
+
+    withSecrets = set()
+    for someUsers in inBatches(users.values()):
+        query = store.query(Secret, Secret.user.oneOf(someUsers))
+        withSecrets.update(query.getColumn("user", raw=True))
+
+    for email in emails:
+        user = users.get(email)
+        if user is None:
+            user = users[email] = User(store=store, email=email)
+            counts["user"] += 1
+        if user.storeID not in withSecrets:
+            Secret(store=store, user=user)
+            withSecrets.add(user.storeID)
+            counts["secret"] += 1
+    counts["email"] += len(emails)
+
+
+
+def provision(store, lines, batchSize=1000):
+    """Provisions a user and a secret for every e-mail address in the
+    given lines of a roster, committing every ``batchSize`` lines.
+
+    Blank lines and lines starting with ``#`` are skipped. Users and
+    secrets that already exist are left alone, so that rosters can be
+    provisioned again when students are added. Once a user has been
+    provisioned, their first connections only read from the store.
+
+    If a line isn't an e-mail address, ``ValueError`` is raised, and
+    its batch is rolled back; earlier batches stay committed.
+
+    Returns the number of e-mail addresses, and of new users and
+    secrets.
+
+    """
+    counts = {"email": 0, "user": 0, "secret": 0}
+    numbered = enumerate(lines, 1)
+    while True:
+        batch = list(islice(numbered, batchSize))
+        if not batch:
+            return counts
+        store.transact(_provisionBatch, store, batch, counts)
+
+
+
+class _ExportOptions(usage.Options):
+    """Exports users, exercises and solutions as line-delimited JSON.
+
+    """
+    optParameters = [
+        ["output", "o", "-", "File to export to (default: stdout)"],
+        ["batch-size", None, 1000, "Items to read from the store at once",
+         int]
+    ]
+
+
+
+class _ImportOptions(usage.Options):
+    """Imports users, exercises and solutions from line-delimited JSON.
+
+    """
+    optParameters = [
+        ["batch-size", None, 1000, "Lines to import per transaction", int]
+    ]
+
+    def parseArgs(self, path="-"):
+        self["input"] = path
+
+
+
+class _ProvisionOptions(usage.Options):
+    """Provisions users and secrets from a roster of e-mail addresses.
+
+    """
+    optParameters = [
+        ["batch-size", None, 1000, "Lines to provision per transaction", int]
+    ]
+
+    def parseArgs(self, path="-"):
+        self["input"] = path
+
+
+
+class Options(usage.Options):
+    """
+    The options for administering a store.
+    """
+    synopsis = "Usage: merlyn-admin --store PATH COMMAND [options]"
+
+    optParameters = [
+        ["store", "s", None, "Path to the store (mandatory)", store.Store]
+    ]
+
+    subCommands = [
+        ["export", None, _ExportOptions, _ExportOptions.__doc__.strip()],
+        ["import", None, _ImportOptions, _ImportOptions.__doc__.strip()],
+        ["provision", None, _ProvisionOptions,
+         _ProvisionOptions.__doc__.strip()]
+    ]
+
+    def postOptions(self):
+        """Verify that a store and a command were passed.
+
+        """
+        if self["store"] is None:
+            raise usage.UsageError("Passing a root store is mandatory.")
+        if self.subCommand is None:
+            raise usage.UsageError("Passing a command is mandatory.")
+
+
+
+def _open(path, mode, default):
+    if path == "-":
+        return default
+    return open(path, mode)
+
+
+
+def run(argv=None, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
+    """Runs the ``merlyn-admin`` command line tool.
+
+    """
+    options = Options()
+    try:
+        options.parseOptions(argv)
+    except usage.UsageError as e:
+        stderr.write("{0}\n{1}\n".format(options, e))
+        return 2
+
+    store, subOptions = options["store"], options.subOptions
+    if options.subCommand == "export":
+        output = _open(subOptions["output"], "wb", stdout)
+        try:
+            export(store, output, subOptions["batch-size"])
+        finally:
+            if output is not stdout:
+                output.close()
+        return 0
+
+    lines = _open(subOptions["input"], "rb", stdin)
+    start = time.time()
+    try:
+        if options.subCommand == "import":
+            counts = importLines(store, lines, subOptions["batch-size"])
+        else:
+            counts = provision(store, lines, subOptions["batch-size"])
+    except ValueError as e:
+        stderr.write("{0}\n".format(e))
+        return 1
+    finally:
+        if lines is not stdin:
+            lines.close()
+    elapsed = time.time() - start
+
+    if options.subCommand == "import":
+        stderr.write("Imported {user} users, {exercise} exercises and "
+                     "{solution} solutions.\n".format(**counts))
+    else:
+        inserts = counts["user"] + counts["secret"]
+        stderr.write("Provisioned {email} e-mail addresses: {user} new "
+                     "users and {secret} new secrets.\n".format(**counts))
+        stderr.write("Inserted {0} items in {1:.2f}s ({2:.0f} per second)."
+                     "\n".format(inserts, elapsed,
+                                 inserts / elapsed if elapsed else 0))
+
+    return 0
+
+
+
+def main():
+    sys.exit(run())
@@ -1,8 +1,18 @@
+import os
+import time
+from weakref import WeakKeyDictionary
+
 from axiom import attributes, item
 from axiom.errors import ItemNotFound
 from clarent.certificate import SecureCiphersContextFactory
+from merlyn import metrics
+from merlyn.cache import LRUCache, forStore
 from OpenSSL.SSL import Context, VERIFY_PEER, SSLv23_METHOD
 from OpenSSL.SSL import OP_SINGLE_DH_USE, OP_NO_SSLv2, OP_NO_SSLv3
+from OpenSSL.SSL import OP_CIPHER_SERVER_PREFERENCE, OP_SINGLE_ECDH_USE
+from OpenSSL.SSL import SESS_CACHE_SERVER
+from OpenSSL.crypto import get_elliptic_curve
+from twisted.internet import reactor, task
 from twisted.python import log
 
 
@@ -13,6 +23,72 @@ class User(item.Item):
     email = attributes.bytes(allowNone=False, indexed=True)
     digest = attributes.bytes()
 
+    _repinned = attributes.inmemory()
+
+    def __setattr__(self, name, value):
+        """Sets an attribute. Replacing a digest that was already pinned is
+        remembered, so that the TLS sessions are flushed once that's
+        committed.
+
+        """
+        if name == "digest" and self.store is not None:
+            if self.digest is not None and self.digest != value:
+                self._repinned = True
+        item.Item.__setattr__(self, name, value)
+
+
+    def committed(self):
+        """Forgets this user's verified certificates, since the user's
+        e-mail address or digest may have just changed.
+
+        If the user's digest was replaced, the contexts of the TLS
+        context factories serving this store are rebuilt, which
+        flushes their session caches and rotates their session ticket
+        keys. Otherwise, a client could still resume a session with
+        the old certificate.
+
+        """
+        store = self.store
+        item.Item.committed(self)
+        getVerifiedUsers(store).discardValue(self)
+        if getattr(self, "_repinned", False):
+            self._repinned = False
+            for ctxFactory in list(_getContextFactories(store)):
+                ctxFactory.reload()
+
+
+
+maxVerifiedUsers = 1024
+
+
+def getVerifiedUsers(store):
+    """Gets the cache of verified users for the given store.
+
+    This is an ``LRUCache`` of certificate digests to the users whose
+    certificates have been verified. It is shared by certificate
+    verification and ``UserMixin``, so that neither has to query the
+    store for returning users. Users remove themselves when they
+    change. It is kept on the store (see ``cache.forStore``).
+
+    """
+    return forStore(store, "verifiedUsers",
+                    lambda store: LRUCache(maxVerifiedUsers))
+
+
+
+def _getContextFactories(store):
+    """Gets the set of started context factories serving the given store.
+
+    """
+    return forStore(store, "contextFactories", lambda store: set())
+
+
+
+class BadDigest(Exception):
+    """The peer certificate's digest isn't the one pinned for its user.
+
+    """
+
 
 
 class UserMixin(object):
@@ -30,23 +106,183 @@ class UserMixin(object):
     def user(self):
         """The current user.
 
-        This property is cached in the ``_user`` attribute.
+        This property is cached in the ``_user`` attribute. If the
+        certificate was verified recently, the user comes from the
+        cache of verified users instead of the store.
+
+        Otherwise, the certificate's digest is checked against the
+        user's, since a resumed TLS session may not have been verified
+        against the user's current digest. If they don't match, the
+        connection is dropped, and ``BadDigest`` is raised.
+
         """
         if self._user is not None:
             return self._user
 
         cert = self.transport.getPeerCertificate()
-        self._user = user = userForCert(self.store, cert)
+        digest = cert.digest("sha512")
+        verifiedUsers = getVerifiedUsers(self.store)
+        user = verifiedUsers.get(digest)
+        if user is None:
+            user = userForCert(self.store, cert)
+            if user.digest != digest:
+                self.transport.loseConnection()
+                raise BadDigest(user.email, digest)
+            verifiedUsers[digest] = user
+        self._user = user
+        self.userResolved(user)
         return user
 
 
+    def userResolved(self, user):
+        """Called when the current user has been found.
+
+        Does nothing by default.
+
+        """
+
+
 
 class _TOFUContextFactory(object):
-    def __init__(self, store):
+    """A context factory that does TOFU/POP (Trust On First Use/Persistence
+    of Pseudonym) verification of client certificates.
+
+    The context is built once, and reused until it is reloaded, or
+    until one of the files it was built from is modified. While the
+    context factory is started, it checks if they were modified every
+    ``checkInterval`` seconds, so that accepting connections doesn't
+    touch the file system.
+
+    Returning clients can resume their TLS sessions, either from the
+    server's session cache or with a session ticket, for
+    ``sessionTimeout`` seconds. OpenSSL generates random session
+    ticket keys for each context, so the ticket keys are rotated by
+    building a new context every ``ticketKeyLifetime`` seconds (or
+    never, if that's ``None``). That also empties the session cache.
+    While the context factory is started, the context is also rebuilt
+    when a user's digest is replaced, so that sessions established
+    with the old certificate can't be resumed. The session cache and
+    ticket keys belong to this context factory, so sessions can't be
+    resumed in another process, such as another worker (see
+    ``merlyn.workers``).
+
+    Ephemeral keys are exchanged using ECDHE on the elliptic curve
+    named by ``ellipticCurve``, which is much cheaper than DHE. DHE is
+    only used for clients that don't support ECDHE.
+
+    At most ``verifyLogLimit`` verifications of each outcome are
+    logged per minute; the rest are summarized. While the context
+    factory is started, the summary is logged at the end of every
+    minute.
+
+    """
+    _now = staticmethod(time.time)
+
+    def __init__(self, store, certificatePath="cert.pem", keyPath="key.pem",
+                 dhParametersPath="dhparam.pem", sessionTimeout=60 * 60,
+                 ticketKeyLifetime=24 * 60 * 60, ellipticCurve="prime256v1",
+                 verifyLogLimit=100, checkInterval=10.0, reactor=reactor):
         self.store = store
+        self.certificatePath = certificatePath
+        self.keyPath = keyPath
+        self.dhParametersPath = dhParametersPath
+        self.sessionTimeout = sessionTimeout
+        self.ticketKeyLifetime = ticketKeyLifetime
+        self.ellipticCurve = ellipticCurve
+        self.checkInterval = checkInterval
+        self.reactor = reactor
+        self._log = _RateLimitedLog(verifyLogLimit, now=lambda: self._now())
+        self._pending = WeakKeyDictionary()
+
+        self._context = None
+        self._modificationTimes = None
+        self._builtAt = None
+        self._calls = []
+
+
+    def start(self):
+        """Starts checking the files the context is built from, rebuilding
+        the context when a user's digest is replaced, and logging how
+        many verifications weren't logged every minute.
+
+        """
+        _getContextFactories(self.store).add(self)
+        self._calls = []
+        for f, interval in [(self.checkFiles, self.checkInterval),
+                            (self._log.flush, self._log.interval)]:
+            call = task.LoopingCall(f)
+            call.clock = self.reactor
+            call.start(interval, now=False)
+            self._calls.append(call)
+
+
+    def stop(self):
+        _getContextFactories(self.store).discard(self)
+        calls, self._calls = self._calls, []
+        for call in calls:
+            call.stop()
 
 
     def getContext(self):
+        """Gets a context.
+
+        If there is no context yet, or its session ticket keys are due
+        to be rotated, a new one is built.
+
+        """
+        if self._context is None or self._ticketKeysExpired():
+            self._modificationTimes = self._getModificationTimes()
+            self._context = self._makeContext()
+            self._builtAt = self._now()
+        return self._context
+
+
+    def checkFiles(self):
+        """Reloads if the files the current context was built from have
+        been modified since.
+
+        """
+        if self._context is None:
+            return
+
+        try:
+            modificationTimes = self._getModificationTimes()
+        except OSError:
+            log.err(None, "Couldn't check the TLS files for modifications")
+            return
+
+        if modificationTimes != self._modificationTimes:
+            self.reload()
+
+
+    def _ticketKeysExpired(self):
+        """Checks if the current context's session ticket keys should be
+        rotated.
+
+        """
+        if self.ticketKeyLifetime is None:
+            return False
+        return self._now() - self._builtAt >= self.ticketKeyLifetime
+
+
+    def reload(self):
+        """Forgets the current context, so that the next call to
+        ``getContext`` builds a new one.
+
+        """
+        self._context = None
+
+
+    def _getModificationTimes(self):
+        """Gets the modification times of the files the context is built
+        from.
+
+        """
+        paths = self.certificatePath, self.keyPath, self.dhParametersPath
+        return [os.stat(path).st_mtime for path in paths]
+
+
+    def _makeContext(self):
         """Creates a context.
 
         This will make contexts using ``SSLv23_METHOD``. This is
@@ -54,54 +290,218 @@ class _TOFUContextFactory(object):
         ``TLSv1_METHOD`` mean "only use TLSv1.0" -- specifically, it
         disables TLSv1.2. Since we don't want to use SSLv2 and v3, we
         set OP_NO_SSLv2|OP_NO_SSLv3. Additionally, we set
-        OP_SINGLE_DH_USE.
+        OP_SINGLE_DH_USE and OP_SINGLE_ECDH_USE.
+
+        The server's ciphersuite preference is used, so that clients
+        supporting ECDHE use it instead of DHE.
+
+        Since we verify peer certificates, OpenSSL will only resume
+        sessions if the context has a session id context.
 
         """
         ctx = Context(SSLv23_METHOD)
-        ctx.use_certificate_file("cert.pem")
-        ctx.use_privatekey_file("key.pem")
-        ctx.load_tmp_dh("dhparam.pem")
-        ctx.set_options(OP_SINGLE_DH_USE|OP_NO_SSLv2|OP_NO_SSLv3)
+        ctx.use_certificate_file(self.certificatePath)
+        ctx.use_privatekey_file(self.keyPath)
+        ctx.load_tmp_dh(self.dhParametersPath)
+        ctx.set_tmp_ecdh(get_elliptic_curve(self.ellipticCurve))
+        ctx.set_options(OP_SINGLE_DH_USE|OP_SINGLE_ECDH_USE
+                        |OP_CIPHER_SERVER_PREFERENCE
+                        |OP_NO_SSLv2|OP_NO_SSLv3)
         ctx.set_verify(VERIFY_PEER, self._verify)
+        ctx.set_session_id(b"merlyn")
+        ctx.set_session_cache_mode(SESS_CACHE_SERVER)
+        ctx.set_timeout(self.sessionTimeout)
         return ctx
 
 
     def _verify(self, connection, cert, errorNumber, errorDepth, returnCode):
         """Verify a certificate.
 
+        OpenSSL may call this several times per handshake: for a
+        self-signed certificate, first with an error, and then again
+        once the certificate is otherwise fine. The certificate is
+        checked every time, but each handshake is only recorded once,
+        when verification is over (because the certificate was
+        rejected, or OpenSSL found it fine). How long the checks took
+        is recorded in ``metrics.verifications``, along with the
+        outcome of the first check, and whether the user came from the
+        cache of verified users. The outcome is logged, unless too
+        many of the same outcome were logged recently (see
+        ``_RateLimitedLog``).
+
         """
+        start = self._now()
+        outcome, verified, fields = self._checkCertificate(cert)
+        elapsed = self._now() - start
+
+        earlier = self._pending.pop(connection, None)
+        if earlier is not None:
+            earlierOutcome, earlierFields, earlierElapsed = earlier
+            if verified:
+                outcome, fields = earlierOutcome, earlierFields
+            elapsed += earlierElapsed
+
+        if verified and not (errorDepth == 0 and returnCode):
+            self._pending[connection] = outcome, fields, elapsed
+            return verified
+
+        cached = "true" if fields.get("cached") else "false"
+        metrics.verifications.observe(elapsed, outcome, cached)
+        self._log.msg(outcome, format=_verifyFormats[outcome], **fields)
+        return verified
+
+
+    def _checkCertificate(self, cert):
+        """Checks a certificate.
+
+        Returns the outcome, whether the certificate was verified, and
+        the fields of the log event for it.
+
+        Certificates that were verified before are found in the cache
+        of verified users, without querying the store.
+
+        """
+        digest = cert.digest("sha512")
+        verifiedUsers = getVerifiedUsers(self.store)
+        user = verifiedUsers.get(digest)
+        if user is not None:
+            return "success", True, {"email": user.email, "cached": True}
+
         try:
             user = userForCert(self.store, cert)
         except ItemNotFound:
-            log.msg("Connection attempt by {0!r}, but no user with that "
-                    "e-mail address was found, cert digest was {1}"
-                    .format(emailForCert(cert), cert.digest("sha512")))
-            return False
+            fields = {"email": emailForCert(cert), "digest": digest}
+            return "unknown_email", False, fields
 
-        digest = cert.digest("sha512")
-        if user.digest is None:
-            user.digest = digest
-            log.msg("First connection by {0!r}, stored digest: {1}"
-                    .format(user.email, digest))
-            return True
+        fields = {"email": user.email, "digest": digest}
+        if user.digest is None and _pinDigest(user, digest) == digest:
+            verifiedUsers[digest] = user
+            return "first_connection", True, fields
         elif user.digest == digest:
-            log.msg("Successful connection by {0!r}".format(user.email))
-            return True
+            verifiedUsers[digest] = user
+            return "success", True, fields
         else:
-            log.msg("Failed connection by {0!r}; cert digest was {1}, "
-                    "expecting {2}".format(user.email, digest, user.digest))
-            return False
+            fields["expected"] = user.digest
+            return "bad_digest", False, fields
+
+
+
+_verifyFormats = {
+    "success": "Successful connection by %(email)r",
+    "first_connection": "First connection by %(email)r, stored digest: "
+                        "%(digest)s",
+    "unknown_email": "Connection attempt by %(email)r, but no user with "
+                     "that e-mail address was found, cert digest was "
+                     "%(digest)s",
+    "bad_digest": "Failed connection by %(email)r; cert digest was "
+                  "%(digest)s, expecting %(expected)s"
+}
+
+
+
+class _RateLimitedLog(object):
+    """Logs at most ``limit`` events of each kind every ``interval``
+    seconds.
+
+    Events are logged with their format and fields (see
+    ``log.msg``), so they're only formatted by observers that want
+    text. Events beyond the limit are only counted: once the interval
+    is over, the next event logs how many of each kind were
+    suppressed. Call ``flush`` every interval (for example, from a
+    ``LoopingCall``) to have that logged even if no event follows.
+
+    """
+    def __init__(self, limit=100, interval=60.0, now=time.time):
+        self.limit = limit
+        self.interval = interval
+        self._now = now
+        self._windowStart = None
+        self._counts = {}
+
+
+    def msg(self, kind, **fields):
+        """Logs an event of the given kind, unless there have been too many
+        of them in the current interval.
+
+        """
+        now = self._now()
+        start = self._windowStart
+        if start is None or now - start >= self.interval:
+            self._summarize()
+            self._windowStart = now
+
+        count = self._counts[kind] = self._counts.get(kind, 0) + 1
+        if count <= self.limit:
+            log.msg(kind=kind, **fields)
+
+
+    def flush(self):
+        """Ends the current interval: logs how many events of each kind were
+        suppressed, and starts counting again.
+
+        """
+        self._summarize()
+        self._windowStart = self._now()
+
+
+    def _summarize(self):
+        """Logs how many events of each kind were suppressed in the current
+        interval, and starts counting again.
+
+        """
+        for kind, count in sorted(self._counts.iteritems()):
+            if count > self.limit:
+                log.msg(format="Suppressed %(suppressed)d %(kind)s log events "
+                        "in the last %(interval)s seconds",
+                        kind=kind, suppressed=count - self.limit,
+                        interval=self.interval)
+        self._counts = {}
 
 
 
 class ContextFactory(object):
-    def __init__(self, store):
-        self._wrapped = _TOFUContextFactory(store)
+    """A context factory that verifies client certificates, and only
+    allows secure ciphersuites.
+
+    Takes the same arguments as ``_TOFUContextFactory``.
+
+    """
+    def __init__(self, store, **kwargs):
+        self._wrapped = _TOFUContextFactory(store, **kwargs)
         self._wrapper = SecureCiphersContextFactory(self._wrapped)
+        self._context = None
 
 
     def getContext(self):
-        return self._wrapper.getContext()
+        """Gets a context.
+
+        Only restricts the ciphersuites of a context once, when that
+        context is new.
+
+        """
+        if self._wrapped.getContext() is not self._context:
+            self._context = self._wrapper.getContext()
+        return self._context
+
+
+    def reload(self):
+        """Builds a new context the next time one is needed, for example
+        after the certificate has been replaced.
+
+        """
+        self._wrapped.reload()
+
+
+    def start(self):
+        """Starts checking the files the context is built from (see
+        ``_TOFUContextFactory``).
+
+        """
+        self._wrapped.start()
+
+
+    def stop(self):
+        self._wrapped.stop()
 
 
 
@@ -112,6 +512,27 @@ def emailForCert(cert):
     return cert.get_subject().emailAddress.encode("utf-8")
 
 
+def _pinDigest(user, digest):
+    """Stores the given digest as the user's, unless the user already has
+    one. Returns the user's digest.
+
+    The user's digest is read again in a transaction, since another
+    process using the same store may have stored one in the meantime.
+
+    """
+    def pin():
+        query = user.store.query(User, User.storeID == user.storeID)
+        stored, = query.getColumn("digest")
+        if stored is None:
+            user.digest = stored = digest
+        elif user.digest != stored:
+            user.digest = stored
+        return stored
+
+    return user.store.transact(pin)
+
+
+
 def userForCert(store, cert):
     """Gets the user for the given certificate.
 
@@ -0,0 +1,15 @@
+"""Splitting lookups into batches that fit in one query.
+
+"""
+maxVariables = 999
+
+
+def inBatches(items, size=maxVariables):
+    """Splits the given items into lists of at most ``size`` items, for
+    example to look them up with ``oneOf`` without exceeding the number
+    of variables SQLite allows.
+
+    """
+    items = list(items)
+    for start in xrange(0, len(items), size):
+        yield items[start:start + size]
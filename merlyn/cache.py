@@ -0,0 +1,105 @@
+"""Bounded in-memory caches.
+
+"""
+from collections import OrderedDict
+
+
+def forStore(store, name, factory):
+    """Gets the object of the given name that is kept for a store, making
+    it with ``factory(store)`` first if there isn't one yet.
+
+    The object is kept as an attribute of the store, so that it lives
+    as long as the store does, instead of as long as the process.
+
+    """
+    attr = "_merlyn_" + name
+    value = vars(store).get(attr)
+    if value is None:
+        value = factory(store)
+        setattr(store, attr, value)
+    return value
+
+
+
+class LRUCache(object):
+    """A mapping with a maximum size, which forgets the least recently
+    used entries first.
+
+    Keeps track of how many lookups hit or missed, in the ``hits``
+    and ``misses`` attributes.
+
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self._entries = OrderedDict()
+        self.hits = self.misses = 0
+
+
+    def get(self, key, default=None):
+        """Gets the value for the given key, or the default if there is no
+        such key.
+
+        The key becomes the most recently used one.
+
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+
+    def __setitem__(self, key, value):
+        """Sets the value for the given key, forgetting the least recently
+        used entry if the cache is full.
+
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self.maxSize:
+            self._entries.popitem(last=False)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def items(self):
+        """Gets a list of the cached ``(key, value)`` pairs, from least to
+        most recently used, without using them.
+
+        """
+        return self._entries.items()
+
+
+    def discard(self, key):
+        """Forgets the given key, if it is cached.
+
+        """
+        self._entries.pop(key, None)
+
+
+    def discardValue(self, value):
+        """Forgets all keys with the given value.
+
+        This has to look at every entry, so it's only suitable for
+        infrequent invalidations.
+
+        """
+        for key in [k for k, v in self._entries.iteritems() if v is value]:
+            del self._entries[key]
+
+
+    def clear(self):
+        """Forgets everything.
+
+        """
+        self._entries.clear()
@@ -2,20 +2,120 @@
 
 """
 import os
+from bisect import bisect_right
+from collections import namedtuple
+from heapq import merge
 
 from axiom import attributes, item, queryutil as q
-from axiom.errors import ItemNotFound
+from axiom.upgrade import registerAttributeCopyingUpgrader
 from clarent import exercise as ce
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from merlyn.batching import inBatches, maxVariables
+from merlyn.cache import LRUCache, forStore
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
 from twisted.protocols import amp
+from twisted.python import log
+from twisted.python.failure import Failure
+
+
+class _VersionCounter(item.Item):
+    """The last version given to a change in this store.
+
+    There is (at most) one of these per store. See ``_nextVersion``.
+
+    """
+    last = attributes.integer(allowNone=False, default=0)
+
+
+
+def _latestVersion(store):
+    """Gets the last version given to a change in this store.
+
+    This is read from the store, not from the (possibly cached)
+    counter item, since another process sharing the store may have
+    given out versions since.
+
+    """
+    versions = store.query(_VersionCounter).getColumn("last", raw=True)
+    return max(list(versions) or [0])
+
+
+
+def _nextVersion(store):
+    """Gives out the next version for a change in this store.
+
+    Must be called in a transaction, so that processes sharing the
+    store never give out the same version, and a change is committed
+    together with its version.
+
+    """
+    counter = store.findOrCreate(_VersionCounter)
+    counter.last = _latestVersion(store) + 1
+    return counter.last
+
+
+
+def _assignVersion(versioned):
+    """Gives a versioned item a new version.
+
+    This should be called in the transaction that makes the change, so
+    that the change is committed together with its version. Outside of
+    a transaction, the change has already been committed, and the
+    version is given in a transaction of its own.
+
+    """
+    store = versioned.store
+    if store.autocommit:
+        store.transact(_assignVersion, versioned)
+    else:
+        versioned.version = _nextVersion(store)
+
 
 
 class Exercise(item.Item):
     """An exercise.
 
+    Every exercise has a version, which is a number that is shared
+    with solutions (see ``_Solution``), and goes up every time an
+    exercise is added or changed, or a solution is recorded. Clients
+    use it to ask for the changes since they last saw the exercises
+    (see ``GetChanges``).
+
     """
+    schemaVersion = 2
+
     identifier = attributes.bytes(allowNone=False)
     title = attributes.text(allowNone=False)
     description = attributes.text(allowNone=False)
+    version = attributes.integer(allowNone=False, default=0, indexed=True)
+
+    _versionedAttributes = frozenset(["identifier", "title", "description"])
+
+    def __setattr__(self, name, value):
+        """Sets an attribute. If that changes an exercise that's already
+        in a store, the exercise gets a new version, in the same
+        transaction.
+
+        """
+        if (name in self._versionedAttributes
+            and self.store is not None
+            and getattr(self, name) != value):
+            self.store.transact(self._change, name, value)
+        else:
+            item.Item.__setattr__(self, name, value)
+
+
+    def _change(self, name, value):
+        item.Item.__setattr__(self, name, value)
+        _assignVersion(self)
+
+
+    def stored(self):
+        _assignVersion(self)
+
 
     def solvedBy(self, user):
         """Stores that this user has just solved this exercise.
@@ -23,8 +123,11 @@ class Exercise(item.Item):
         You probably want to notify the user when this happens. For
         that, see ``solveAndNotify``.
 
+        The solution is recorded in a transaction, so that it's
+        committed together with its version.
+
         """
-        _Solution(store=self.store, who=user, what=self)
+        self.store.transact(_Solution, store=self.store, who=user, what=self)
 
 
     def wasSolvedBy(self, user):
@@ -37,13 +140,496 @@ class Exercise(item.Item):
         return self.store.query(_Solution, condition, limit=1).count() == 1
 
 
+    def committed(self):
+        """Invalidates the catalog of this exercise's store, since this
+        exercise was just added, changed or deleted.
+
+        """
+        store = self.store
+        item.Item.committed(self)
+        getCatalog(store).invalidate()
+        notifyChanged(store)
+
+
+
+class Catalog(object):
+    """An in-memory index of all the exercises in a store.
+
+    Exercises are loaded from the store once, and then served from
+    memory until the catalog is invalidated. Exercises invalidate the
+    catalog themselves when they're added, changed or deleted in this
+    process. If exercises are changed some other way, for example by
+    another process, call ``invalidate``.
+
+    Use ``getCatalog`` to get the catalog for a store.
+
+    """
+    def __init__(self, store):
+        self.store = store
+        self._exercises = None
+        self._byIdentifier = None
+        self._storeIDs = None
+
+
+    def _load(self):
+        """Loads the exercises from the store, if they haven't been loaded
+        yet.
+
+        """
+        if self._exercises is None:
+            query = self.store.query(Exercise,
+                                     sort=Exercise.storeID.ascending)
+            self._exercises = list(query)
+            self._byIdentifier = dict((e.identifier, e)
+                                      for e in self._exercises)
+            self._storeIDs = [e.storeID for e in self._exercises]
+
+
+    def __iter__(self):
+        """Iterates over all exercises, in the order they were added.
+
+        """
+        self._load()
+        return iter(self._exercises)
+
+
+    def after(self, storeID):
+        """Iterates over the exercises added after the one with the given
+        store ID, in the order they were added.
+
+        The exercise with that store ID doesn't have to exist anymore.
+
+        """
+        self._load()
+        start = bisect_right(self._storeIDs, storeID)
+        return (self._exercises[i]
+                for i in xrange(start, len(self._exercises)))
+
+
+    def __len__(self):
+        self._load()
+        return len(self._exercises)
+
+
+    def __getitem__(self, identifier):
+        """Gets the exercise with the given identifier.
+
+        Raises ``KeyError`` if there is no such exercise.
+
+        """
+        self._load()
+        return self._byIdentifier[identifier]
+
+
+    def invalidate(self):
+        """Forgets all exercises, so that they will be loaded from the store
+        again when they are next needed.
+
+        """
+        self._exercises = self._byIdentifier = self._storeIDs = None
+
+
+
+def getCatalog(store):
+    """Gets the catalog of exercises for the given store.
+
+    There is one catalog per store, shared by everything in this
+    process. It is kept on the store (see ``cache.forStore``), so it
+    lives as long as the store does.
+
+    """
+    return forStore(store, "catalog", Catalog)
+
+
 
 class _Solution(item.Item):
     """A log of an exercise being solved.
 
+    Solutions are indexed by who solved what, so that looking up the
+    solutions for a particular user (and exercise) doesn't scan the
+    entire log, and by who solved them when (by version; see
+    ``Exercise``), so that a user's new solutions can be found.
+
     """
+    schemaVersion = 3
+
     who = attributes.reference(allowNone=False)
     what = attributes.reference(allowNone=False)
+    version = attributes.integer(allowNone=False, default=0)
+    attributes.compoundIndex(who, what)
+    attributes.compoundIndex(who, version)
+
+    def stored(self):
+        _assignVersion(self)
+
+
+    def committed(self):
+        """Notifies the change listeners of this solution's store, since
+        this solution was just recorded.
+
+        """
+        store = self.store
+        item.Item.committed(self)
+        notifyChanged(store)
+
+
+
+item.declareLegacyItem(Exercise.typeName, 1, {
+    "identifier": attributes.bytes(allowNone=False),
+    "title": attributes.text(allowNone=False),
+    "description": attributes.text(allowNone=False)
+})
+registerAttributeCopyingUpgrader(Exercise, 1, 2, _assignVersion)
+
+
+
+item.declareLegacyItem(_Solution.typeName, 1, {
+    "who": attributes.reference(allowNone=False),
+    "what": attributes.reference(allowNone=False)
+})
+registerAttributeCopyingUpgrader(_Solution, 1, 2)
+
+
+
+item.declareLegacyItem(_Solution.typeName, 2, {
+    "who": attributes.reference(allowNone=False),
+    "what": attributes.reference(allowNone=False)
+})
+registerAttributeCopyingUpgrader(_Solution, 2, 3, _assignVersion)
+
+
+
+def _getChangeListeners(store):
+    return forStore(store, "changeListeners", lambda store: [])
+
+
+
+def addChangeListener(store, listener):
+    """Adds a function to be called (without arguments) when exercises
+    or solutions in the given store may have changed.
+
+    Listeners are called every time an exercise or a solution is
+    committed in this process, so they should be cheap, and put off
+    any real work. Changes made by other processes are only noticed
+    if something calls ``notifyChanged`` for them (see
+    ``workers.ChangeWatcher``).
+
+    """
+    _getChangeListeners(store).append(listener)
+
+
+
+def removeChangeListener(store, listener):
+    """Removes a function added with ``addChangeListener``.
+
+    """
+    _getChangeListeners(store).remove(listener)
+
+
+
+def notifyChanged(store):
+    """Calls the change listeners of the given store.
+
+    """
+    for listener in list(_getChangeListeners(store)):
+        listener()
+
+
+
+def solvedExerciseIDs(user):
+    """Gets the store IDs of all exercises solved by the user.
+
+    This takes a single query, regardless of the number of exercises.
+
+    """
+    solutions = user.store.query(_Solution, _Solution.who == user)
+    return set(solutions.getColumn("what", raw=True))
+
+
+
+def _solvedExerciseIDsByUserID(store, userID):
+    """Gets the store IDs of all exercises solved by the user with the
+    given store ID.
+
+    Used from a ``storethread.StoreThread``, which has its own store.
+
+    """
+    return solvedExerciseIDs(store.getItemByID(userID))
+
+
+
+_ExerciseSummary = namedtuple("_ExerciseSummary", "storeID identifier title")
+
+
+def _summarize(exercise):
+    return _ExerciseSummary(exercise.storeID, exercise.identifier,
+                            exercise.title)
+
+
+
+def _changesSince(store, since, userIDs):
+    """Gets the changes after the given version, up to the latest one:
+    exercises that were added or changed, and solutions by the users
+    with the given store IDs.
+
+    Returns the latest version, the exercise changes as ``(version,
+    exercise)`` pairs, and the solutions as ``(version, userID,
+    exercise)`` tuples, both in order of version. Exercises are
+    ``_ExerciseSummary``s, so that this can be used from a
+    ``storethread.StoreThread``, which has its own store.
+
+    Solutions are read directly, with the users' store IDs, as many
+    at a time as SQLite allows in one query.
+
+    """
+    latest = _latestVersion(store)
+    if latest <= since:
+        return latest, [], []
+
+    query = store.query(Exercise, q.AND(Exercise.version > since,
+                                        Exercise.version <= latest),
+                        sort=Exercise.version.ascending)
+    exercises = [(e.version, _summarize(e)) for e in query]
+
+    sql = ("SELECT {0}, {1}, {2} FROM {3} WHERE {0} > ? AND {0} <= ? "
+           "AND {1} IN ({{0}})").format(
+        _Solution.version.getShortColumnName(store),
+        _Solution.who.getShortColumnName(store),
+        _Solution.what.getShortColumnName(store),
+        store.getTableName(_Solution))
+    rows = []
+    for batch in inBatches(userIDs, maxVariables - 2):
+        query = sql.format(", ".join("?" * len(batch)))
+        rows.extend(store.querySQL(query, [since, latest] + batch))
+
+    summaries = {}
+    solutions = []
+    for version, userID, exerciseID in sorted(rows):
+        summary = summaries.get(exerciseID)
+        if summary is None:
+            summary = summaries[exerciseID] = _summarize(
+                store.getItemByID(exerciseID))
+        solutions.append((version, userID, summary))
+
+    return latest, exercises, solutions
+
+
+
+def _changesPage(store, userID, since, limit):
+    """Gets the changes since the given version for a page of at most
+    ``limit`` changes, for the user with the given store ID.
+
+    The latest version is read first, and only changes up to it are
+    looked at. Everything with an earlier version was committed
+    together with its version, so nothing the client hasn't seen yet
+    can be skipped, even while changes are being made.
+
+    A page can't have more than ``limit`` exercises, so no more than
+    one change more than that is read of each kind. Since several
+    changes (like repeated solutions) can be about the same exercise,
+    that may not fill a page. If there were more changes of a kind,
+    the changes only go up to the last version read of that kind, so
+    that none are skipped; the rest are left for the next page.
+
+    Returns the latest version, the version the changes go up to, and
+    the changed exercises and the user's solutions as
+    ``(version, exercise)`` pairs in order of version. Exercises are
+    ``_ExerciseSummary``s, so that this can be used from a
+    ``storethread.StoreThread``, which has its own store.
+
+    """
+    latest = _latestVersion(store)
+    between = lambda attr: q.AND(attr > since, attr <= latest)
+
+    exercises = [(e.version, _summarize(e)) for e in store.query(
+        Exercise, between(Exercise.version),
+        sort=Exercise.version.ascending, limit=limit + 1)]
+    solutions = [(s.version, _summarize(s.what)) for s in store.query(
+        _Solution, q.AND(_Solution.who == store.getItemByID(userID),
+                         between(_Solution.version)),
+        sort=_Solution.version.ascending, limit=limit + 1)]
+
+    upTo = latest
+    for changes in exercises, solutions:
+        if len(changes) > limit:
+            upTo = min(upTo, changes[-1][0])
+
+    exercises, solutions = [[(v, e) for v, e in changes if v <= upTo]
+                            for changes in (exercises, solutions)]
+    return latest, upTo, exercises, solutions
+
+
+
+class GetExercisesPage(amp.Command):
+    """Gets the identifiers and titles of a page of exercises.
+
+    This is like ``GetExercises``, except that large catalogs are sent
+    over several responses, instead of one that may be too large for
+    AMP. To get the next page, pass the ``next`` value of a response
+    as ``after``. On the last page, ``next`` is absent.
+
+    Pages have at most ``limit`` exercises, and never more than
+    ``maxPageSize``. Limits below 1 are taken to be 1.
+
+    """
+    arguments = [
+        (b"solved", amp.Boolean()),
+        (b"after", amp.Integer(optional=True)),
+        (b"limit", amp.Integer(optional=True))
+    ]
+    response = [
+        (b"exercises", amp.AmpList([
+            (b"identifier", amp.String()),
+            (b"title", amp.Unicode())
+        ])),
+        (b"next", amp.Integer(optional=True))
+    ]
+
+
+
+class GetChanges(amp.Command):
+    """Gets the exercises that were added or changed, or that the user
+    solved, since the given version (see ``Exercise``).
+
+    This lets returning clients catch up, instead of getting all
+    exercises again with ``GetExercises``. The response has the
+    version the client is now up to date with, to be passed as
+    ``since`` the next time. Clients that haven't seen any exercises
+    yet can pass 0.
+
+    Like ``GetExercisesPage``, the changes are sent a page at a time,
+    of at most ``limit`` exercises (at least 1, at most
+    ``maxPageSize``). If ``more`` is true, ask again with the returned
+    version to get the rest.
+
+    Deleted exercises are not reported.
+
+    """
+    arguments = [
+        (b"since", amp.Integer()),
+        (b"limit", amp.Integer(optional=True))
+    ]
+    response = [
+        (b"exercises", amp.AmpList([
+            (b"identifier", amp.String()),
+            (b"title", amp.Unicode()),
+            (b"solved", amp.Boolean())
+        ])),
+        (b"version", amp.Integer()),
+        (b"more", amp.Boolean())
+    ]
+
+
+
+class Subscribe(amp.Command):
+    """Subscribes this connection to changes: from now on, the server
+    sends ``NotifyChanged`` when exercises are added or changed, or
+    when the user solves an exercise, from any connection.
+
+    The response has the latest version (see ``Exercise``). Changes up
+    to that version aren't pushed, so clients that have been away
+    should catch up with ``GetChanges`` until they're at that version.
+
+    """
+    response = [(b"version", amp.Integer())]
+
+
+
+class Unsubscribe(amp.Command):
+    """Stops sending changes to this connection.
+
+    """
+
+
+
+class NotifyChanged(amp.Command):
+    """Sent by the server to subscribed connections: exercises were
+    added or changed, or solved by the user.
+
+    The exercises are like those of ``GetChanges``, and the version is
+    the one to pass to ``GetChanges`` the next time. Large changes are
+    sent in several of these.
+
+    """
+    arguments = [
+        (b"exercises", amp.AmpList([
+            (b"identifier", amp.String()),
+            (b"title", amp.Unicode()),
+            (b"solved", amp.Boolean())
+        ])),
+        (b"version", amp.Integer())
+    ]
+    requiresAnswer = False
+
+
+
+maxPageSize = 100
+maxPageBytes = 32 * 1024
+
+
+def _pageSize(limit):
+    """Gets the number of exercises a page may have, given the limit a
+    client asked for: ``maxPageSize`` if there's no limit, and
+    otherwise the limit, but at least 1 and at most ``maxPageSize``.
+
+    """
+    if limit is None:
+        return maxPageSize
+    return max(1, min(limit, maxPageSize))
+
+
+def _encodedSize(entry):
+    """Gets the size of an exercise entry in an ``AmpList``, which is one
+    AMP box.
+
+    Every key and value has a two byte length prefix, and a box ends
+    with two zero bytes.
+
+    """
+    size = 2
+    for key, value in entry.iteritems():
+        if isinstance(value, unicode):
+            value = value.encode("utf-8")
+        elif isinstance(value, bool):
+            value = str(value)
+        size += 2 + len(key) + 2 + len(value)
+    return size
+
+
+
+def _pages(changes, limit):
+    """Puts changes, as ``(version, exercise, solved)`` tuples in order of
+    version, on pages of exercise entries.
+
+    Yields every page, with the version of the last change on it.
+    Pages are full when they have ``limit`` exercises, or when another
+    one could make them too big for AMP. An exercise that has more
+    than one change on a page is only on it once, as solved if any of
+    them say so.
+
+    """
+    page, byStoreID, pageBytes, last = [], {}, 0, None
+    for version, exercise, solved in changes:
+        entry = byStoreID.get(exercise.storeID)
+        if entry is not None:
+            entry[b"solved"] = entry[b"solved"] or solved
+        else:
+            entry = {b"identifier": exercise.identifier,
+                     b"title": exercise.title,
+                     b"solved": solved}
+            entryBytes = _encodedSize(entry)
+            if page and (len(page) == limit
+                         or pageBytes + entryBytes > maxPageBytes):
+                yield page, last
+                page, byStoreID, pageBytes = [], {}, 0
+
+            byStoreID[exercise.storeID] = entry
+            page.append(entry)
+            pageBytes += entryBytes
+        last = version
+
+    if page:
+        yield page, last
 
 
 
@@ -51,31 +637,235 @@ def solveAndNotify(proto, exercise):
     """The user at the given AMP protocol has solved the given exercise.
 
     This will log the solution and notify the user.
+
+    If the protocol has a write queue, the solution is committed
+    together with other writes, and the user is only notified once it
+    has been.
+
+    Returns a Deferred that fires with ``True`` when the user has been
+    notified, or with ``False`` if the solution couldn't be recorded.
+    That failure is logged; callers that can tell the client about it
+    should check the result.
+
     """
-    exercise.solvedBy(proto.user)
-    proto.callRemote(ce.NotifySolved,
-                     identifier=exercise.identifier,
-                     title=exercise.title)
+    if proto.writeQueue is None:
+        d = maybeDeferred(exercise.solvedBy, proto.user)
+    else:
+        d = proto.writeQueue.write(exercise.solvedBy, proto.user)
+
+    def notify(_result):
+        proto.exerciseSolved(exercise)
+        proto.callRemote(ce.NotifySolved,
+                         identifier=exercise.identifier,
+                         title=exercise.title)
+        return True
+
+    def failed(failure):
+        log.err(failure, "Couldn't record a solution")
+        return False
+
+    return d.addCallbacks(notify, failed)
 
 
 
 class Locator(amp.CommandLocator):
+    """A command locator for getting exercises and their details.
+
+    Expects ``store`` and ``user`` attributes, like the ones provided
+    by ``auth.UserMixin``. If the ``storeThread`` attribute is set to
+    a ``storethread.StoreThread``, the user's solved exercises and
+    changes (see ``GetChanges``) are fetched in that thread instead of
+    blocking the reactor, and the responders return Deferreds until
+    they have been fetched.
+
+    The ``writeQueue`` attribute, if set, is the
+    ``writequeue.WriteQueue`` used by ``solveAndNotify``.
+
+    """
+    storeThread = None
+    writeQueue = None
+
+    _solvedIDs = None
+    _fetchingSolvedIDs = None
+    _solvedIDsWaiters = None
+
+    @property
+    def solvedIDs(self):
+        """The store IDs of the exercises solved by the current user.
+
+        This property is cached in the ``_solvedIDs`` attribute. The
+        cache is kept up to date by ``solveAndNotify``. If solutions
+        are recorded some other way (for example, from the manhole, or
+        by another process), call ``invalidateSolved``.
+
+        """
+        if self._solvedIDs is None:
+            self._solvedIDs = solvedExerciseIDs(self.user)
+        return self._solvedIDs
+
+
+    def exerciseSolved(self, exercise):
+        """Notes that the current user has just solved the given exercise.
+
+        If the solved exercises haven't been fetched yet, this does
+        nothing: they'll include this one when they are. If they are
+        being fetched in the store thread, this one is added when that
+        is done, in case the solution was recorded too late for the
+        query to find it.
+
+        """
+        if self._solvedIDs is not None:
+            self._solvedIDs.add(exercise.storeID)
+        elif self._fetchingSolvedIDs is not None:
+            self._fetchingSolvedIDs.add(exercise.storeID)
+
+
+    def invalidateSolved(self):
+        """Forgets the cached solved exercises, so that they will be fetched
+        from the store again when they are next needed.
+
+        """
+        self._solvedIDs = None
+
+
+    def _withSolvedIDs(self, f):
+        """Calls ``f`` once the solved exercises have been cached.
+
+        If they are cached already, or there's no store thread to fetch
+        them in, ``f`` is called right away, and its result is
+        returned. Otherwise, they are fetched in the store thread (at
+        most once at a time), and a Deferred that fires with the
+        result of ``f`` is returned.
+
+        """
+        if self._solvedIDs is not None or self.storeThread is None:
+            return f()
+
+        if self._solvedIDsWaiters is None:
+            self._fetchSolvedIDs()
+
+        d = Deferred()
+        self._solvedIDsWaiters.append(d)
+        return d.addCallback(lambda _result: f())
+
+
+    def _fetchSolvedIDs(self):
+        """Fetches the solved exercises in the store thread, and notifies
+        everything waiting for them when that's done.
+
+        """
+        solvedDuringFetch = self._fetchingSolvedIDs = set()
+        self._solvedIDsWaiters = []
+        d = self.storeThread.run(_solvedExerciseIDsByUserID, self.user.storeID)
+
+        @d.addBoth
+        def notify(result):
+            waiters, self._solvedIDsWaiters = self._solvedIDsWaiters, None
+            self._fetchingSolvedIDs = None
+
+            if isinstance(result, Failure):
+                for waiter in waiters:
+                    waiter.errback(result)
+            else:
+                self._solvedIDs = result | solvedDuringFetch
+                for waiter in waiters:
+                    waiter.callback(None)
+
+
     @ce.GetExercises.responder
     def getExercises(self, solved):
+        return self._withSolvedIDs(lambda: self._getExercisesResponse(solved))
+
+
+    def _getExercisesResponse(self, solved):
         return {"exercises": [{b"title": e.title, b"identifier": e.identifier}
                               for e in self._getExercises(solved)]}
 
 
-    def _getExercises(self, yieldSolved):
-        for ex in self.store.query(Exercise):
-            if ex.wasSolvedBy(self.user):
-                if yieldSolved:
-                    yield ex
-            else:
-                if not yieldSolved:
-                    yield ex
+    def _getExercises(self, yieldSolved, after=0):
+        """Yields the exercises that the current user has (or hasn't)
+        solved, that were added after the exercise with the given store
+        ID.
+
+        This uses the user's (cached) solved exercises, instead of
+        asking every exercise if it was solved.
+
+        """
+        solved = self.solvedIDs
+        for ex in getCatalog(self.store).after(after):
+            if (ex.storeID in solved) == yieldSolved:
+                yield ex
+
+
+    @GetExercisesPage.responder
+    def getExercisesPage(self, solved, after=None, limit=None):
+        return self._withSolvedIDs(
+            lambda: self._getExercisesPage(solved, after, limit))
+
+
+    def _getExercisesPage(self, solved, after, limit):
+        """Gets a page of exercises.
+
+        Exercises are taken from ``_getExercises`` until the page is
+        full, either because it has ``limit`` exercises, or because
+        another one could make the response too big for AMP. Only one
+        more exercise than the page has is looked at, to know if there
+        are more.
+
+        """
+        limit = _pageSize(limit)
+        exercises = self._getExercises(solved, after or 0)
+        page, pageBytes, last = [], 0, None
+        for ex in exercises:
+            entry = {b"title": ex.title, b"identifier": ex.identifier}
+            entryBytes = _encodedSize(entry)
+            if page and (len(page) == limit
+                         or pageBytes + entryBytes > maxPageBytes):
+                return {"exercises": page, "next": last}
+            page.append(entry)
+            pageBytes += entryBytes
+            last = ex.storeID
+        return {"exercises": page, "next": None}
+
+
+    @GetChanges.responder
+    def getChanges(self, since, limit=None):
+        limit = _pageSize(limit)
+        return self._inStoreThread(
+            lambda changes: self._withSolvedIDs(
+                lambda: self._getChanges(since, limit, changes)),
+            _changesPage, self.user.storeID, since, limit)
 
 
+    def _getChanges(self, since, limit, changes):
+        """Gets a page of changes, from what ``_changesPage`` found.
+
+        """
+        latest, upTo, exercises, solutions = changes
+        solvedIDs = self.solvedIDs
+        changes = merge(((v, e, e.storeID in solvedIDs) for v, e in exercises),
+                        ((v, e, True) for v, e in solutions))
+        pages = _pages(changes, limit)
+        page, last = next(pages, ([], since))
+        if next(pages, None) is not None:
+            return {"exercises": page, "version": last, "more": True}
+        return {"exercises": page, "version": upTo, "more": upTo < latest}
+
+
+    def _inStoreThread(self, callback, f, *args):
+        """Calls ``f`` with a store and the given arguments, and then
+        ``callback`` with its result.
+
+        If there's a store thread, ``f`` is called in it, and a Deferred
+        that fires with the result of ``callback`` is returned.
+        Otherwise, ``f`` is called with this locator's store right
+        away, and the result of ``callback`` is returned.
+
+        """
+        if self.storeThread is None:
+            return callback(f(self.store, *args))
+        return self.storeThread.run(f, *args).addCallback(callback)
+
 
     @ce.GetExerciseDetails.responder
     def getExerciseDetails(self, identifier):
@@ -83,20 +873,23 @@ class Locator(amp.CommandLocator):
 
         """
         exercise = self._getExercise(identifier)
+        return self._withSolvedIDs(lambda: self._getDetails(exercise))
+
+
+    def _getDetails(self, exercise):
         response = {
             b"identifier": exercise.identifier,
             b"title": exercise.title,
             b"description": exercise.description,
-            b"solved": exercise.wasSolvedBy(self.user)
+            b"solved": exercise.storeID in self.solvedIDs
         }
         return response
 
 
     def _getExercise(self, identifier):
         try:
-            cond = Exercise.identifier == identifier
-            return self.store.findUnique(Exercise, cond)
-        except ItemNotFound:
+            return getCatalog(self.store)[identifier]
+        except KeyError:
             raise ce.UnknownExercise()
 
 
@@ -117,11 +910,15 @@ class SolvableResourceMixin(object):
         exercise) that they've solved the exercise, and mark it as
         solved in the database.
 
+        Returns a Deferred that fires with ``True`` once the user has
+        been notified, or with ``False`` if the solution couldn't be
+        recorded (see ``solveAndNotify``), so that the resource can
+        tell the client.
+
         """
         remote = request.transport.remote
-        withThisIdentifier = Exercise.identifier == self.exerciseIdentifier
-        exercise = self.store.findUnique(Exercise, withThisIdentifier)
-        solveAndNotify(remote, exercise)
+        exercise = getCatalog(self.store)[self.exerciseIdentifier]
+        return solveAndNotify(remote, exercise)
 
 
 
@@ -135,13 +932,169 @@ class Secret(item.Item):
     - Preventing users from requesting arbitrary amounts of random
       data
 
+    Exercises shouldn't use the entropy directly; ``deriveKey`` and
+    ``deriveStream`` derive keys from it that are specific to an
+    exercise and a purpose within that exercise.
+
     """
     user = attributes.reference(allowNone=False, indexed=True)
     entropy = attributes.bytes(defaultFactory=lambda: os.urandom(256 // 8))
 
+    def committed(self):
+        """Forgets the keys derived for this secret's user, since this
+        secret was just added, changed or deleted.
+
+        """
+        store, user = self.store, self.user
+        item.Item.committed(self)
+        if user is not None:
+            getDerivedKeys(store).discard(user.storeID)
+
+
     @classmethod
     def forUser(cls, user):
         """Finds or creates a Secret for this user.
 
+        Creating it happens in a transaction, so that processes sharing
+        the store don't both create a secret for the same user. Finding
+        an existing secret only reads from the store.
+
         """
-        return user.store.findOrCreate(cls, user=user)
+        def findOrCreate():
+            secret = cls._find(user)
+            if secret is None:
+                secret = cls(store=user.store, user=user)
+            return secret
+
+        secret = cls._find(user)
+        if secret is None:
+            secret = user.store.transact(findOrCreate)
+        return secret
+
+
+    @classmethod
+    def _find(cls, user):
+        """Finds the user's oldest secret, if there is one.
+
+        """
+        return user.store.findFirst(cls, cls.user == user,
+                                    sort=cls.storeID.ascending)
+
+
+    @classmethod
+    def forUserQueued(cls, user, writeQueue):
+        """Finds or creates a Secret for this user, like ``forUser``.
+
+        If the secret has to be created, that is done through the given
+        write queue, together with other writes. Returns a Deferred
+        that fires with the secret.
+
+        """
+        secret = cls._find(user)
+        if secret is not None:
+            return succeed(secret)
+        return writeQueue.write(cls.forUser, user)
+
+
+    @classmethod
+    def deriveKey(cls, user, identifier, label, length=32):
+        """Derives a key of ``length`` bytes from the user's secret, for the
+        exercise with the given identifier, and the given label.
+
+        Keys are derived with HKDF, so keys for different exercises or
+        labels are unrelated, and they reveal nothing about the secret.
+        The same arguments always give the same key.
+
+        Derived keys are cached (see ``getDerivedKeys``), so deriving
+        a key again doesn't query the store, or redo the derivation.
+
+        """
+        return cls._derive(user, b"key", identifier, label, length)
+
+
+    @classmethod
+    def deriveStream(cls, user, identifier, label):
+        """Derives a stream of pseudorandom bytes from the user's secret, for
+        the exercise with the given identifier, and the given label.
+
+        This is for when an exercise needs more bytes than a key, or
+        doesn't know how many it will need. The same arguments always
+        give a stream with the same bytes.
+
+        """
+        return KeyStream(cls._derive(user, b"stream", identifier, label, 32))
+
+
+    @classmethod
+    def _derive(cls, user, purpose, identifier, label, length):
+        """Derives a key, or gets it from the cache of derived keys.
+
+        The user's keys are only added to the cache after the secret
+        has been found, since creating the secret forgets them.
+
+        """
+        cacheKey = purpose, identifier, label, length
+        derivedKeys = getDerivedKeys(user.store)
+        keys = derivedKeys.get(user.storeID)
+        if keys is not None:
+            key = keys.get(cacheKey)
+            if key is not None:
+                return key
+
+        entropy = cls.forUser(user).entropy
+        if keys is None or user.storeID not in derivedKeys:
+            keys = derivedKeys[user.storeID] = LRUCache(maxDerivedKeysPerUser)
+        key = keys[cacheKey] = _hkdf(entropy, length,
+                                     [purpose, identifier, label])
+        return key
+
+
+
+def _hkdf(entropy, length, infoParts):
+    """Derives a key from the given entropy with HKDF-SHA256.
+
+    The parts of the info are length-prefixed, so that different
+    parts can't give the same info.
+
+    """
+    info = b"".join(b"{0}:{1},".format(len(part), part) for part in infoParts)
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=length, salt=None,
+                info=b"merlyn " + info, backend=default_backend())
+    return hkdf.derive(entropy)
+
+
+
+class KeyStream(object):
+    """A stream of pseudorandom bytes generated from a key, with
+    AES-256 in CTR mode.
+
+    """
+    def __init__(self, key):
+        cipher = Cipher(algorithms.AES(key), modes.CTR(b"\0" * 16),
+                        backend=default_backend())
+        self._encryptor = cipher.encryptor()
+
+
+    def read(self, count):
+        """Reads the next ``count`` bytes of the stream.
+
+        """
+        return self._encryptor.update(b"\0" * count)
+
+
+
+maxDerivedKeyUsers = 1024
+maxDerivedKeysPerUser = 64
+
+
+def getDerivedKeys(store):
+    """Gets the cache of keys derived from users' secrets for the given
+    store.
+
+    This is an ``LRUCache`` of user store IDs to ``LRUCache``s of the
+    keys derived for those users. Secrets remove the keys of their
+    user when they change. It is kept on the store (see ``cache.forStore``).
+
+    """
+    return forStore(store, "derivedKeys",
+                    lambda store: LRUCache(maxDerivedKeyUsers))
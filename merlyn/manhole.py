@@ -1,14 +1,20 @@
 """Note: this is horribly insecure; only listen on localhost ever!
 
 """
+from merlyn import profiling
 from twisted.cred import checkers, portal
 from twisted.conch import manhole, manhole_ssh
 
 checker = checkers.InMemoryUsernamePasswordDatabaseDontUse(manhole="manhole")
 
 
-def makeFactory(store, ampFactory):
-    shellGlobals = {"store": store, "ampFactory": ampFactory}
+def makeFactory(store, ampFactory, contextFactory=None):
+    shellGlobals = {
+        "store": store,
+        "ampFactory": ampFactory,
+        "contextFactory": contextFactory,
+        "profiler": profiling.Profiler(ampFactory.protocol)
+    }
     makeManhole = lambda _ign: manhole.ColoredManhole(shellGlobals)
 
     realm = manhole_ssh.TerminalRealm()
@@ -0,0 +1,221 @@
+"""Metrics about the server, in the Prometheus text format.
+
+Metrics are kept in memory, in the process that records them, and
+served over HTTP by ``MetricsResource``. Recording a value is a
+dictionary lookup and an addition or two, so they can stay on in
+production.
+
+"""
+import time
+from bisect import bisect_left
+
+from twisted.python.failure import Failure
+from twisted.web import resource
+
+
+class Registry(object):
+    """A collection of metrics that are rendered together.
+
+    """
+    def __init__(self):
+        self.metrics = []
+
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+
+    def render(self):
+        """Renders all metrics in the Prometheus text format.
+
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append("# HELP {0} {1}".format(metric.name, metric.help))
+            lines.append("# TYPE {0} {1}".format(metric.name, metric.type))
+            lines.extend(metric.samples())
+        return "".join(line + "\n" for line in lines)
+
+
+
+def _formatLabels(labelNames, labelValues, extra=()):
+    pairs = zip(labelNames, labelValues) + list(extra)
+    if not pairs:
+        return ""
+    escape = lambda v: (str(v).replace("\\", "\\\\").replace("\n", "\\n")
+                        .replace('"', '\\"'))
+    return "{" + ",".join('{0}="{1}"'.format(n, escape(v))
+                          for n, v in pairs) + "}"
+
+
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value)
+
+
+
+class Counter(object):
+    """A value that only goes up, for every combination of label values.
+
+    """
+    type = "counter"
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self._values = {}
+
+
+    def inc(self, *labelValues):
+        """Increments the value for the given label values by one.
+
+        """
+        self._values[labelValues] = self._values.get(labelValues, 0) + 1
+
+
+    def get(self, *labelValues):
+        return self._values.get(labelValues, 0)
+
+
+    def samples(self):
+        for labelValues, value in sorted(self._values.iteritems()):
+            labels = _formatLabels(self.labelNames, labelValues)
+            yield "{0}{1} {2}".format(self.name, labels, _formatValue(value))
+
+
+
+class Gauge(Counter):
+    """A value that can go up and down, for every combination of label
+    values.
+
+    """
+    type = "gauge"
+
+    def dec(self, *labelValues):
+        """Decrements the value for the given label values by one.
+
+        """
+        self._values[labelValues] = self._values.get(labelValues, 0) - 1
+
+
+
+defaultBuckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                  1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+
+class Histogram(object):
+    """Counts observed values (usually durations, in seconds) in buckets,
+    for every combination of label values.
+
+    """
+    type = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=defaultBuckets):
+        self.name = name
+        self.help = help
+        self.labelNames = labelNames
+        self.buckets = buckets
+        self._values = {}
+
+
+    def observe(self, value, *labelValues):
+        """Records an observed value for the given label values.
+
+        """
+        counts = self._values.get(labelValues)
+        if counts is None:
+            counts = self._values[labelValues] = [0] * len(self.buckets) + [0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+    def count(self, *labelValues):
+        """Gets the number of values observed for the given label values.
+
+        """
+        counts = self._values.get(labelValues)
+        return 0 if counts is None else sum(counts[:-1])
+
+
+    def samples(self):
+        for labelValues, counts in sorted(self._values.iteritems()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _formatLabels(self.labelNames, labelValues,
+                                       [("le", _formatValue(bound))])
+                yield "{0}_bucket{1} {2}".format(self.name, labels, cumulative)
+
+            labels = _formatLabels(self.labelNames, labelValues)
+            yield "{0}_sum{1} {2}".format(self.name, labels,
+                                          _formatValue(counts[-1]))
+            yield "{0}_count{1} {2}".format(self.name, labels, cumulative)
+
+
+
+registry = Registry()
+
+commandDurations = registry.register(Histogram(
+    "merlyn_amp_command_seconds",
+    "Time taken to respond to AMP commands",
+    labelNames=("command",)))
+
+commandErrors = registry.register(Counter(
+    "merlyn_amp_command_errors_total",
+    "AMP commands that failed",
+    labelNames=("command",)))
+
+verifications = registry.register(Histogram(
+    "merlyn_tls_verify_seconds",
+    "Time taken to verify client certificates, by outcome, and whether "
+    "the user was cached",
+    labelNames=("outcome", "cached")))
+
+openConnections = registry.register(Gauge(
+    "merlyn_amp_connections",
+    "Open AMP connections"))
+
+
+
+def timeResponder(name, responder, _now=time.time):
+    """Wraps an AMP responder (as found by ``locateResponder``), so that
+    the time it takes to respond is recorded in ``commandDurations``,
+    and its failures in ``commandErrors``.
+
+    """
+    def timedResponder(box):
+        start = _now()
+        d = responder(box)
+
+        @d.addBoth
+        def record(result):
+            commandDurations.observe(_now() - start, name)
+            if isinstance(result, Failure):
+                commandErrors.inc(name)
+            return result
+
+        return d
+
+    return timedResponder
+
+
+
+class MetricsResource(resource.Resource):
+    """Serves the metrics in a registry.
+
+    """
+    isLeaf = True
+
+    def __init__(self, registry=registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+
+    def render_GET(self, request):
+        request.setHeader(b"content-type", b"text/plain; version=0.0.4")
+        return self.registry.render()
@@ -1,5 +1,9 @@
+import time
+
 from axiom import attributes, item
 from axiom.errors import ItemNotFound
+from merlyn.cache import forStore
+from twisted.python import log
 from twisted.python.reflect import namedAny
 
 
@@ -7,6 +11,41 @@ class _PersistedFactory(item.Item):
     identifier = attributes.bytes(indexed=True)
     name = attributes.bytes()
 
+    _oldIdentifiers = attributes.inmemory()
+
+    def __setattr__(self, name, value):
+        """Sets an attribute. If that changes the identifier of a persisted
+        factory that's already in a store, the old identifier is
+        remembered, so that its factory is forgotten too.
+
+        """
+        if name == "identifier" and self.store is not None:
+            old = self.identifier
+            if old != value:
+                if getattr(self, "_oldIdentifiers", None) is None:
+                    self._oldIdentifiers = set()
+                self._oldIdentifiers.add(old)
+        item.Item.__setattr__(self, name, value)
+
+
+    def committed(self):
+        """Forgets the factory for this identifier (and any identifier
+        this persisted factory had before) in the store's factory dict,
+        since this persisted factory was just added, changed or
+        deleted.
+
+        """
+        store, identifier = self.store, self.identifier
+        oldIdentifiers = getattr(self, "_oldIdentifiers", None) or ()
+        self._oldIdentifiers = None
+        item.Item.committed(self)
+
+        factoryDict = getFactoryDict(store)
+        for oldIdentifier in oldIdentifiers:
+            factoryDict.invalidate(oldIdentifier)
+        factoryDict.invalidate(identifier)
+
+
     def dereference(self):
         """Returns the object to which the name attribute points.
 
@@ -24,12 +63,26 @@ class FactoryDict(object):
     This object is read-only; to persist factories, use
     ``addToStore``.
 
+    Factories are looked up, dereferenced and built once, and then
+    served from memory until they are invalidated. Persisted factories
+    invalidate themselves when they're added, changed or deleted in
+    this process. If they are changed some other way, for example by
+    another process, call ``invalidate``.
+
+    Use ``getFactoryDict`` to get the factory dict for a store.
+
     """
     def __init__(self, store):
         self.store = store
+        self._factories = {}
 
 
     def __getitem__(self, key):
+        try:
+            return self._factories[key]
+        except KeyError:
+            pass
+
         PF = _PersistedFactory
         try:
             persistedFactory = self.store.findUnique(PF, PF.identifier == key)
@@ -37,7 +90,32 @@ class FactoryDict(object):
             raise KeyError(key)
 
         factoryMaker = persistedFactory.dereference()
-        return factoryMaker(self.store)
+        factory = self._factories[key] = factoryMaker(self.store)
+        return factory
+
+
+    def invalidate(self, identifier=None):
+        """Forgets the factory with the given identifier, or all factories if
+        no identifier is given, so that they will be built again when
+        they are next needed.
+
+        """
+        if identifier is None:
+            self._factories.clear()
+        else:
+            self._factories.pop(identifier, None)
+
+
+
+def getFactoryDict(store):
+    """Gets the factory dict for the given store.
+
+    There is one factory dict per store, shared by every connection in
+    this process. It is kept on the store (see ``cache.forStore``), so
+    it lives as long as the store does.
+
+    """
+    return forStore(store, "factoryDict", FactoryDict)
 
 
 
@@ -51,9 +129,37 @@ def addToStore(store, identifier, name):
     store.
 
     If a persisted factory with the same identifier already exists,
-    the name will be updated.
+    the name will be updated, and the store's factory dict will build
+    a new factory for it.
 
     """
     persistedFactory = store.findOrCreate(_PersistedFactory, identifier=identifier)
     persistedFactory.name = name
+    getFactoryDict(store).invalidate(identifier)
     return persistedFactory
+
+
+
+def preload(store):
+    """Dereferences and builds every persisted factory in the store, so
+    that the first connection to each of them doesn't have to.
+
+    Returns a list of ``(identifier, seconds)`` pairs, with the time it
+    took to build each factory. If a factory can't be built (for
+    example, because its name doesn't point to anything), the
+    exception is logged and raised.
+
+    """
+    factoryDict = getFactoryDict(store)
+    timings = []
+    for persistedFactory in store.query(_PersistedFactory):
+        identifier = persistedFactory.identifier
+        start = time.time()
+        try:
+            factoryDict[identifier]
+        except Exception:
+            log.msg("Couldn't preload factory {0!r} ({1!r})"
+                    .format(identifier, persistedFactory.name))
+            raise
+        timings.append((identifier, time.time() - start))
+    return timings
@@ -0,0 +1,198 @@
+"""Profiling AMP responders and factory lookups of a running server.
+
+A ``Profiler`` is available as ``profiler`` in the manhole. For
+example, to profile ``GetExercises`` for a minute::
+
+    profiler.start("exercises.prof", seconds=60, commands=["GetExercises"])
+
+When it is not profiling, the profiler has replaced nothing, so it
+costs nothing.
+
+"""
+import cProfile
+import sys
+import time
+
+from merlyn.multiplexing import FactoryDict
+from twisted.internet import reactor
+from twisted.python import log
+
+
+class _StackProfile(object):
+    """Records how long was spent in every call stack.
+
+    ``dump_stats`` writes the stacks in the folded format that flame graph
+    tools (such as ``flamegraph.pl``) read: one line per stack, with
+    the frames separated by semicolons, followed by the number of
+    microseconds spent in it.
+
+    This has the same ``enable``, ``disable`` and ``dump_stats`` methods
+    as a ``cProfile.Profile``.
+
+    """
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self.stacks = {}
+        self._stack = []
+        self._last = None
+
+
+    def enable(self):
+        self._stack = []
+        self._last = self.timer()
+        sys.setprofile(self._event)
+
+
+    def disable(self):
+        sys.setprofile(None)
+        self._account(self.timer())
+
+
+    def _account(self, now):
+        if self._stack:
+            key = tuple(self._stack)
+            self.stacks[key] = self.stacks.get(key, 0) + now - self._last
+        self._last = now
+
+
+    def _event(self, frame, event, arg):
+        self._account(self.timer())
+        if event == "call":
+            code = frame.f_code
+            self._stack.append("{0}:{1}".format(code.co_filename,
+                                                code.co_name))
+        elif event == "c_call":
+            self._stack.append(getattr(arg, "__name__", repr(arg)))
+        elif self._stack:
+            self._stack.pop()
+
+
+    def dump_stats(self, path):
+        with open(path, "wb") as f:
+            for stack, seconds in sorted(self.stacks.iteritems()):
+                f.write("{0} {1}\n".format(";".join(stack),
+                                           int(seconds * 1e6)))
+
+
+
+def _replace(cls, name, value):
+    """Replaces an attribute of a class. Returns a function that puts
+    back the original.
+
+    """
+    if name in cls.__dict__:
+        original = cls.__dict__[name]
+        restore = lambda: setattr(cls, name, original)
+    else:
+        restore = lambda: delattr(cls, name)
+    setattr(cls, name, value)
+    return restore
+
+
+
+class Profiler(object):
+    """Profiles the responders of an AMP protocol class, and the factory
+    lookups of factory dicts, for a while.
+
+    Only the work done before a responder returns is profiled; work
+    done later (for example, in the store thread) is not.
+
+    """
+    def __init__(self, protocolClass, factoryDictClass=FactoryDict,
+                 reactor=reactor):
+        self.protocolClass = protocolClass
+        self.factoryDictClass = factoryDictClass
+        self.reactor = reactor
+
+        self.path = None
+        self._profile = None
+        self._depth = 0
+        self._restores = []
+        self._call = None
+
+
+    @property
+    def profiling(self):
+        return self._profile is not None
+
+
+    def start(self, path, seconds=60.0, commands=None, stacks=False):
+        """Starts profiling, for the given number of seconds.
+
+        If ``commands`` is given, only responders for those commands
+        are profiled; otherwise, all of them are. Factory lookups are
+        always profiled.
+
+        When profiling stops, cProfile stats (which ``pstats`` reads)
+        are written to ``path``, or, if ``stacks`` is true, folded
+        stacks (see ``_StackProfile``).
+
+        """
+        if self.profiling:
+            raise RuntimeError("already profiling to {0!r}".format(self.path))
+
+        self.path = path
+        self._profile = _StackProfile() if stacks else cProfile.Profile()
+
+        commands = None if commands is None else frozenset(commands)
+        profiled = self._profiled
+        locateResponder = self.protocolClass.locateResponder.im_func
+
+        def profiledLocateResponder(proto, name):
+            responder = locateResponder(proto, name)
+            if responder is not None and (commands is None
+                                          or name in commands):
+                responder = profiled(responder)
+            return responder
+
+        getItem = self.factoryDictClass.__getitem__.im_func
+        self._restores = [
+            _replace(self.protocolClass, "locateResponder",
+                     profiledLocateResponder),
+            _replace(self.factoryDictClass, "__getitem__", profiled(getItem))
+        ]
+
+        self._call = self.reactor.callLater(seconds, self.stop)
+
+
+    def _profiled(self, f):
+        """Wraps a function, so that calls to it are profiled.
+
+        """
+        def profiledFunction(*args, **kwargs):
+            profile = self._profile
+            if profile is None:
+                return f(*args, **kwargs)
+
+            if self._depth == 0:
+                profile.enable()
+            self._depth += 1
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self._depth -= 1
+                if self._depth == 0:
+                    profile.disable()
+
+        return profiledFunction
+
+
+    def stop(self):
+        """Stops profiling, and writes the profile. Returns its path.
+
+        """
+        if not self.profiling:
+            raise RuntimeError("not profiling")
+
+        if self._call.active():
+            self._call.cancel()
+        self._call = None
+
+        for restore in self._restores:
+            restore()
+        self._restores = []
+
+        profile, self._profile = self._profile, None
+        profile.dump_stats(self.path)
+        log.msg("Wrote profile to {0!r}".format(self.path))
+        return self.path
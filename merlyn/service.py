@@ -1,10 +1,17 @@
+import sys
+from functools import partial
+from heapq import merge
+
 from axiom import store
-from merlyn import auth, exercise, manhole, multiplexing
+from merlyn import auth, exercise, manhole, metrics, multiplexing
+from merlyn import storethread, workers, writequeue
 from twisted.application import service
 from twisted import plugin
-from twisted.internet import protocol, reactor
+from twisted.internet import defer, endpoints, protocol, reactor, task
 from twisted.protocols.amp import AMP
-from twisted.python import usage
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.python import log, usage
+from twisted.web import server
 from txampext.multiplexing import MultiplexingCommandLocator
 from zope import interface
 
@@ -23,9 +30,20 @@ class Protocol(AMP, exercise.Locator, auth.UserMixin, MultiplexingCommandLocator
         return self.factory.store
 
 
+    @property
+    def storeThread(self):
+        return self.factory.storeThread
+
+
+    @property
+    def writeQueue(self):
+        return self.factory.writeQueue
+
+
     def connectionMade(self):
         """Keep a reference to the protocol on the factory, and uses the
-        factory's store to find multiplexed connection factories.
+        factory dict of the factory's store (shared by all connections)
+        to find multiplexed connection factories.
 
         Unfortunately, we can't add the protocol by TLS certificate
         fingerprint, because the TLS handshake won't have completed
@@ -34,25 +52,293 @@ class Protocol(AMP, exercise.Locator, auth.UserMixin, MultiplexingCommandLocator
 
         """
         self.factory.protocols.add(self)
-        self._factories = multiplexing.FactoryDict(self.store)
+        metrics.openConnections.inc()
+        self._factories = multiplexing.getFactoryDict(self.store)
         super(AMP, self).connectionMade()
 
 
+    def locateResponder(self, name):
+        """Finds the responder for a command, and times it (see
+        ``metrics.timeResponder``).
+
+        """
+        responder = super(Protocol, self).locateResponder(name)
+        if responder is not None:
+            responder = metrics.timeResponder(name, responder)
+        return responder
+
+
+    def userResolved(self, user):
+        """Registers this connection as one of the user's on the factory.
+
+        If there's a write queue, and the user doesn't have a secret yet,
+        it is created through the write queue, together with other
+        writes, so that deriving keys for the user later doesn't need
+        a transaction of its own.
+
+        """
+        self.factory._addUserConnection(self)
+        if self.writeQueue is not None:
+            d = exercise.Secret.forUserQueued(user, self.writeQueue)
+            d.addErrback(log.err, "Couldn't create a secret")
+
+
+    @exercise.Subscribe.responder
+    def subscribe(self):
+        """Subscribes this connection to changes (see ``Factory``).
+
+        The user is found first, so that their solutions are pushed.
+        The latest version is read in the store thread, if there is one.
+
+        """
+        self.user
+        self.factory._subscribe(self)
+        return self._inStoreThread(lambda latest: {"version": latest},
+                                   exercise._latestVersion)
+
+
+    @exercise.Unsubscribe.responder
+    def unsubscribe(self):
+        self.factory._unsubscribe(self)
+        return {}
+
+
     def connectionLost(self, reason):
         """Lose the reference to the protocol on the factory.
 
         """
         self.factory.protocols.remove(self)
+        self.factory._unsubscribe(self)
+        metrics.openConnections.dec()
+        if self._user is not None:
+            self.factory._removeUserConnection(self)
         super(AMP, self).connectionLost(reason)
 
 
 
 class Factory(protocol.ServerFactory):
+    """The factory for merlyn AMP connections.
+
+    Keeps track of all connections in ``protocols``, and of the
+    connections of every user, once they're known.
+
+    While the factory is started, it pushes changes to subscribed
+    connections (see ``exercise.Subscribe``). It listens for changes
+    to its store (see ``exercise.addChangeListener``), and then, once
+    per reactor iteration, sends the changes since the last time to
+    every subscribed connection, and adds new solutions to the solved
+    exercises cached by the solvers' connections. The changes are
+    found in the store thread, if there is one.
+
+    """
     protocol = Protocol
 
-    def __init__(self, store):
+    def __init__(self, store, storeThread=None, writeQueue=None,
+                 cooperator=task, reactor=reactor):
         self.store = store
+        self.storeThread = storeThread
+        self.writeQueue = writeQueue
+        self.cooperator = cooperator
+        self.reactor = reactor
         self.protocols = set()
+        self._connectionsByUser = {}
+        self._subscribers = set()
+        self._pushedVersion = None
+        self._pushCall = None
+        self._pushing = False
+        self._pushAgain = False
+
+
+    def startFactory(self):
+        self._pushedVersion = exercise._latestVersion(self.store)
+        exercise.addChangeListener(self.store, self._changed)
+
+
+    def stopFactory(self):
+        exercise.removeChangeListener(self.store, self._changed)
+        if self._pushCall is not None:
+            call, self._pushCall = self._pushCall, None
+            call.cancel()
+        self._pushAgain = False
+
+
+    def _subscribe(self, proto):
+        self._subscribers.add(proto)
+
+
+    def _unsubscribe(self, proto):
+        self._subscribers.discard(proto)
+
+
+    def _changed(self):
+        """Pushes changes soon, unless that's already going to happen.
+
+        If changes are being pushed already, they are pushed again once
+        that's done.
+
+        """
+        if self._pushing:
+            self._pushAgain = True
+        elif self._pushCall is None:
+            self._pushCall = self.reactor.callLater(0, self._pushChanges)
+
+
+    def _pushChanges(self):
+        """Pushes the changes since the last push.
+
+        The changes are found in the store thread, if there is one. If
+        the store changes again while they are being pushed, they are
+        pushed again once that's done.
+
+        """
+        self._pushCall = None
+        self._pushing = True
+        since, userIDs = self._pushedVersion, list(self._connectionsByUser)
+        d = self._runQuery(exercise._changesSince, since, userIDs)
+        d.addCallback(self._pushed)
+        d.addErrback(log.err, "Couldn't push changes")
+
+        @d.addBoth
+        def done(_result):
+            self._pushing = False
+            if self._pushAgain:
+                self._pushAgain = False
+                self._changed()
+
+        return d
+
+
+    def _runQuery(self, f, *args):
+        """Calls ``f`` with a store and the given arguments: in the store
+        thread if there is one, or with this factory's store otherwise.
+
+        Returns a Deferred that fires with the result.
+
+        """
+        if self.storeThread is None:
+            return defer.maybeDeferred(f, self.store, *args)
+        return self.storeThread.run(f, *args)
+
+
+    def _pushed(self, changes):
+        """Pushes changes found by ``exercise._changesSince``.
+
+        Solved exercises are added to the solvers' connections' caches
+        right away. Subscribers are sent their changes once their own
+        solved exercises are known (see ``exercise.Locator``).
+
+        """
+        latest, exercises, solutions = changes
+        self._pushedVersion = max(self._pushedVersion, latest)
+
+        solutionsByUser = {}
+        for version, userID, solved in solutions:
+            solutionsByUser.setdefault(userID, []).append((version, solved))
+            for proto in self._connectionsByUser.get(userID, ()):
+                proto.exerciseSolved(solved)
+
+        if not exercises and not solutions:
+            return
+
+        pushes = []
+        for proto in list(self._subscribers):
+            own = solutionsByUser.get(proto._user.storeID, [])
+            if not exercises and not own:
+                continue
+
+            push = partial(self._pushTo, proto, latest, exercises, own)
+            d = defer.maybeDeferred(proto._withSolvedIDs, push)
+            d.addErrback(log.err, "Couldn't push changes to a subscriber")
+            pushes.append(d)
+
+        return defer.gatherResults(pushes)
+
+
+    def _pushTo(self, proto, latest, exercises, own):
+        """Sends changed exercises and the subscriber's own solutions to a
+        subscriber, unless it's unsubscribed in the meantime.
+
+        """
+        if proto not in self._subscribers:
+            return
+
+        solvedIDs = proto.solvedIDs
+        changes = merge(((v, e, e.storeID in solvedIDs) for v, e in exercises),
+                        ((v, e, True) for v, e in own))
+        pages = list(exercise._pages(changes, exercise.maxPageSize))
+        for i, (page, version) in enumerate(pages):
+            if i == len(pages) - 1:
+                version = latest
+            proto.callRemote(exercise.NotifyChanged,
+                             exercises=page, version=version)
+
+
+    def _addUserConnection(self, proto):
+        key = proto._user.storeID
+        self._connectionsByUser.setdefault(key, set()).add(proto)
+
+
+    def _removeUserConnection(self, proto):
+        key = proto._user.storeID
+        connections = self._connectionsByUser.get(key, set())
+        connections.discard(proto)
+        if not connections:
+            self._connectionsByUser.pop(key, None)
+
+
+    def connectionsFor(self, user):
+        """Gets the current connections of the given user.
+
+        Only includes connections for which the user has been found,
+        which happens when they first use a command that needs it.
+
+        """
+        return frozenset(self._connectionsByUser.get(user.storeID, ()))
+
+
+    def callRemoteForUser(self, user, command, **kwargs):
+        """Calls a remote command on all of the given user's connections.
+
+        """
+        for proto in self.connectionsFor(user):
+            proto.callRemote(command, **kwargs)
+
+
+    def broadcast(self, command, **kwargs):
+        """Calls a remote command on every connection.
+
+        This is done cooperatively, a few connections at a time, so
+        that other connections are still served while there are
+        thousands to go. Connections that are lost in the meantime are
+        skipped. Returns a Deferred that fires when every connection
+        has been sent the command.
+
+        """
+        def callRemotes():
+            for proto in list(self.protocols):
+                if proto in self.protocols:
+                    proto.callRemote(command, **kwargs)
+                yield None
+
+        return self.cooperator.cooperate(callRemotes()).whenDone()
+
+
+    def invalidateSolved(self, user=None):
+        """Forgets the cached solved exercises of all connections by the
+        given user, or all connections if no user is given.
+
+        Use this when solutions were recorded without going through
+        ``exercise.solveAndNotify``, for example from the manhole or by
+        another process.
+
+        """
+        if user is None:
+            connections = self.protocols
+        else:
+            connections = self.connectionsFor(user)
+
+        for proto in connections:
+            proto.invalidateSolved()
 
 
 
@@ -61,31 +347,212 @@ class Options(usage.Options):
     The options for starting a service.
     """
     optParameters = [
-        ["store", "s", None, "Path to the store (mandatory)", store.Store]
+        ["store", "s", None, "Path to the store (mandatory)", store.Store],
+        ["manhole", None, "tcp:8888:interface=localhost",
+         "Endpoint description to serve the manhole on"],
+        ["certificate", None, "cert.pem", "Path to the TLS certificate"],
+        ["key", None, "key.pem", "Path to the TLS private key"],
+        ["dh-parameters", None, "dhparam.pem", "Path to the DH parameters"],
+        ["session-timeout", None, 60 * 60,
+         "Seconds for which TLS sessions can be resumed", int],
+        ["ticket-key-lifetime", None, 24 * 60 * 60,
+         "Seconds after which TLS session ticket keys are rotated", int],
+        ["elliptic-curve", None, "prime256v1",
+         "Name of the elliptic curve used for ECDHE"],
+        ["verify-log-limit", None, 100,
+         "Certificate verifications of each outcome to log per minute "
+         "(the rest are counted, and summarized)", int],
+        ["commit-interval", None, None,
+         "Milliseconds for which to group writes into one transaction "
+         "(default: don't group writes)", int],
+        ["commit-batch-size", None, 100,
+         "Maximum number of writes grouped into one transaction", int],
+        ["workers", None, 1, "Number of processes to serve from", int],
+        ["metrics", None, None,
+         "Endpoint description to serve metrics on over HTTP, for example "
+         "tcp:9100:interface=localhost (default: don't serve metrics)"]
     ]
 
+    optFlags = [
+        ["store-thread", None, "Query the store in a dedicated thread"],
+        ["preload-factories", None,
+         "Build all multiplexed factories before listening"],
+        ["worker", None, "Run as a worker process (used by --workers)"]
+    ]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self["listen"] = []
+
+
+    def opt_listen(self, description):
+        """Endpoint description to serve AMP on, over TLS (for example,
+        tcp:4430:backlog=128 or unix:merlyn.sock). Can be passed more
+        than once. [default: tcp:4430]
+
+        """
+        self["listen"].append(description)
+
+
     def postOptions(self):
-        """Verify that a store was passed.
+        """Verify that a store was passed, and listen on the default port if
+        no endpoints were passed.
 
         """
         if self["store"] is None:
             raise usage.UsageError("Passing a root store is mandatory.")
 
+        if not self["listen"]:
+            self["listen"] = ["tcp:4430"]
+
 
 
 class Service(service.Service):
-    def __init__(self, store, reactor=reactor):
+    """The merlyn service.
+
+    If ``useStoreThread`` is true, AMP responders query the store in a
+    dedicated thread (see ``storethread.StoreThread``). This requires
+    a store on disk.
+
+    If ``commitInterval`` is not ``None``, writes are grouped into
+    transactions of up to ``commitBatchSize`` writes, for up to that
+    many milliseconds (see ``writequeue.WriteQueue``).
+
+    If ``preloadFactories`` is true, all multiplexed factories are
+    built before the service starts listening (see
+    ``multiplexing.preload``). If any of them can't be built, the
+    service fails to start.
+
+    The AMP factory listens on every endpoint description in
+    ``ampEndpoints``, always over TLS, and the manhole listens on
+    ``manholeEndpoint``. If ``metricsEndpoint`` is not ``None``, the
+    metrics are served over HTTP on it (see ``metrics``).
+
+    If ``workers`` is more than one, this process starts ``workers -
+    1`` worker processes with the command line ``workerArguments``
+    (see ``workers.WorkerPool``). Those run with ``isWorker`` set,
+    which means they don't serve a manhole or metrics, and only listen
+    on TCP endpoints. All of the processes share those TCP ports, and
+    watch the store for changes made by the others (see
+    ``workers.ChangeWatcher``). Metrics are kept per process, so the
+    metrics served are only those of this process.
+
+    Any other keyword arguments besides the reactor are passed to
+    ``auth.ContextFactory``.
+
+    """
+    ampFactory = None
+    storeThread = None
+    writeQueue = None
+    workerPool = None
+    changeWatcher = None
+    contextFactory = None
+
+    def __init__(self, store, reactor=reactor, useStoreThread=False,
+                 commitInterval=None, commitBatchSize=100,
+                 preloadFactories=False, workers=1, isWorker=False,
+                 workerArguments=None, ampEndpoints=("tcp:4430",),
+                 manholeEndpoint="tcp:8888:interface=localhost",
+                 metricsEndpoint=None, **contextFactoryKwargs):
         self.store = store
         self.reactor = reactor
+        self.useStoreThread = useStoreThread
+        self.commitInterval = commitInterval
+        self.commitBatchSize = commitBatchSize
+        self.preloadFactories = preloadFactories
+        self.workers = workers
+        self.isWorker = isWorker
+        self.workerArguments = workerArguments
+        self.ampEndpoints = ampEndpoints
+        self.manholeEndpoint = manholeEndpoint
+        self.metricsEndpoint = metricsEndpoint
+        self.contextFactoryKwargs = contextFactoryKwargs
 
 
     def startService(self):
-        factory = Factory(self.store)
-        ctxFactory = auth.ContextFactory(self.store)
-        self.reactor.listenSSL(4430, factory, ctxFactory)
+        if self.preloadFactories:
+            for identifier, seconds in multiplexing.preload(self.store):
+                log.msg("Preloaded factory {0!r} in {1:.3f}s"
+                        .format(identifier, seconds))
+
+        if self.useStoreThread:
+            self.storeThread = storethread.StoreThread(self.store.dbdir,
+                                                       self.reactor)
+            self.storeThread.start()
+
+        if self.commitInterval is not None:
+            self.writeQueue = writequeue.WriteQueue(
+                self.store, maxDelay=self.commitInterval / 1000.0,
+                maxSize=self.commitBatchSize, reactor=self.reactor)
+
+        factory = Factory(self.store, self.storeThread, self.writeQueue)
+        kwargs = self.contextFactoryKwargs
+        ctxFactory = auth.ContextFactory(self.store, reactor=self.reactor,
+                                         **kwargs)
+        ctxFactory.start()
+        self.contextFactory = ctxFactory
+
+        self.ampFactory = factory
+
+        listenReactor = self.reactor
+        if self.isWorker or self.workers > 1:
+            listenReactor = workers.ReusablePortReactor(self.reactor)
+            self.changeWatcher = workers.ChangeWatcher(self.store, factory,
+                                                       reactor=self.reactor)
+            self.changeWatcher.start()
+
+        tlsFactory = TLSMemoryBIOFactory(ctxFactory, False, factory)
+        for description in self.ampEndpoints:
+            endpoint = endpoints.serverFromString(listenReactor, description)
+            if self.isWorker and not isinstance(endpoint, _tcpEndpoints):
+                continue
+            _listen(endpoint, tlsFactory)
+
+        if not self.isWorker:
+            manholeFactory = manhole.makeFactory(self.store, factory,
+                                                 ctxFactory)
+            endpoint = endpoints.serverFromString(self.reactor,
+                                                  self.manholeEndpoint)
+            _listen(endpoint, manholeFactory)
+
+        if self.metricsEndpoint is not None and not self.isWorker:
+            metricsFactory = server.Site(metrics.MetricsResource())
+            endpoint = endpoints.serverFromString(self.reactor,
+                                                  self.metricsEndpoint)
+            _listen(endpoint, metricsFactory)
+
+        if self.workers > 1:
+            self.workerPool = workers.WorkerPool(self.workers - 1,
+                                                 self.workerArguments,
+                                                 self.reactor)
+            self.workerPool.start()
+
+
+    def stopService(self):
+        """Commits any queued writes, stops checking the TLS files, and stops
+        the store thread and worker processes, if there are any.
+
+        """
+        if self.writeQueue is not None:
+            self.writeQueue.flush()
+
+        if self.changeWatcher is not None:
+            self.changeWatcher.stop()
+
+        if self.contextFactory is not None:
+            self.contextFactory.stop()
+
+        stopping = []
+        if self.workerPool is not None:
+            workerPool, self.workerPool = self.workerPool, None
+            stopping.append(workerPool.stop())
+
+        if self.storeThread is not None:
+            storeThread, self.storeThread = self.storeThread, None
+            stopping.append(storeThread.stop())
 
-        manholeFactory = manhole.makeFactory(self.store, factory)
-        self.reactor.listenTCP(8888, manholeFactory, interface="localhost")
+        if stopping:
+            return defer.gatherResults(stopping)
 
 
 
@@ -99,4 +566,73 @@ class ServiceMaker(object):
     options = Options
 
     def makeService(self, options):
-        return Service(options["store"])
+        workerArguments = None
+        if options["workers"] > 1:
+            workerArguments = _workerArguments(options)
+
+        return Service(options["store"],
+                       workers=options["workers"],
+                       isWorker=options["worker"],
+                       workerArguments=workerArguments,
+                       ampEndpoints=options["listen"],
+                       manholeEndpoint=options["manhole"],
+                       metricsEndpoint=options["metrics"],
+                       useStoreThread=options["store-thread"],
+                       commitInterval=options["commit-interval"],
+                       commitBatchSize=options["commit-batch-size"],
+                       preloadFactories=options["preload-factories"],
+                       certificatePath=options["certificate"],
+                       keyPath=options["key"],
+                       dhParametersPath=options["dh-parameters"],
+                       sessionTimeout=options["session-timeout"],
+                       ticketKeyLifetime=options["ticket-key-lifetime"],
+                       ellipticCurve=options["elliptic-curve"],
+                       verifyLogLimit=options["verify-log-limit"])
+
+
+
+def _workerArguments(options):
+    """Builds the command line for a worker process, which runs with the
+    same options as this one.
+
+    """
+    arguments = [sys.executable, "-c",
+                 "from twisted.scripts.twistd import run; run()",
+                 "--nodaemon", "--pidfile=", ServiceMaker.tapname]
+
+    for parameter in Options.optParameters:
+        name = parameter[0]
+        value = options[name]
+        if name == "workers" or value is None:
+            continue
+        elif name == "store":
+            value = value.dbdir.path
+        arguments.append("--{0}={1}".format(name, value))
+
+    for name, _short, _doc in Options.optFlags:
+        if options[name]:
+            arguments.append("--{0}".format(name))
+
+    for description in options["listen"]:
+        arguments.append("--listen={0}".format(description))
+
+    arguments.append("--worker")
+    return arguments
+
+
+
+_tcpEndpoints = endpoints.TCP4ServerEndpoint, endpoints.TCP6ServerEndpoint
+
+
+def _listen(endpoint, factory):
+    """Listens on the given endpoint.
+
+    If that fails right away (as it does for most endpoints, for
+    example when the port is in use), the exception is raised, so that
+    the service fails to start instead of running without listening.
+
+    """
+    failures = []
+    endpoint.listen(factory).addErrback(failures.append)
+    if failures:
+        failures[0].raiseException()
@@ -0,0 +1,66 @@
+"""Store access off the reactor thread.
+
+"""
+from axiom.store import Store
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class StoreThread(object):
+    """Runs functions against a store in a dedicated thread, so that slow
+    queries don't block the reactor.
+
+    SQLite connections can only be used from the thread that created
+    them, so the thread opens its own store on the same database. The
+    functions get that store, not the one used in the reactor thread,
+    so they must not return items from it; they should return plain
+    data (such as store IDs) instead.
+
+    """
+    def __init__(self, dbdir, reactor=reactor):
+        self.dbdir = dbdir
+        self.reactor = reactor
+        self._pool = ThreadPool(1, 1, name="merlyn-store")
+        self._store = None
+
+
+    def start(self):
+        """Starts the thread.
+
+        """
+        self._pool.start()
+
+
+    def stop(self):
+        """Closes the thread's store, and stops the thread.
+
+        Returns a Deferred that fires once the store is closed.
+
+        """
+        d = deferToThreadPool(self.reactor, self._pool, self._close)
+        d.addBoth(lambda result: (self._pool.stop(), result)[1])
+        return d
+
+
+    def _close(self):
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+
+    def run(self, f, *args, **kwargs):
+        """Calls ``f`` with the thread's store, and any other arguments, in
+        the store thread.
+
+        Returns a Deferred that fires with the result.
+
+        """
+        return deferToThreadPool(self.reactor, self._pool,
+                                 self._call, f, args, kwargs)
+
+
+    def _call(self, f, args, kwargs):
+        if self._store is None:
+            self._store = Store(self.dbdir)
+        return f(self._store, *args, **kwargs)
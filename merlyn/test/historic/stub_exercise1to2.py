@@ -0,0 +1,25 @@
+"""Creates a store with version 1 exercises and a version 2 solution in
+it.
+
+"""
+from axiom.test.historic.stubloader import saveStub
+from merlyn.auth import User
+from merlyn.exercise import Exercise
+
+
+def createDatabase(store):
+    """Creates two exercises, one of which a user has solved.
+
+    """
+    user = User(store=store, email=b"user@example.com")
+    solved, _unsolved = [Exercise(store=store,
+                                  identifier=identifier,
+                                  title=u"Exercise",
+                                  description=u"Description")
+                         for identifier in [b"solved", b"unsolved"]]
+    solved.solvedBy(user)
+
+
+
+if __name__ == "__main__":
+    saveStub(createDatabase, "35254a8")
@@ -0,0 +1,23 @@
+"""Creates a store with a version 1 solution in it.
+
+"""
+from axiom.test.historic.stubloader import saveStub
+from merlyn.auth import User
+from merlyn.exercise import Exercise, _Solution
+
+
+def createDatabase(store):
+    """Creates a user who has solved an exercise.
+
+    """
+    user = User(store=store, email=b"user@example.com")
+    exercise = Exercise(store=store,
+                        identifier=b"exercise",
+                        title=u"Exercise",
+                        description=u"Description")
+    _Solution(store=store, who=user, what=exercise)
+
+
+
+if __name__ == "__main__":
+    saveStub(createDatabase, "e0161f1")
@@ -0,0 +1,55 @@
+from axiom.test.historic.stubloader import StubbedTest
+from merlyn.auth import User
+from merlyn.exercise import Exercise, _Solution, _latestVersion
+
+
+class VersionUpgradeTests(StubbedTest):
+    def test_exercisesUpgraded(self):
+        """The exercises keep their attributes, and get different versions.
+
+        """
+        exercises = list(self.store.query(Exercise,
+                                          sort=Exercise.identifier.ascending))
+        self.assertEqual([e.identifier for e in exercises],
+                         [b"solved", b"unsolved"])
+        for exercise in exercises:
+            self.assertEqual(exercise.title, u"Exercise")
+            self.assertEqual(exercise.description, u"Description")
+
+        versions = set(e.version for e in exercises)
+        self.assertEqual(len(versions), 2)
+        self.assertNotIn(0, versions)
+
+
+    def test_solutionUpgraded(self):
+        """The solution still refers to the same user and exercise, and gets
+        a version too.
+
+        """
+        solution = self.store.findUnique(_Solution)
+        user = self.store.findUnique(User)
+        exercise = self.store.findUnique(Exercise,
+                                         Exercise.identifier == b"solved")
+        self.assertIdentical(solution.who, user)
+        self.assertIdentical(solution.what, exercise)
+        self.assertTrue(exercise.wasSolvedBy(user))
+        self.assertNotEqual(solution.version, 0)
+
+
+    def test_latestVersion(self):
+        """The latest version is that of the last upgraded item.
+
+        """
+        versions = list(self.store.query(Exercise).getColumn("version"))
+        versions.append(self.store.findUnique(_Solution).version)
+        self.assertEqual(_latestVersion(self.store), max(versions))
+
+
+    def test_indexed(self):
+        """The upgraded solution table has an index on who solved when.
+
+        """
+        indexes = self.store.querySchemaSQL(
+            "SELECT name FROM *DATABASE*.sqlite_master WHERE type = 'index'")
+        expected = self.store._indexNameOf(_Solution, ["who", "version"])
+        self.assertIn((expected,), indexes)
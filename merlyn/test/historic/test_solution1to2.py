@@ -0,0 +1,27 @@
+from axiom.test.historic.stubloader import StubbedTest
+from merlyn.auth import User
+from merlyn.exercise import Exercise, _Solution
+
+
+class SolutionUpgradeTests(StubbedTest):
+    def test_solutionUpgraded(self):
+        """The solution still refers to the same user and exercise, and is
+        still visible to ``wasSolvedBy``.
+
+        """
+        solution = self.store.findUnique(_Solution)
+        user = self.store.findUnique(User)
+        exercise = self.store.findUnique(Exercise)
+        self.assertIdentical(solution.who, user)
+        self.assertIdentical(solution.what, exercise)
+        self.assertTrue(exercise.wasSolvedBy(user))
+
+
+    def test_indexed(self):
+        """The upgraded solution table has an index on who solved what.
+
+        """
+        indexes = self.store.querySchemaSQL(
+            "SELECT name FROM *DATABASE*.sqlite_master WHERE type = 'index'")
+        expected = self.store._indexNameOf(_Solution, ["who", "what"])
+        self.assertIn((expected,), indexes)
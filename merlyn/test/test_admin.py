@@ -0,0 +1,405 @@
+import json
+from StringIO import StringIO
+
+from axiom.store import Store
+from merlyn import admin, batching
+from merlyn.auth import User
+from merlyn.exercise import Exercise, Secret, _Solution, solvedExerciseIDs
+from twisted.trial.unittest import SynchronousTestCase
+
+
+def populate(store):
+    """Adds two users, two exercises, and three solutions to the store.
+
+    """
+    alice = User(store=store, email=b"alice@example.com", digest=b"abc")
+    bob = User(store=store, email=b"bob@example.com")
+    first = Exercise(store=store, identifier=b"first",
+                     title=u"First", description=u"The first one")
+    second = Exercise(store=store, identifier=b"second",
+                      title=u"Second \N{SNOWMAN}", description=u"Another")
+    first.solvedBy(alice)
+    second.solvedBy(alice)
+    first.solvedBy(bob)
+    return store
+
+
+
+def exportLines(store, **kwargs):
+    output = StringIO()
+    admin.export(store, output, **kwargs)
+    return output.getvalue().splitlines(True)
+
+
+
+class ExportTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        populate(self.store)
+
+
+    def test_export(self):
+        """Users and exercises are exported before solutions, one JSON object
+        per line.
+
+        """
+        objects = [json.loads(line) for line in exportLines(self.store)]
+        self.assertEqual(objects, [
+            {"type": "user", "email": "alice@example.com", "digest": "abc"},
+            {"type": "user", "email": "bob@example.com", "digest": None},
+            {"type": "exercise", "identifier": "first", "title": "First",
+             "description": "The first one"},
+            {"type": "exercise", "identifier": "second",
+             "title": u"Second \N{SNOWMAN}", "description": "Another"},
+            {"type": "solution", "user": "alice@example.com",
+             "exercise": "first"},
+            {"type": "solution", "user": "alice@example.com",
+             "exercise": "second"},
+            {"type": "solution", "user": "bob@example.com",
+             "exercise": "first"},
+        ])
+
+
+    def test_batches(self):
+        """Exports read the store in batches, which doesn't change what's
+        exported.
+
+        """
+        self.assertEqual(exportLines(self.store, batchSize=1, cacheSize=1),
+                         exportLines(self.store))
+
+
+    def test_concurrentChanges(self):
+        """Items added while the export runs aren't exported, so that every
+        exported solution refers to an exported user and exercise.
+
+        """
+        store = self.store
+        class Output(StringIO):
+            def write(self, line):
+                if not self.getvalue():
+                    carol = User(store=store, email=b"carol@example.com")
+                    third = Exercise(store=store, identifier=b"third",
+                                     title=u"Third", description=u"")
+                    third.solvedBy(carol)
+                    first = store.findUnique(Exercise,
+                                             Exercise.identifier == b"first")
+                    first.solvedBy(carol)
+                StringIO.write(self, line)
+
+        output = Output()
+        admin.export(store, output, batchSize=1)
+        lines = output.getvalue().splitlines(True)
+        self.assertEqual(lines, exportLines(populate(Store())))
+
+        counts = admin.importLines(Store(), lines)
+        self.assertEqual(counts, {"user": 2, "exercise": 2, "solution": 3})
+
+
+
+class ImportTests(SynchronousTestCase):
+    def setUp(self):
+        source = Store()
+        populate(source)
+        self.lines = exportLines(source)
+        self.store = Store()
+
+
+    def assertImported(self):
+        alice = self.store.findUnique(User, User.email == b"alice@example.com")
+        self.assertEqual(alice.digest, b"abc")
+        bob = self.store.findUnique(User, User.email == b"bob@example.com")
+        self.assertIdentical(bob.digest, None)
+
+        second = self.store.findUnique(Exercise,
+                                       Exercise.identifier == b"second")
+        self.assertEqual(second.title, u"Second \N{SNOWMAN}")
+
+        solved = lambda user: set(self.store.getItemByID(storeID).identifier
+                                  for storeID in solvedExerciseIDs(user))
+        self.assertEqual(solved(alice), set([b"first", b"second"]))
+        self.assertEqual(solved(bob), set([b"first"]))
+
+
+    def test_import(self):
+        """Exports can be imported into another store.
+
+        """
+        counts = admin.importLines(self.store, self.lines)
+        self.assertEqual(counts, {"user": 2, "exercise": 2, "solution": 3})
+        self.assertImported()
+
+
+    def test_batches(self):
+        """Imports are committed in batches.
+
+        """
+        transactions = []
+        transact = self.store.transact
+        def countingTransact(f, *args, **kwargs):
+            if self.store.transaction is None:
+                transactions.append(f)
+            return transact(f, *args, **kwargs)
+        self.patch(self.store, "transact", countingTransact)
+
+        admin.importLines(self.store, self.lines, batchSize=3)
+        self.assertEqual(len(transactions), 3)
+        self.assertImported()
+
+
+    def test_merge(self):
+        """Importing into a store that already has some of the same users,
+        exercises and solutions updates them, instead of duplicating
+        them.
+
+        """
+        admin.importLines(self.store, self.lines)
+        exercise = self.store.findUnique(Exercise,
+                                         Exercise.identifier == b"first")
+        exercise.title = u"Old title"
+
+        admin.importLines(self.store, self.lines)
+        self.assertEqual(exercise.title, u"First")
+        self.assertEqual(self.store.query(User).count(), 2)
+        self.assertEqual(self.store.query(Exercise).count(), 2)
+        self.assertEqual(self.store.query(_Solution).count(), 3)
+        self.assertImported()
+
+
+    def test_existingSolutions(self):
+        """Existing solutions are found for a whole batch at once, instead of
+        being looked up one solution at a time. Solutions that appear
+        twice are only recorded once.
+
+        """
+        def wasSolvedBy(exercise, user):
+            self.fail("solutions should not be looked up one at a time")
+        self.patch(Exercise, "wasSolvedBy", wasSolvedBy)
+
+        admin.importLines(self.store, self.lines[:5] + [self.lines[4]])
+        admin.importLines(self.store, self.lines + [self.lines[-1]])
+        self.assertEqual(self.store.query(_Solution).count(), 3)
+        self.assertImported()
+
+
+    def test_manySolvers(self):
+        """Existing solutions are found in batches that SQLite accepts.
+
+        """
+        count = batching.maxVariables + 1
+        lines = [json.dumps({"type": "exercise", "identifier": "first",
+                             "title": u"First", "description": u""})]
+        for number in range(count):
+            email = "user{0}@example.com".format(number)
+            lines.append(json.dumps({"type": "user", "email": email}))
+            lines.append(json.dumps({"type": "solution", "user": email,
+                                     "exercise": "first"}))
+
+        admin.importLines(self.store, lines, batchSize=len(lines))
+        admin.importLines(self.store, lines, batchSize=len(lines))
+        self.assertEqual(self.store.query(_Solution).count(), count)
+
+
+    def test_unknownReference(self):
+        """Solutions by users that don't exist can't be imported. The batch
+        with that solution is rolled back.
+
+        """
+        lines = self.lines + [
+            json.dumps({"type": "solution", "user": "eve@example.com",
+                        "exercise": "first"})
+        ]
+        e = self.assertRaises(ValueError, admin.importLines, self.store, lines,
+                              batchSize=5)
+        self.assertEqual(str(e), "line 8: no email 'eve@example.com'")
+        self.assertEqual(self.store.query(_Solution).count(), 1)
+
+
+    def test_badLine(self):
+        """Lines that aren't users, exercises or solutions can't be
+        imported.
+
+        """
+        for line in ["{", "{}", '{"type": "secret"}']:
+            e = self.assertRaises(ValueError, admin.importLines, self.store,
+                                  ["\n", line])
+            self.assertEqual(str(e), "line 2: not a user, exercise or "
+                                     "solution")
+
+
+
+class ProvisionTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        self.lines = ["# Course roster\n", "alice@example.com\n", "\n",
+                      "bob@example.com\n", "carol@example.com\n"]
+
+
+    def assertProvisioned(self, emails):
+        users = list(self.store.query(User, sort=User.storeID.ascending))
+        self.assertEqual([u.email for u in users], emails)
+        for user in users:
+            self.assertEqual(self.store.query(Secret, Secret.user == user)
+                             .count(), 1)
+
+
+    def test_provision(self):
+        """Users are provisioned with a secret for every e-mail address.
+
+        """
+        counts = admin.provision(self.store, self.lines)
+        self.assertEqual(counts, {"email": 3, "user": 3, "secret": 3})
+        self.assertProvisioned([b"alice@example.com", b"bob@example.com",
+                                b"carol@example.com"])
+
+
+    def test_batches(self):
+        """Users are provisioned in batches, one transaction per batch.
+
+        """
+        transactions = []
+        transact = self.store.transact
+        def countingTransact(f, *args, **kwargs):
+            if self.store.transaction is None:
+                transactions.append(f)
+            return transact(f, *args, **kwargs)
+        self.patch(self.store, "transact", countingTransact)
+
+        admin.provision(self.store, self.lines, batchSize=2)
+        self.assertEqual(len(transactions), 3)
+
+
+    def test_largeBatches(self):
+        """Batches can have more e-mail addresses than SQLite allows
+        variables in one query, since they're looked up in smaller
+        batches.
+
+        """
+        lines = ["user{0}@example.com\n".format(n) for n in range(1200)]
+        counts = admin.provision(self.store, lines, batchSize=1200)
+        self.assertEqual(counts, {"email": 1200, "user": 1200, "secret": 1200})
+
+        counts = admin.provision(self.store, lines, batchSize=1200)
+        self.assertEqual(counts, {"email": 1200, "user": 0, "secret": 0})
+
+
+    def test_existing(self):
+        """Existing users get a secret if they don't have one yet. Existing
+        secrets, and addresses that appear twice, are left alone.
+
+        """
+        alice = User(store=self.store, email=b"alice@example.com")
+        bob = User(store=self.store, email=b"bob@example.com")
+        secret = Secret(store=self.store, user=bob)
+
+        lines = self.lines + ["alice@example.com\n"]
+        counts = admin.provision(self.store, lines)
+        self.assertEqual(counts, {"email": 4, "user": 1, "secret": 2})
+        self.assertProvisioned([b"alice@example.com", b"bob@example.com",
+                                b"carol@example.com"])
+        self.assertIdentical(Secret.forUser(bob), secret)
+        self.assertEqual(Secret.forUser(alice).user, alice)
+
+
+    def test_readOnlyAfterwards(self):
+        """Once provisioned, finding a user's secret doesn't start a
+        transaction.
+
+        """
+        admin.provision(self.store, self.lines)
+        user = self.store.findUnique(User, User.email == b"bob@example.com")
+
+        def transact(f, *args, **kwargs):
+            self.fail("should not write")
+        self.patch(self.store, "transact", transact)
+        self.assertEqual(Secret.forUser(user).user, user)
+
+
+    def test_badLine(self):
+        """Lines that aren't e-mail addresses can't be provisioned. The batch
+        with that line is rolled back.
+
+        """
+        lines = self.lines + ["nobody\n"]
+        e = self.assertRaises(ValueError, admin.provision, self.store, lines,
+                              batchSize=4)
+        self.assertEqual(str(e), "line 6: not an e-mail address")
+        self.assertProvisioned([b"alice@example.com", b"bob@example.com"])
+
+
+
+class RunTests(SynchronousTestCase):
+    def setUp(self):
+        self.path = self.mktemp()
+        populate(Store(self.path))
+        self.stdout, self.stderr = StringIO(), StringIO()
+
+
+    def runTool(self, *argv, **kwargs):
+        return admin.run(list(argv), stdout=self.stdout, stderr=self.stderr,
+                         **kwargs)
+
+
+    def test_exportImport(self):
+        """The tool exports to stdout, and imports from stdin.
+
+        """
+        self.assertEqual(self.runTool("--store", self.path, "export"), 0)
+        exported = self.stdout.getvalue()
+
+        path = self.mktemp()
+        stdin = StringIO(exported)
+        self.assertEqual(self.runTool("--store", path, "import", stdin=stdin), 0)
+        self.assertEqual(self.stderr.getvalue(), "Imported 2 users, "
+                         "2 exercises and 3 solutions.\n")
+        self.assertEqual(exportLines(Store(path)), exported.splitlines(True))
+
+
+    def test_files(self):
+        """The tool can export to and import from files.
+
+        """
+        exportPath = self.mktemp()
+        self.runTool("--store", self.path, "export", "--output", exportPath)
+        path = self.mktemp()
+        self.runTool("--store", path, "import", exportPath)
+
+        with open(exportPath) as f:
+            self.assertEqual(exportLines(Store(path)), f.readlines())
+
+
+    def test_importFails(self):
+        """When an import fails, the tool says why, and fails.
+
+        """
+        stdin = StringIO("{}\n")
+        path = self.mktemp()
+        self.assertEqual(self.runTool("--store", path, "import", stdin=stdin), 1)
+        self.assertEqual(self.stderr.getvalue(),
+                         "line 1: not a user, exercise or solution\n")
+
+
+    def test_provision(self):
+        """The tool provisions users from a roster on stdin, and reports how
+        fast it did.
+
+        """
+        stdin = StringIO("alice@example.com\ndave@example.com\n")
+        self.assertEqual(self.runTool("--store", self.path, "provision",
+                                      stdin=stdin), 0)
+        report = self.stderr.getvalue().splitlines()
+        self.assertEqual(report[0], "Provisioned 2 e-mail addresses: 1 new "
+                                    "users and 2 new secrets.")
+        self.assertTrue(report[1].startswith("Inserted 3 items in "))
+
+
+    def test_usage(self):
+        """The tool needs a store and a command.
+
+        """
+        self.assertEqual(self.runTool("export"), 2)
+        self.assertIn("Passing a root store is mandatory.",
+                      self.stderr.getvalue())
+        self.assertEqual(self.runTool("--store", self.path), 2)
+        self.assertIn("Passing a command is mandatory.",
+                      self.stderr.getvalue())
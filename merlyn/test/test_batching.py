@@ -0,0 +1,19 @@
+from merlyn.batching import inBatches, maxVariables
+from twisted.trial.unittest import SynchronousTestCase
+
+
+class InBatchesTests(SynchronousTestCase):
+    def test_batches(self):
+        """Items are split into lists of at most the given size, in order.
+
+        """
+        self.assertEqual(list(inBatches(xrange(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(inBatches([], 2)), [])
+
+
+    def test_defaultSize(self):
+        """By default, batches are as large as SQLite allows.
+
+        """
+        batches = list(inBatches(xrange(maxVariables + 1)))
+        self.assertEqual(map(len, batches), [maxVariables, 1])
@@ -0,0 +1,140 @@
+import gc
+import weakref
+
+from axiom.store import Store
+from merlyn.cache import LRUCache, forStore
+from merlyn.exercise import getCatalog
+from twisted.trial.unittest import SynchronousTestCase
+
+
+class LRUCacheTests(SynchronousTestCase):
+    def setUp(self):
+        self.cache = LRUCache(2)
+
+
+    def test_get(self):
+        """Values can be retrieved by key; missing keys produce the default.
+
+        """
+        self.cache["a"] = 1
+        self.assertEqual(self.cache.get("a"), 1)
+        self.assertIdentical(self.cache.get("b"), None)
+        self.assertEqual(self.cache.get("b", 2), 2)
+
+
+    def test_items(self):
+        """The cached items can be listed, from least to most recently used,
+        without changing that order.
+
+        """
+        self.cache["a"] = 1
+        self.cache["b"] = 2
+        self.cache.get("a")
+        self.assertEqual(self.cache.items(), [("b", 2), ("a", 1)])
+        self.cache["c"] = 3
+        self.assertEqual(self.cache.items(), [("a", 1), ("c", 3)])
+
+
+    def test_counters(self):
+        """The cache counts hits and misses.
+
+        """
+        self.cache["a"] = 1
+        self.cache.get("a")
+        self.cache.get("a")
+        self.cache.get("b")
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+
+    def test_bounded(self):
+        """When the cache is full, the least recently used entry is
+        forgotten.
+
+        """
+        self.cache["a"] = 1
+        self.cache["b"] = 2
+        self.cache.get("a")
+        self.cache["c"] = 3
+
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn("a", self.cache)
+        self.assertNotIn("b", self.cache)
+        self.assertIn("c", self.cache)
+
+
+    def test_replace(self):
+        """Setting an existing key replaces its value, without growing the
+        cache.
+
+        """
+        self.cache["a"] = 1
+        self.cache["a"] = 2
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.cache.get("a"), 2)
+
+
+    def test_discard(self):
+        """Keys can be discarded. Discarding a missing key does nothing.
+
+        """
+        self.cache["a"] = 1
+        self.cache.discard("a")
+        self.cache.discard("b")
+        self.assertNotIn("a", self.cache)
+
+
+    def test_discardValue(self):
+        """All keys with a particular value can be discarded.
+
+        """
+        value, otherValue = object(), object()
+        self.cache = LRUCache(3)
+        self.cache["a"] = value
+        self.cache["b"] = otherValue
+        self.cache["c"] = value
+
+        self.cache.discardValue(value)
+        self.assertEqual(len(self.cache), 1)
+        self.assertIn("b", self.cache)
+
+
+    def test_clear(self):
+        """The cache can be cleared.
+
+        """
+        self.cache["a"] = 1
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+
+class ForStoreTests(SynchronousTestCase):
+    def test_perStore(self):
+        """There is one object of each name per store, made the first time
+        it is needed.
+
+        """
+        store = Store()
+        made = []
+        def factory(store):
+            made.append(store)
+            return object()
+
+        value = forStore(store, "thing", factory)
+        self.assertIdentical(forStore(store, "thing", factory), value)
+        self.assertEqual(made, [store])
+        self.assertNotIdentical(forStore(store, "other", factory), value)
+        self.assertNotIdentical(forStore(Store(), "thing", factory), value)
+
+
+    def test_storeCollected(self):
+        """Stores whose caches have been used can still be garbage
+        collected.
+
+        """
+        store = Store()
+        getCatalog(store)
+        ref = weakref.ref(store)
+        del store
+        gc.collect()
+        self.assertIdentical(ref(), None)
@@ -3,9 +3,14 @@ import os
 from axiom.store import Store
 from clarent.exercise import GetExercises, GetExerciseDetails
 from clarent.exercise import UnknownExercise, NotifySolved
-from merlyn.exercise import Exercise, Locator, solveAndNotify
-from merlyn.exercise import SolvableResourceMixin, Secret
+from merlyn import exercise
+from merlyn.exercise import Exercise, Locator, solveAndNotify, _Solution
+from merlyn.exercise import SolvableResourceMixin, Secret, solvedExerciseIDs
+from merlyn.exercise import Catalog, getCatalog, GetExercisesPage, GetChanges
 from merlyn.auth import User
+from merlyn.writequeue import WriteQueue
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
 from twisted.trial.unittest import SynchronousTestCase
 from txampext.respondertests import ResponderTestMixin
 
@@ -43,6 +48,315 @@ class ExerciseTests(SynchronousTestCase):
         self.assertFalse(exercise.wasSolvedBy(someOtherUser))
 
 
+    def test_solvedExerciseIDs(self):
+        """The store IDs of all the exercises solved by a user can be
+        retrieved at once.
+
+        """
+        store = Store()
+        one = makeExercise(store=store, identifier=b"1")
+        two = makeExercise(store=store, identifier=b"2")
+        makeExercise(store=store, identifier=b"3")
+
+        someUser = User(store=store, email="foo@example.com")
+        self.assertEqual(solvedExerciseIDs(someUser), set())
+
+        one.solvedBy(someUser)
+        two.solvedBy(someUser)
+        self.assertEqual(solvedExerciseIDs(someUser),
+                         set([one.storeID, two.storeID]))
+
+        someOtherUser = User(store=store, email="bar@example.com")
+        self.assertEqual(solvedExerciseIDs(someOtherUser), set())
+
+
+
+class CatalogTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        self.one = makeExercise(store=self.store, identifier=b"1")
+        self.two = makeExercise(store=self.store, identifier=b"2")
+        self.catalog = Catalog(self.store)
+
+
+    def test_getCatalog(self):
+        """There is one catalog per store.
+
+        """
+        catalog = getCatalog(self.store)
+        self.assertTrue(isinstance(catalog, Catalog))
+        self.assertIdentical(catalog.store, self.store)
+        self.assertIdentical(getCatalog(self.store), catalog)
+        self.assertNotIdentical(getCatalog(Store()), catalog)
+
+
+    def test_iterate(self):
+        """Iterating over the catalog produces all exercises, in the order in
+        which they were added.
+
+        """
+        self.assertEqual(list(self.catalog), [self.one, self.two])
+        self.assertEqual(len(self.catalog), 2)
+
+
+    def test_getItem(self):
+        """Exercises can be found by identifier.
+
+        """
+        self.assertIdentical(self.catalog[b"1"], self.one)
+        self.assertIdentical(self.catalog[b"2"], self.two)
+
+
+    def test_getMissing(self):
+        """Looking up a missing exercise raises ``KeyError``.
+
+        """
+        self.assertRaises(KeyError, lambda: self.catalog[b"BOGUS"])
+
+
+    def test_loadedOnce(self):
+        """Exercises are only loaded from the store once.
+
+        """
+        list(self.catalog)
+
+        def query(*args, **kwargs):
+            self.fail("exercises should not be loaded again")
+        self.patch(self.store, "query", query)
+
+        self.assertEqual(list(self.catalog), [self.one, self.two])
+        self.assertIdentical(self.catalog[b"1"], self.one)
+
+
+    def test_invalidate(self):
+        """When invalidated, exercises are loaded from the store again.
+
+        """
+        list(self.catalog)
+
+        calls = []
+        query = self.store.query
+        def countingQuery(*args, **kwargs):
+            calls.append(args)
+            return query(*args, **kwargs)
+        self.patch(self.store, "query", countingQuery)
+
+        self.catalog.invalidate()
+        self.assertEqual(list(self.catalog), [self.one, self.two])
+        self.assertEqual(calls, [(Exercise,)])
+
+
+    def test_exerciseAdded(self):
+        """Adding an exercise updates the store's catalog.
+
+        """
+        catalog = getCatalog(self.store)
+        self.assertEqual(len(catalog), 2)
+
+        three = makeExercise(store=self.store, identifier=b"3")
+        self.assertEqual(list(catalog), [self.one, self.two, three])
+
+
+    def test_exerciseChanged(self):
+        """Changing an exercise's identifier updates the store's catalog.
+
+        """
+        catalog = getCatalog(self.store)
+        self.assertIdentical(catalog[b"1"], self.one)
+
+        self.one.identifier = b"one"
+        self.assertIdentical(catalog[b"one"], self.one)
+        self.assertRaises(KeyError, lambda: catalog[b"1"])
+
+
+    def test_exerciseDeleted(self):
+        """Deleting an exercise updates the store's catalog.
+
+        """
+        catalog = getCatalog(self.store)
+        self.assertEqual(len(catalog), 2)
+
+        self.one.deleteFromStore()
+        self.assertEqual(list(catalog), [self.two])
+
+
+    def test_after(self):
+        """The catalog can iterate over the exercises added after a given
+        one, even if that one has since been deleted.
+
+        """
+        three = makeExercise(store=self.store, identifier=b"3")
+        self.assertEqual(list(self.catalog.after(0)),
+                         [self.one, self.two, three])
+        self.assertEqual(list(self.catalog.after(self.one.storeID)),
+                         [self.two, three])
+
+        self.two.deleteFromStore()
+        self.catalog.invalidate()
+        self.assertEqual(list(self.catalog.after(self.two.storeID)), [three])
+        self.assertEqual(list(self.catalog.after(three.storeID)), [])
+
+
+
+class VersionTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        self.exercise = makeExercise(store=self.store)
+        self.user = User(store=self.store, email=b"x@y.z")
+
+
+    def test_added(self):
+        """Added exercises and solutions get increasing versions.
+
+        """
+        first = self.exercise.version
+        self.exercise.solvedBy(self.user)
+        solution = self.store.findUnique(_Solution)
+        second = makeExercise(store=self.store, identifier=b"2")
+        self.assertTrue(0 < first < solution.version < second.version)
+        self.assertEqual(exercise._latestVersion(self.store), second.version)
+
+
+    def test_changed(self):
+        """Changing an exercise gives it a new version. Setting an attribute
+        to the value it already has doesn't.
+
+        """
+        before = self.exercise.version
+        self.exercise.title = self.exercise.title
+        self.assertEqual(self.exercise.version, before)
+
+        self.exercise.title = u"New title"
+        self.assertTrue(self.exercise.version > before)
+
+
+    def test_transaction(self):
+        """Versions are given out in transactions too.
+
+        """
+        def addExercises():
+            one = makeExercise(store=self.store, identifier=b"1")
+            two = makeExercise(store=self.store, identifier=b"2")
+            two.description = u"New description"
+            return one, two
+
+        one, two = self.store.transact(addExercises)
+        self.assertTrue(self.exercise.version < one.version < two.version)
+        self.assertEqual(exercise._latestVersion(self.store), two.version)
+
+
+    def test_committedWithVersion(self):
+        """Solutions and changes to exercises are committed together with
+        their versions, not before them.
+
+        """
+        path = self.mktemp()
+        store = Store(path)
+        ex = makeExercise(store=store)
+        user = User(store=store, email=b"x@y.z")
+        ex.solvedBy(user)
+
+        otherStore = Store(path)
+        def countCommitted():
+            return (
+                otherStore.query(_Solution).count(),
+                otherStore.query(Exercise, Exercise.title == u"New").count()
+            )
+        countCommitted()
+
+        committed = []
+        nextVersion = exercise._nextVersion
+        def _nextVersion(store):
+            committed.append(countCommitted())
+            return nextVersion(store)
+        self.patch(exercise, "_nextVersion", _nextVersion)
+
+        ex.solvedBy(user)
+        ex.title = u"New"
+        self.assertEqual(committed, [(1, 0), (2, 0)])
+
+
+    def test_deleted(self):
+        """Versions aren't given out again when the latest change is
+        deleted.
+
+        """
+        version = self.exercise.version
+        self.exercise.deleteFromStore()
+        other = makeExercise(store=self.store, identifier=b"2")
+        self.assertTrue(other.version > version)
+
+
+    def test_sharedStore(self):
+        """Processes sharing a store never give out the same version, even
+        though each of them has the counter cached.
+
+        """
+        path = self.mktemp()
+        stores = [Store(path), Store(path)]
+        versions = []
+        for identifier in [b"1", b"2", b"3"]:
+            for store in stores:
+                exercise = makeExercise(store=store, identifier=identifier)
+                versions.append(exercise.version)
+        self.assertEqual(versions, range(1, 7))
+
+
+
+class ChangeListenerTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        self.calls = []
+        exercise.addChangeListener(self.store, self.listener)
+
+
+    def listener(self):
+        self.calls.append(None)
+
+
+    def test_exercises(self):
+        """Listeners are notified when exercises are added or changed.
+
+        """
+        ex = makeExercise(store=self.store)
+        self.assertTrue(self.calls)
+
+        del self.calls[:]
+        ex.title = u"New title"
+        self.assertTrue(self.calls)
+
+
+    def test_solutions(self):
+        """Listeners are notified when solutions are recorded.
+
+        """
+        ex = makeExercise(store=self.store)
+        user = User(store=self.store, email=b"x@y.z")
+        del self.calls[:]
+        ex.solvedBy(user)
+        self.assertTrue(self.calls)
+
+
+    def test_remove(self):
+        """Removed listeners are no longer notified.
+
+        """
+        exercise.removeChangeListener(self.store, self.listener)
+        makeExercise(store=self.store)
+        self.assertEqual(self.calls, [])
+
+
+
+class SolutionTests(SynchronousTestCase):
+    def test_indexed(self):
+        """Solutions are indexed by who solved what.
+
+        """
+        index = (_Solution.who, _Solution.what)
+        self.assertIn(index, _Solution.who.compoundIndexes)
+        self.assertIn(index, _Solution.what.compoundIndexes)
+
+
 
 class SolveAndNotifyTests(SynchronousTestCase):
     def setUp(self):
@@ -96,8 +410,72 @@ class SolveAndNotifyTests(SynchronousTestCase):
         self.assertTrue(self.wasNotified())
 
 
+    def test_writeQueue(self):
+        """When the protocol has a write queue, the solution is written
+        through it, and the user is only notified once it has been
+        committed.
 
-class FakeProto(object):
+        """
+        self.proto.writeQueue = queue = WriteQueue(self.store,
+                                                   reactor=Clock())
+        d = solveAndNotify(self.proto, self.exercise)
+        self.assertNoResult(d)
+        self.assertFalse(self.wasSolved())
+        self.assertFalse(self.wasNotified())
+
+        queue.flush()
+        self.assertTrue(self.successResultOf(d))
+        self.assertTrue(self.wasSolved())
+        self.assertTrue(self.wasNotified())
+
+
+    def test_failedWrite(self):
+        """If the solution can't be written, the failure is logged, the user
+        isn't notified, and the Deferred fires with ``False``.
+
+        """
+        self.proto.writeQueue = queue = WriteQueue(self.store,
+                                                   reactor=Clock())
+        def solvedBy(exercise, user):
+            raise RuntimeError("write failed")
+        self.patch(Exercise, "solvedBy", solvedBy)
+
+        d = solveAndNotify(self.proto, self.exercise)
+        queue.flush()
+        self.assertFalse(self.successResultOf(d))
+        self.assertEqual(len(self.flushLoggedErrors(RuntimeError)), 1)
+        self.assertFalse(self.wasNotified())
+
+
+    def test_writeThrough(self):
+        """Solving an exercise updates the protocol's cached solved
+        exercises, without fetching them from the store again.
+
+        """
+        self.assertEqual(self.proto.solvedIDs, set())
+
+        def solvedExerciseIDs(user):
+            self.fail("solved exercises should not be fetched again")
+        self.patch(exercise, "solvedExerciseIDs", solvedExerciseIDs)
+
+        solveAndNotify(self.proto, self.exercise)
+        self.assertEqual(self.proto.solvedIDs, set([self.exercise.storeID]))
+
+
+    def test_writeThroughWithoutCache(self):
+        """Solving an exercise when the solved exercises haven't been fetched
+        yet doesn't fetch them.
+
+        """
+        def solvedExerciseIDs(user):
+            self.fail("solved exercises should not be fetched yet")
+        self.patch(exercise, "solvedExerciseIDs", solvedExerciseIDs)
+
+        solveAndNotify(self.proto, self.exercise)
+
+
+
+class FakeProto(Locator):
     def __init__(self, store, user):
         self.store = store
         self.user = user
@@ -166,6 +544,383 @@ class GetExercisesTests(_LocatorTests, SynchronousTestCase):
         ])
 
 
+    def test_solvedCached(self):
+        """The user's solved exercises are only fetched once.
+
+        """
+        calls = []
+        def solvedExerciseIDs(user):
+            calls.append(user)
+            return set()
+        self.patch(exercise, "solvedExerciseIDs", solvedExerciseIDs)
+
+        self.locator.getExercises(solved=True)
+        self.locator.getExercises(solved=False)
+        self.locator.getExerciseDetails(identifier=b"1")
+        self.assertEqual(calls, [self.locator.user])
+
+
+    def test_invalidateSolved(self):
+        """When the solved exercises are invalidated, they are fetched again,
+        picking up solutions that were recorded elsewhere.
+
+        """
+        self.locator.getExercises(solved=True)
+
+        two = self.locator._getExercise(b"2")
+        two.solvedBy(self.locator.user)
+        response = self.locator.getExercises(solved=True)
+        self.assertEqual(len(response["exercises"]), 1)
+
+        self.locator.invalidateSolved()
+        response = self.locator.getExercises(solved=True)
+        self.assertEqual(len(response["exercises"]), 2)
+
+
+    def test_doesNotAskEveryExercise(self):
+        """Getting exercises does not check every exercise individually.
+
+        """
+        def wasSolvedBy(exercise, user):
+            self.fail("wasSolvedBy should not be called")
+        self.patch(Exercise, "wasSolvedBy", wasSolvedBy)
+
+        self.locator.getExercises(solved=True)
+        self.locator.getExercises(solved=False)
+
+
+
+class GetExercisesPageTests(_LocatorTests, SynchronousTestCase):
+    def getIdentifiers(self, response):
+        return [e[b"identifier"] for e in response["exercises"]]
+
+
+    def test_onePage(self):
+        """When all exercises fit on one page, there is no next page.
+
+        """
+        response = self.locator.getExercisesPage(solved=False)
+        self.assertEqual(response["exercises"], [
+            {b"title": u"Exercise 2", b"identifier": b"2"},
+            {b"title": u"Exercise 3", b"identifier": b"3"}
+        ])
+        self.assertIdentical(response["next"], None)
+
+
+    def test_pages(self):
+        """Pages have at most ``limit`` exercises. The next page starts
+        after the given exercise.
+
+        """
+        makeExercise(store=self.locator.store, identifier=b"4")
+        response = self.locator.getExercisesPage(solved=False, limit=2)
+        self.assertEqual(self.getIdentifiers(response), [b"2", b"3"])
+
+        response = self.locator.getExercisesPage(
+            solved=False, after=response["next"], limit=2)
+        self.assertEqual(self.getIdentifiers(response), [b"4"])
+        self.assertIdentical(response["next"], None)
+
+
+    def test_exactlyFull(self):
+        """When the last page is exactly full, there is no next page.
+
+        """
+        response = self.locator.getExercisesPage(solved=False, limit=2)
+        self.assertIdentical(response["next"], None)
+
+
+    def test_solved(self):
+        """Solved exercises can be paged through too.
+
+        """
+        response = self.locator.getExercisesPage(solved=True, limit=1)
+        self.assertEqual(self.getIdentifiers(response), [b"1"])
+        self.assertIdentical(response["next"], None)
+
+
+    def test_maxPageSize(self):
+        """Pages never have more than ``maxPageSize`` exercises.
+
+        """
+        self.patch(exercise, "maxPageSize", 1)
+        response = self.locator.getExercisesPage(solved=False, limit=10)
+        self.assertEqual(self.getIdentifiers(response), [b"2"])
+        self.assertNotIdentical(response["next"], None)
+
+
+    def test_limitTooSmall(self):
+        """Limits below 1 are taken to be 1.
+
+        """
+        for limit in 0, -1:
+            response = self.locator.getExercisesPage(solved=False,
+                                                     limit=limit)
+            self.assertEqual(self.getIdentifiers(response), [b"2"])
+            self.assertNotIdentical(response["next"], None)
+
+
+    def test_maxPageBytes(self):
+        """Pages are cut short when the response would get too big, but
+        always have at least one exercise.
+
+        """
+        self.patch(exercise, "maxPageBytes", 1)
+        response = self.locator.getExercisesPage(solved=False)
+        self.assertEqual(self.getIdentifiers(response), [b"2"])
+
+        response = self.locator.getExercisesPage(solved=False,
+                                                 after=response["next"])
+        self.assertEqual(self.getIdentifiers(response), [b"3"])
+        self.assertIdentical(response["next"], None)
+
+
+    def test_lazy(self):
+        """Only one exercise more than fits on the page is looked at.
+
+        """
+        store = self.locator.store
+        for i in xrange(4, 10):
+            makeExercise(store=store, identifier=str(i))
+
+        looked = []
+        getExercises = self.locator._getExercises
+        def _getExercises(*args):
+            for ex in getExercises(*args):
+                looked.append(ex.identifier)
+                yield ex
+        self.patch(self.locator, "_getExercises", _getExercises)
+
+        self.locator.getExercisesPage(solved=False, limit=2)
+        self.assertEqual(looked, [b"2", b"3", b"4"])
+
+
+
+class GetChangesTests(_LocatorTests, SynchronousTestCase):
+    def setUp(self):
+        _LocatorTests.setUp(self)
+        self.version = exercise._latestVersion(self.locator.store)
+
+
+    def getChanges(self, since, limit=None):
+        response = self.locator.getChanges(since=since, limit=limit)
+        changes = [(e[b"identifier"], e[b"solved"])
+                   for e in response["exercises"]]
+        return changes, response["version"], response["more"]
+
+
+    def test_everything(self):
+        """Since version 0, every exercise has changed.
+
+        """
+        response = self.locator.getChanges(since=0)
+        self.assertEqual(response, {
+            "exercises": [
+                {b"identifier": b"1", b"title": u"Exercise 1", b"solved": True},
+                {b"identifier": b"2", b"title": u"Exercise 2",
+                 b"solved": False},
+                {b"identifier": b"3", b"title": u"Exercise 3", b"solved": False}
+            ],
+            "version": self.version,
+            "more": False
+        })
+
+
+    def test_nothing(self):
+        """When nothing changed, there are no changes.
+
+        """
+        self.assertEqual(self.getChanges(self.version),
+                         ([], self.version, False))
+
+
+    def test_changes(self):
+        """New and changed exercises and new solutions are changes.
+
+        """
+        store, user = self.locator.store, self.locator.user
+        self.locator._getExercise(b"2").title = u"New title"
+        makeExercise(store=store, identifier=b"4")
+        self.locator._getExercise(b"3").solvedBy(user)
+        self.locator.invalidateSolved()
+
+        changes, version, more = self.getChanges(self.version)
+        self.assertEqual(changes, [(b"2", False), (b"4", False), (b"3", True)])
+        self.assertEqual(version, exercise._latestVersion(store))
+        self.assertFalse(more)
+
+
+    def test_otherUsers(self):
+        """Other users' solutions are not changes, but the version they got
+        is skipped.
+
+        """
+        store = self.locator.store
+        other = User(store=store, email=b"other@y.z")
+        self.locator._getExercise(b"2").solvedBy(other)
+
+        changes, version, _more = self.getChanges(self.version)
+        self.assertEqual(changes, [])
+        self.assertEqual(version, exercise._latestVersion(store))
+
+
+    def test_once(self):
+        """Exercises that changed and were solved are only sent once, as
+        solved.
+
+        """
+        two = self.locator._getExercise(b"2")
+        two.title = u"New title"
+        two.solvedBy(self.locator.user)
+
+        changes, _version, _more = self.getChanges(self.version)
+        self.assertEqual(changes, [(b"2", True)])
+
+
+    def test_pages(self):
+        """Changes are sent a page at a time. The version of the last change
+        on a page is where the next page starts.
+
+        """
+        changes, version, more = self.getChanges(0, limit=2)
+        self.assertEqual(changes, [(b"1", True), (b"2", False)])
+        self.assertTrue(more)
+
+        changes, version, more = self.getChanges(version, limit=2)
+        self.assertEqual(changes, [(b"3", False)])
+        self.assertEqual(version, self.version)
+        self.assertFalse(more)
+
+
+    def test_repeatedSolutions(self):
+        """When the user solved an exercise several times, the changes after
+        those solutions still get sent, on later pages if need be.
+
+        """
+        user = self.locator.user
+        for _ in range(3):
+            self.locator._getExercise(b"2").solvedBy(user)
+        self.locator._getExercise(b"3").solvedBy(user)
+        self.locator.invalidateSolved()
+
+        seen, version, more = [], self.version, True
+        while more:
+            changes, newVersion, more = self.getChanges(version, limit=1)
+            self.assertTrue(newVersion > version)
+            seen.extend(changes)
+            version = newVersion
+
+        self.assertEqual(version, exercise._latestVersion(self.locator.store))
+        self.assertEqual(sorted(set(seen)), [(b"2", True), (b"3", True)])
+
+
+    def test_limitTooSmall(self):
+        """Limits below 1 are taken to be 1.
+
+        """
+        for limit in 0, -1:
+            changes, _version, more = self.getChanges(0, limit=limit)
+            self.assertEqual(changes, [(b"1", True)])
+            self.assertTrue(more)
+
+
+    def test_maxPageBytes(self):
+        """Pages are cut short when the response would get too big.
+
+        """
+        self.patch(exercise, "maxPageBytes", 1)
+        changes, _version, more = self.getChanges(0)
+        self.assertEqual(changes, [(b"1", True)])
+        self.assertTrue(more)
+
+
+    def test_latestFirst(self):
+        """Changes made after the latest version was read are left for the
+        next time.
+
+        """
+        latestVersion = exercise._latestVersion
+        def _latestVersion(store):
+            version = latestVersion(store)
+            self.patch(exercise, "_latestVersion", latestVersion)
+            makeExercise(store=store, identifier=b"4")
+            return version
+        self.patch(exercise, "_latestVersion", _latestVersion)
+
+        changes, version, _more = self.getChanges(self.version)
+        self.assertEqual((changes, version), ([], self.version))
+
+
+
+class ChangesSinceTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        self.exercise = makeExercise(store=self.store)
+        self.user = User(store=self.store, email=b"user@example.com")
+        self.version = exercise._latestVersion(self.store)
+
+
+    def test_changes(self):
+        """Changed exercises, and solutions by the given users, are found
+        as summaries, in order of version.
+
+        """
+        other = User(store=self.store, email=b"other@example.com")
+        self.exercise.solvedBy(other)
+        self.exercise.solvedBy(self.user)
+        new = makeExercise(store=self.store, identifier=b"new")
+
+        latest, exercises, solutions = exercise._changesSince(
+            self.store, self.version, [self.user.storeID])
+        self.assertEqual(latest, exercise._latestVersion(self.store))
+        summary = exercise._ExerciseSummary(
+            new.storeID, new.identifier, new.title)
+        self.assertEqual(exercises, [(new.version, summary)])
+        version, = self.store.query(_Solution, _Solution.who == self.user
+                                    ).getColumn("version")
+        summary = exercise._ExerciseSummary(
+            self.exercise.storeID, self.exercise.identifier,
+            self.exercise.title)
+        self.assertEqual(solutions, [(version, self.user.storeID, summary)])
+
+
+    def test_noChanges(self):
+        """If nothing changed, nothing is found.
+
+        """
+        changes = exercise._changesSince(
+            self.store, self.version, [self.user.storeID])
+        self.assertEqual(changes, (self.version, [], []))
+
+
+    def test_manyUsers(self):
+        """Solutions by more users than SQLite allows variables in one query
+        are found.
+
+        """
+        users = [User(store=self.store, email=b"%d@example.com" % i)
+                 for i in xrange(1000)]
+        for user in users:
+            self.exercise.solvedBy(user)
+
+        _latest, _exercises, solutions = exercise._changesSince(
+            self.store, self.version, [user.storeID for user in users])
+        self.assertEqual([userID for _v, userID, _e in solutions],
+                         [user.storeID for user in users])
+
+
+
+class EncodedSizeTests(SynchronousTestCase):
+    def test_encodedSize(self):
+        """The estimated size of an entry is the size of its AMP box.
+
+        """
+        entry = {b"title": u"\N{SNOWMAN}", b"identifier": b"1"}
+        argument = GetExercisesPage.response[0][1]
+        encoded = argument.toStringProto([entry], None)
+        self.assertEqual(exercise._encodedSize(entry), len(encoded))
+
+
 
 class GetExerciseDetailsTests(_LocatorTests, SynchronousTestCase):
     def test_getSolvedExerciseDetails(self):
@@ -204,6 +959,148 @@ class GetExerciseDetailsTests(_LocatorTests, SynchronousTestCase):
 
 
 
+class FakeStoreThread(object):
+    """A fake store thread, which runs functions whenever the test wants.
+
+    """
+    def __init__(self, store):
+        self.store = store
+        self.pending = []
+
+
+    def run(self, f, *args, **kwargs):
+        d = Deferred()
+        self.pending.append((d, f, args, kwargs))
+        return d
+
+
+    def runPending(self, replacement=None):
+        """Runs all pending functions, or the given replacement instead.
+
+        """
+        pending, self.pending = self.pending, []
+        for d, f, args, kwargs in pending:
+            f = replacement or f
+            try:
+                result = f(self.store, *args, **kwargs)
+            except Exception:
+                d.errback()
+            else:
+                d.callback(result)
+
+
+
+class StoreThreadLocatorTests(_LocatorTests, SynchronousTestCase):
+    def setUp(self):
+        _LocatorTests.setUp(self)
+        self.locator.storeThread = FakeStoreThread(self.locator.store)
+
+
+    def test_getExercises(self):
+        """The solved exercises are fetched in the store thread, and the
+        response is returned in a Deferred.
+
+        """
+        d = self.locator.getExercises(solved=True)
+        self.assertNoResult(d)
+
+        self.locator.storeThread.runPending()
+        response = self.successResultOf(d)
+        self.assertEqual(response["exercises"], [
+            {b"title": u"Exercise 1", b"identifier": b"1"},
+        ])
+
+
+    def test_getChanges(self):
+        """Changes are found in the store thread, and then the solved
+        exercises are fetched in it. The response is returned in a
+        Deferred.
+
+        """
+        d = self.locator.getChanges(since=0)
+        self.assertEqual(len(self.locator.storeThread.pending), 1)
+        self.locator.storeThread.runPending()
+        self.assertNoResult(d)
+
+        self.locator.storeThread.runPending()
+        response = self.successResultOf(d)
+        self.assertEqual([(e[b"identifier"], e[b"solved"])
+                          for e in response["exercises"]],
+                         [(b"1", True), (b"2", False), (b"3", False)])
+        self.assertEqual(response["version"],
+                         exercise._latestVersion(self.locator.store))
+
+
+    def test_getExerciseDetails(self):
+        """The solved exercises are fetched in the store thread, and the
+        details are returned in a Deferred.
+
+        """
+        d = self.locator.getExerciseDetails(identifier=b"1")
+        self.assertNoResult(d)
+
+        self.locator.storeThread.runPending()
+        self.assertTrue(self.successResultOf(d)[b"solved"])
+
+
+    def test_cached(self):
+        """Once the solved exercises have been fetched, responses are
+        returned right away.
+
+        """
+        self.locator.getExercises(solved=True)
+        self.locator.storeThread.runPending()
+
+        details = self.locator.getExerciseDetails(identifier=b"1")
+        self.assertTrue(details[b"solved"])
+        self.assertEqual(self.locator.storeThread.pending, [])
+
+
+    def test_concurrent(self):
+        """Concurrent requests share a single fetch.
+
+        """
+        first = self.locator.getExercises(solved=True)
+        second = self.locator.getExercises(solved=False)
+        self.assertEqual(len(self.locator.storeThread.pending), 1)
+
+        self.locator.storeThread.runPending()
+        self.assertEqual(len(self.successResultOf(first)["exercises"]), 1)
+        self.assertEqual(len(self.successResultOf(second)["exercises"]), 2)
+
+
+    def test_solvedDuringFetch(self):
+        """Exercises that are solved while the solved exercises are being
+        fetched are included.
+
+        """
+        d = self.locator.getExercises(solved=True)
+
+        two = self.locator._getExercise(b"2")
+        self.locator.exerciseSolved(two)
+
+        self.locator.storeThread.runPending(lambda store, userID: set())
+        response = self.successResultOf(d)
+        self.assertEqual(response["exercises"], [
+            {b"title": u"Exercise 2", b"identifier": b"2"},
+        ])
+
+
+    def test_fetchFailed(self):
+        """When fetching the solved exercises fails, so do the responses
+        waiting for them, and the next request tries again.
+
+        """
+        d = self.locator.getExercises(solved=True)
+        self.locator.storeThread.runPending(lambda store, userID: 1 // 0)
+        self.failureResultOf(d, ZeroDivisionError)
+
+        d = self.locator.getExercises(solved=True)
+        self.locator.storeThread.runPending()
+        self.assertEqual(len(self.successResultOf(d)["exercises"]), 1)
+
+
+
 locator = Locator()
 
 
@@ -214,6 +1111,18 @@ class GetExercisesResponderTests(ResponderTestMixin, SynchronousTestCase):
 
 
 
+class GetExercisesPageResponderTests(ResponderTestMixin, SynchronousTestCase):
+    command =  GetExercisesPage
+    locator = locator
+
+
+
+class GetChangesResponderTests(ResponderTestMixin, SynchronousTestCase):
+    command =  GetChanges
+    locator = locator
+
+
+
 class GetExerciseDetailsResponderTests(ResponderTestMixin, SynchronousTestCase):
     command =  GetExerciseDetails
     locator = locator
@@ -257,8 +1166,202 @@ class SecretTests(SynchronousTestCase):
         self.assertIdentical(Secret.forUser(self.user), secret)
 
 
+    def test_oldestSecret(self):
+        """If a user somehow has several secrets, the oldest one is used.
+
+        """
+        secret = Secret(store=self.store, entropy="xyzzy", user=self.user)
+        Secret(store=self.store, entropy="plugh", user=self.user)
+        self.assertIdentical(Secret.forUser(self.user), secret)
+
+
+    def test_createdElsewhere(self):
+        """When another process has created a secret for the user, that
+        secret is used.
+
+        """
+        path = self.mktemp()
+        store = Store(path)
+        user = User(store=store, email="user@example.com")
+        otherStore = Store(path)
+        otherUser = otherStore.getItemByID(user.storeID)
+
+        secret = Secret.forUser(otherUser)
+        self.assertEqual(Secret.forUser(user).storeID, secret.storeID)
+        self.assertEqual(store.query(Secret).count(), 1)
+
+
+    def test_queuedNew(self):
+        """When the user has no secret yet, a new one is created through the
+        write queue.
+
+        """
+        queue = WriteQueue(self.store, reactor=Clock())
+        d = Secret.forUserQueued(self.user, queue)
+        self.assertNoResult(d)
+
+        queue.flush()
+        secret = self.successResultOf(d)
+        self.assertEqual(secret.user, self.user)
+        self.assertIdentical(Secret.forUser(self.user), secret)
+
+
+    def test_queuedSame(self):
+        """When the user already has a secret, it is returned right away.
+
+        """
+        secret = Secret(store=self.store, entropy="xyzzy", user=self.user)
+        queue = WriteQueue(self.store, reactor=Clock())
+        d = Secret.forUserQueued(self.user, queue)
+        self.assertIdentical(self.successResultOf(d), secret)
+
+
+    def test_queuedTwice(self):
+        """When a secret is requested twice before the queue is flushed, only
+        one secret is created.
+
+        """
+        queue = WriteQueue(self.store, reactor=Clock())
+        first = Secret.forUserQueued(self.user, queue)
+        second = Secret.forUserQueued(self.user, queue)
+        queue.flush()
+        self.assertIdentical(self.successResultOf(first),
+                             self.successResultOf(second))
+
+
     def test_indexed(self):
         """The user attribute of secrets is indexed.
 
         """
         self.assertTrue(Secret.user.indexed)
+
+
+
+class DerivedKeyTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        self.user = User(store=self.store, email="test@example.com")
+        self.secret = Secret(store=self.store, entropy="xyzzy", user=self.user)
+
+
+    def test_deriveKey(self):
+        """Keys are derived from the secret with HKDF, for the exercise and
+        label.
+
+        """
+        key = Secret.deriveKey(self.user, b"exercise", b"label")
+        expected = exercise._hkdf("xyzzy", 32, [b"key", b"exercise", b"label"])
+        self.assertEqual(key, expected)
+        self.assertEqual(len(key), 32)
+
+        key = Secret.deriveKey(self.user, b"exercise", b"label", length=16)
+        self.assertEqual(len(key), 16)
+
+
+    def test_deterministic(self):
+        """The same arguments always give the same key.
+
+        """
+        key = Secret.deriveKey(self.user, b"exercise", b"label")
+        exercise.getDerivedKeys(self.store).clear()
+        self.assertEqual(Secret.deriveKey(self.user, b"exercise", b"label"),
+                         key)
+
+
+    def test_unrelated(self):
+        """Keys for different users, exercises or labels are different, even
+        when their parts concatenate to the same thing.
+
+        """
+        otherUser = User(store=self.store, email="other@example.com")
+        Secret(store=self.store, entropy="plugh", user=otherUser)
+
+        keys = set([
+            Secret.deriveKey(self.user, b"exercise", b"label"),
+            Secret.deriveKey(otherUser, b"exercise", b"label"),
+            Secret.deriveKey(self.user, b"other", b"label"),
+            Secret.deriveKey(self.user, b"exercise", b"other"),
+            Secret.deriveKey(self.user, b"exercis", b"elabel"),
+            Secret.deriveStream(self.user, b"exercise", b"label").read(32)
+        ])
+        self.assertEqual(len(keys), 6)
+
+
+    def test_cached(self):
+        """Deriving a key again doesn't look up the secret.
+
+        """
+        key = Secret.deriveKey(self.user, b"exercise", b"label")
+        data = Secret.deriveStream(self.user, b"exercise", b"label").read(32)
+
+        def forUser(user):
+            self.fail("key should come from the cache")
+        self.patch(Secret, "forUser", staticmethod(forUser))
+
+        self.assertEqual(Secret.deriveKey(self.user, b"exercise", b"label"),
+                         key)
+        stream = Secret.deriveStream(self.user, b"exercise", b"label")
+        self.assertEqual(stream.read(32), data)
+
+
+    def test_secretChanged(self):
+        """When a user's secret changes, the keys derived from it are
+        forgotten.
+
+        """
+        key = Secret.deriveKey(self.user, b"exercise", b"label")
+        self.secret.entropy = "plugh"
+        self.assertNotEqual(Secret.deriveKey(self.user, b"exercise", b"label"),
+                            key)
+
+
+    def test_newSecret(self):
+        """Keys can be derived for users without a secret, which makes
+        one.
+
+        """
+        otherUser = User(store=self.store, email="other@example.com")
+        key = Secret.deriveKey(otherUser, b"exercise", b"label")
+        secret = Secret.forUser(otherUser)
+        self.assertEqual(key, exercise._hkdf(secret.entropy, 32, [
+            b"key", b"exercise", b"label"]))
+
+
+    def test_newSecretCached(self):
+        """Keys derived while making the user's secret are cached.
+
+        """
+        otherUser = User(store=self.store, email="other@example.com")
+        key = Secret.deriveKey(otherUser, b"exercise", b"label")
+
+        def forUser(user):
+            self.fail("key should come from the cache")
+        self.patch(Secret, "forUser", staticmethod(forUser))
+
+        self.assertEqual(Secret.deriveKey(otherUser, b"exercise", b"label"),
+                         key)
+
+
+    def test_boundedPerUser(self):
+        """Only so many keys are cached for each user.
+
+        """
+        self.patch(exercise, "maxDerivedKeysPerUser", 2)
+        for label in b"a", b"b", b"c":
+            Secret.deriveKey(self.user, b"exercise", label)
+
+        keys = exercise.getDerivedKeys(self.store).get(self.user.storeID)
+        self.assertEqual(len(keys), 2)
+
+
+    def test_stream(self):
+        """Streams with the same arguments have the same bytes, however they
+        are read.
+
+        """
+        stream = Secret.deriveStream(self.user, b"exercise", b"label")
+        data = stream.read(100)
+        self.assertEqual(len(data), 100)
+
+        stream = Secret.deriveStream(self.user, b"exercise", b"label")
+        self.assertEqual(stream.read(30) + stream.read(70), data)
@@ -0,0 +1,168 @@
+from merlyn import metrics
+from twisted.internet.defer import Deferred, fail
+from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+
+class CounterTests(SynchronousTestCase):
+    def test_inc(self):
+        """Counters count per combination of label values, starting at zero.
+
+        """
+        counter = metrics.Counter("requests_total", "Requests", ["method"])
+        self.assertEqual(counter.get("GET"), 0)
+        counter.inc("GET")
+        counter.inc("GET")
+        counter.inc("POST")
+        self.assertEqual((counter.get("GET"), counter.get("POST")), (2, 1))
+
+
+    def test_samples(self):
+        """Samples have the label values, in the order of the label names.
+
+        """
+        counter = metrics.Counter("requests_total", "Requests",
+                                  ["method", "path"])
+        counter.inc("GET", "/")
+        self.assertEqual(list(counter.samples()),
+                         ['requests_total{method="GET",path="/"} 1'])
+
+
+    def test_escaping(self):
+        """Backslashes, newlines and double quotes in label values are
+        escaped.
+
+        """
+        counter = metrics.Counter("requests_total", "Requests", ["path"])
+        counter.inc('a"b\\c\nd')
+        self.assertEqual(list(counter.samples()),
+                         ['requests_total{path="a\\"b\\\\c\\nd"} 1'])
+
+
+    def test_noLabels(self):
+        """Metrics without labels are sampled without braces.
+
+        """
+        gauge = metrics.Gauge("connections", "Connections")
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(list(gauge.samples()), ["connections 1"])
+
+
+
+class HistogramTests(SynchronousTestCase):
+    def setUp(self):
+        self.histogram = metrics.Histogram("duration_seconds", "Durations",
+                                           ["command"], buckets=(0.1, 1.0,
+                                                                 float("inf")))
+
+
+    def test_count(self):
+        """Histograms count observed values per combination of label values.
+
+        """
+        self.histogram.observe(0.5, "A")
+        self.histogram.observe(2.0, "A")
+        self.assertEqual(self.histogram.count("A"), 2)
+        self.assertEqual(self.histogram.count("B"), 0)
+
+
+    def test_samples(self):
+        """Buckets are cumulative, and include values equal to their bound.
+
+        """
+        for value in [0.05, 0.1, 0.5, 2.0]:
+            self.histogram.observe(value, "A")
+
+        self.assertEqual(list(self.histogram.samples()), [
+            'duration_seconds_bucket{command="A",le="0.1"} 2',
+            'duration_seconds_bucket{command="A",le="1.0"} 3',
+            'duration_seconds_bucket{command="A",le="+Inf"} 4',
+            'duration_seconds_sum{command="A"} 2.65',
+            'duration_seconds_count{command="A"} 4'
+        ])
+
+
+
+class RegistryTests(SynchronousTestCase):
+    def test_render(self):
+        """Registered metrics are rendered in order, with their help and type.
+
+        """
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter("a_total", "As"))
+        registry.register(metrics.Gauge("b", "Bs"))
+        counter.inc()
+
+        self.assertEqual(registry.render(),
+                         "# HELP a_total As\n"
+                         "# TYPE a_total counter\n"
+                         "a_total 1\n"
+                         "# HELP b Bs\n"
+                         "# TYPE b gauge\n")
+
+
+
+class TimeResponderTests(SynchronousTestCase):
+    def setUp(self):
+        self.durations = metrics.Histogram("durations", "Durations",
+                                           ["command"])
+        self.patch(metrics, "commandDurations", self.durations)
+        self.errors = metrics.Counter("errors", "Errors", ["command"])
+        self.patch(metrics, "commandErrors", self.errors)
+
+        self.now = [10.0]
+        self.boxes = []
+
+
+    def timeResponder(self, result):
+        def responder(box):
+            self.boxes.append(box)
+            return result
+        return metrics.timeResponder(b"Command", responder,
+                                     _now=lambda: self.now[0])
+
+
+    def test_success(self):
+        """The time until the responder's result is recorded.
+
+        """
+        d = Deferred()
+        responder = self.timeResponder(d)
+        self.assertIdentical(responder(b"box"), d)
+        self.assertEqual(self.boxes, [b"box"])
+
+        self.now[0] += 0.25
+        d.callback(b"response")
+        self.assertEqual(self.successResultOf(d), b"response")
+        self.assertEqual(self.durations._values[(b"Command",)][-1], 0.25)
+        self.assertEqual(self.errors.get(b"Command"), 0)
+
+
+    def test_failure(self):
+        """Failures are counted, and passed on.
+
+        """
+        responder = self.timeResponder(fail(RuntimeError()))
+        self.failureResultOf(responder(b"box"), RuntimeError)
+        self.assertEqual(self.durations.count(b"Command"), 1)
+        self.assertEqual(self.errors.get(b"Command"), 1)
+
+
+
+class MetricsResourceTests(SynchronousTestCase):
+    def test_render(self):
+        """The resource renders the registry as plain text.
+
+        """
+        registry = metrics.Registry()
+        registry.register(metrics.Gauge("a", "As")).inc()
+        resource = metrics.MetricsResource(registry)
+
+        request = DummyRequest([b""])
+        body = resource.render_GET(request)
+        self.assertEqual(body, registry.render())
+        self.assertEqual(
+            request.responseHeaders.getRawHeaders(b"content-type"),
+            [b"text/plain; version=0.0.4"])
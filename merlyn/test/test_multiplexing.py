@@ -1,6 +1,9 @@
 from axiom.store import Store
 from functools import partial
-from merlyn.multiplexing import addToStore, FactoryDict
+from merlyn.multiplexing import _PersistedFactory, addToStore
+from merlyn.multiplexing import FactoryDict, getFactoryDict, preload
+from merlyn.test.test_auth import FakeLogObserver
+from twisted.python.log import addObserver, removeObserver
 from twisted.trial.unittest import SynchronousTestCase
 
 
@@ -23,6 +26,7 @@ class OtherFactory(Factory):
 
 
 otherName = prefix + "OtherFactory"
+bogusName = prefix + "BogusFactory"
 
 
 
@@ -33,7 +37,7 @@ class FactoryDictTests(SynchronousTestCase):
     """
     def setUp(self):
         self.store = Store()
-        self.factoryDict = FactoryDict(self.store)
+        self.factoryDict = getFactoryDict(self.store)
         addToStore(self.store, "test", name)
 
 
@@ -68,5 +72,127 @@ class FactoryDictTests(SynchronousTestCase):
         persisted factory with the passed identifier already exists.
 
         """
+        self.checkFactory(self.factoryDict["test"])
         addToStore(self.store, "test", otherName)
         self.checkFactory(self.factoryDict["test"], cls=OtherFactory)
+
+
+    def test_cached(self):
+        """Factories are only looked up and built once.
+
+        """
+        factory = self.factoryDict["test"]
+
+        def findUnique(*args, **kwargs):
+            self.fail("factory was looked up again")
+        self.patch(self.store, "findUnique", findUnique)
+
+        self.assertIdentical(self.factoryDict["test"], factory)
+
+
+    def test_invalidate(self):
+        """Invalidated factories are built again when they are next needed.
+
+        """
+        addToStore(self.store, "other", otherName)
+        factory = self.factoryDict["test"]
+        otherFactory = self.factoryDict["other"]
+
+        self.factoryDict.invalidate("test")
+        self.assertNotIdentical(self.factoryDict["test"], factory)
+        self.assertIdentical(self.factoryDict["other"], otherFactory)
+
+        self.factoryDict.invalidate()
+        self.assertNotIdentical(self.factoryDict["other"], otherFactory)
+
+
+    def test_deleteFromStore(self):
+        """When a persisted factory is deleted, its factory is forgotten.
+
+        """
+        self.factoryDict["test"]
+        PF = _PersistedFactory
+        self.store.findUnique(PF, PF.identifier == "test").deleteFromStore()
+        self.assertRaises(KeyError, lambda: self.factoryDict["test"])
+
+
+    def test_renameInStore(self):
+        """When a persisted factory's identifier changes, the factory for its
+        old identifier is forgotten, as well as any factory for the new
+        one.
+
+        """
+        self.factoryDict["test"]
+        PF = _PersistedFactory
+        persistedFactory = self.store.findUnique(PF, PF.identifier == "test")
+        persistedFactory.identifier = "renamed"
+        self.assertRaises(KeyError, lambda: self.factoryDict["test"])
+        self.checkFactory(self.factoryDict["renamed"])
+
+        def rename():
+            persistedFactory.identifier = "again"
+            persistedFactory.identifier = "final"
+        self.store.transact(rename)
+        for identifier in "renamed", "again":
+            self.assertRaises(KeyError, lambda: self.factoryDict[identifier])
+        self.checkFactory(self.factoryDict["final"])
+
+
+
+class GetFactoryDictTests(SynchronousTestCase):
+    def test_perStore(self):
+        """There is one factory dict per store.
+
+        """
+        store, otherStore = Store(), Store()
+        factoryDict = getFactoryDict(store)
+        self.assertTrue(isinstance(factoryDict, FactoryDict))
+        self.assertIdentical(factoryDict.store, store)
+        self.assertIdentical(getFactoryDict(store), factoryDict)
+        self.assertNotIdentical(getFactoryDict(otherStore), factoryDict)
+
+
+
+class PreloadTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        addToStore(self.store, "test", name)
+        addToStore(self.store, "other", otherName)
+
+        self.observer = FakeLogObserver()
+        addObserver(self.observer)
+        self.addCleanup(removeObserver, self.observer)
+
+
+    def test_preload(self):
+        """Preloading builds every persisted factory, and reports how long
+        each one took.
+
+        """
+        timings = preload(self.store)
+        self.assertEqual(sorted(identifier for identifier, _ in timings),
+                         ["other", "test"])
+        for _identifier, seconds in timings:
+            self.assertTrue(seconds >= 0)
+
+        def findUnique(*args, **kwargs):
+            self.fail("factory was looked up again")
+        self.patch(self.store, "findUnique", findUnique)
+
+        factoryDict = getFactoryDict(self.store)
+        self.assertTrue(isinstance(factoryDict["test"], Factory))
+        self.assertTrue(isinstance(factoryDict["other"], OtherFactory))
+
+
+    def test_bogusName(self):
+        """When a persisted factory's name doesn't point to anything,
+        preloading logs which one it was and fails.
+
+        """
+        addToStore(self.store, "bogus", bogusName)
+        self.assertRaises(AttributeError, preload, self.store)
+
+        message, = [e["message"][0] for e in self.observer.events
+                    if e.get("message")]
+        self.assertIn("'bogus'", message)
+        self.assertIn(repr(bogusName), message)
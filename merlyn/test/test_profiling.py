@@ -0,0 +1,143 @@
+import pstats
+
+from merlyn import profiling
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+
+def respond(box):
+    return box
+
+
+
+class FakeProtocol(object):
+    def locateResponder(self, name):
+        if name == b"Unknown":
+            return None
+        return respond
+
+
+
+class FakeFactoryDict(object):
+    def __getitem__(self, key):
+        return key
+
+
+
+class ProfilerTests(SynchronousTestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.profiler = profiling.Profiler(FakeProtocol, FakeFactoryDict,
+                                           reactor=self.clock)
+        self.path = self.mktemp()
+        self.locateResponder = FakeProtocol.__dict__["locateResponder"]
+        self.getItem = FakeFactoryDict.__dict__["__getitem__"]
+
+
+    def assertRestored(self):
+        self.assertIdentical(FakeProtocol.__dict__["locateResponder"],
+                             self.locateResponder)
+        self.assertIdentical(FakeFactoryDict.__dict__["__getitem__"],
+                             self.getItem)
+
+
+    def test_notProfiling(self):
+        """When it isn't profiling, the profiler replaces nothing.
+
+        """
+        self.assertFalse(self.profiler.profiling)
+        self.assertRestored()
+
+
+    def test_profile(self):
+        """Responders and factory lookups are profiled, and cProfile stats
+        are written when profiling stops.
+
+        """
+        self.profiler.start(self.path)
+        self.assertTrue(self.profiler.profiling)
+        responder = FakeProtocol().locateResponder(b"Command")
+        self.assertEqual(responder(b"box"), b"box")
+        self.assertEqual(FakeFactoryDict()[b"key"], b"key")
+        self.assertIdentical(FakeProtocol().locateResponder(b"Unknown"), None)
+
+        self.assertEqual(self.profiler.stop(), self.path)
+        self.assertFalse(self.profiler.profiling)
+        self.assertRestored()
+
+        names = set(name for _f, _l, name in pstats.Stats(self.path).stats)
+        self.assertIn("respond", names)
+        self.assertIn("__getitem__", names)
+
+
+    def test_commands(self):
+        """Only the responders of the given commands are profiled.
+
+        """
+        self.profiler.start(self.path, commands=[b"Other"])
+        FakeProtocol().locateResponder(b"Command")(b"box")
+        FakeFactoryDict()[b"key"]
+        self.profiler.stop()
+
+        names = set(name for _f, _l, name in pstats.Stats(self.path).stats)
+        self.assertNotIn("respond", names)
+        self.assertIn("__getitem__", names)
+
+
+    def test_stacks(self):
+        """The profiler can write folded stacks instead.
+
+        """
+        self.profiler.start(self.path, stacks=True)
+        FakeProtocol().locateResponder(b"Command")(b"box")
+        self.profiler.stop()
+
+        with open(self.path) as f:
+            stacks = dict(line.rsplit(" ", 1) for line in f)
+        respondStacks = [s for s in stacks if s.endswith(":respond")]
+        self.assertEqual(len(respondStacks), 1)
+        self.assertTrue(stacks[respondStacks[0]].strip().isdigit())
+
+
+    def test_window(self):
+        """Profiling stops after the given number of seconds.
+
+        """
+        self.profiler.start(self.path, seconds=10)
+        self.clock.advance(10)
+        self.assertFalse(self.profiler.profiling)
+        self.assertRestored()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_startTwice(self):
+        """Profiling can't be started while it already is.
+
+        """
+        self.profiler.start(self.path)
+        self.assertRaises(RuntimeError, self.profiler.start, self.path)
+        self.profiler.stop()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertRaises(RuntimeError, self.profiler.stop)
+
+
+
+class StackProfileTests(SynchronousTestCase):
+    def test_nested(self):
+        """Calls are recorded with the stack of calls they were made from.
+
+        """
+        def outer():
+            inner()
+
+        def inner():
+            pass
+
+        profile = profiling._StackProfile()
+        profile.enable()
+        outer()
+        profile.disable()
+
+        stacks = [[frame.rsplit(":", 1)[-1] for frame in stack]
+                  for stack in profile.stacks]
+        self.assertIn(["outer", "inner"], stacks)
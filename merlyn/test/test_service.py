@@ -1,9 +1,24 @@
+from OpenSSL.SSL import Context, SSLv23_METHOD
 from axiom.store import Store
-from merlyn import auth, service
+from clarent.exercise import NotifySolved
+from merlyn import auth, exercise, metrics, multiplexing, service
+from merlyn import storethread
+from merlyn import workers
+from merlyn.writequeue import WriteQueue
+from merlyn.test.test_auth import realUserCert
+from merlyn.test.test_exercise import FakeStoreThread as FakeLocatorStoreThread
 from twisted.conch.manhole_ssh import ConchFactory
+from twisted.internet.defer import succeed
+from twisted.internet.error import CannotListenError
 from twisted.internet.protocol import connectionDone
-from twisted.test.proto_helpers import MemoryReactor, StringTransport
+from twisted.internet.task import Clock, Cooperator
+from twisted.test.proto_helpers import MemoryReactorClock
+from twisted.protocols.amp import RemoteAmpError
+from twisted.protocols.tls import TLSMemoryBIOFactory
+from twisted.test.proto_helpers import StringTransport
 from twisted.trial.unittest import SynchronousTestCase
+from twisted.web.server import Site
+from txampext.respondertests import ResponderTestMixin
 
 
 class AMPTests(SynchronousTestCase):
@@ -31,6 +46,423 @@ class AMPTests(SynchronousTestCase):
         self.assertEqual(self.factory.protocols, set([]))
 
 
+    def test_sharedFactoryDict(self):
+        """All protocols use the factory dict of the store to find
+        multiplexed connection factories.
+
+        """
+        factoryDict = multiplexing.getFactoryDict(self.store)
+        for _ in range(2):
+            proto = self.factory.buildProtocol(None)
+            proto.makeConnection(StringTransport())
+            self.assertIdentical(proto._factories, factoryDict)
+
+
+    def connect(self, user=None):
+        """Connects a protocol. If a user is given, the protocol's user is
+        resolved to that user.
+
+        """
+        proto = self.factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        proto.callRemote = lambda command, **kwargs: \
+            proto.remoteCalls.append((command, kwargs))
+        proto.remoteCalls = []
+
+        if user is not None:
+            verifiedUsers = auth.getVerifiedUsers(self.store)
+            verifiedUsers[realUserCert.digest("sha512")] = user
+            proto.transport.getPeerCertificate = lambda: realUserCert
+            proto.user
+            verifiedUsers.clear()
+
+        return proto
+
+
+    def makeUser(self, email):
+        return auth.User(store=self.store, email=email)
+
+
+    def test_connectionsFor(self):
+        """The factory knows the connections of each user, once the user of
+        a connection has been found, until that connection is lost.
+
+        """
+        user = self.makeUser(b"user@example.com")
+        otherUser = self.makeUser(b"other@example.com")
+        self.assertEqual(self.factory.connectionsFor(user), frozenset())
+
+        first, second = self.connect(user), self.connect(user)
+        other = self.connect(otherUser)
+        anonymous = self.connect()
+        self.assertEqual(self.factory.connectionsFor(user),
+                         frozenset([first, second]))
+        self.assertEqual(self.factory.connectionsFor(otherUser),
+                         frozenset([other]))
+
+        for proto in first, other, anonymous:
+            proto.connectionLost(connectionDone)
+        self.assertEqual(self.factory.connectionsFor(user),
+                         frozenset([second]))
+        self.assertEqual(self.factory.connectionsFor(otherUser), frozenset())
+        self.assertEqual(self.factory._connectionsByUser.keys(),
+                         [user.storeID])
+
+
+    def test_callRemoteForUser(self):
+        """The factory can call a remote command on all connections of a
+        user.
+
+        """
+        user = self.makeUser(b"user@example.com")
+        first, second = self.connect(user), self.connect(user)
+        other = self.connect(self.makeUser(b"other@example.com"))
+
+        self.factory.callRemoteForUser(user, NotifySolved,
+                                       identifier=b"x", title=u"X")
+        call = NotifySolved, {"identifier": b"x", "title": u"X"}
+        self.assertEqual(first.remoteCalls, [call])
+        self.assertEqual(second.remoteCalls, [call])
+        self.assertEqual(other.remoteCalls, [])
+
+
+    def test_broadcast(self):
+        """The factory can call a remote command on all connections,
+        cooperatively. Connections that are lost in the meantime are
+        skipped.
+
+        """
+        scheduled = []
+        self.factory.cooperator = Cooperator(scheduler=scheduled.append,
+                                             terminationPredicateFactory=
+                                             lambda: lambda: True)
+        protos = [self.connect() for _ in range(3)]
+
+        d = self.factory.broadcast(NotifySolved, identifier=b"x", title=u"X")
+        scheduled.pop()()
+        self.assertNoResult(d)
+        self.assertEqual(sum(len(p.remoteCalls) for p in protos), 1)
+
+        lost = [p for p in protos if not p.remoteCalls][0]
+        lost.connectionLost(connectionDone)
+        while scheduled:
+            scheduled.pop()()
+
+        self.successResultOf(d)
+        self.assertEqual(lost.remoteCalls, [])
+        self.assertEqual(sum(len(p.remoteCalls) for p in protos), 2)
+
+
+    def test_invalidateSolved(self):
+        """The factory can invalidate the cached solved exercises of all of
+        its connections, or only those of a particular user.
+
+        """
+        user = self.makeUser(b"user@example.com")
+        otherUser = self.makeUser(b"other@example.com")
+        proto, otherProto = self.connect(user), self.connect(otherUser)
+        for p in proto, otherProto:
+            p._solvedIDs = set()
+
+        self.factory.invalidateSolved(user)
+        self.assertIdentical(proto._solvedIDs, None)
+        self.assertEqual(otherProto._solvedIDs, set())
+
+        self.factory.invalidateSolved()
+        self.assertIdentical(otherProto._solvedIDs, None)
+
+
+    def test_openConnections(self):
+        """Open connections are counted.
+
+        """
+        gauge = metrics.Gauge("connections", "Connections")
+        self.patch(metrics, "openConnections", gauge)
+        proto = self.connect()
+        self.assertEqual(gauge.get(), 1)
+        proto.connectionLost(connectionDone)
+        self.assertEqual(gauge.get(), 0)
+
+
+    def test_timedResponders(self):
+        """Responders are timed, and their failures counted, by command.
+
+        """
+        durations = metrics.Histogram("durations", "Durations", ["command"])
+        self.patch(metrics, "commandDurations", durations)
+        errors = metrics.Counter("errors", "Errors", ["command"])
+        self.patch(metrics, "commandErrors", errors)
+        proto = self.connect(self.makeUser(b"user@example.com"))
+
+        responder = proto.locateResponder(b"GetExercises")
+        self.successResultOf(responder({b"solved": b"False"}))
+        self.assertEqual(durations.count(b"GetExercises"), 1)
+
+        responder = proto.locateResponder(b"GetExerciseDetails")
+        d = responder({b"identifier": b"nonexistent"})
+        self.failureResultOf(d, RemoteAmpError)
+        self.assertEqual(errors.get(b"GetExerciseDetails"), 1)
+
+        self.assertIdentical(proto.locateResponder(b"Unknown"), None)
+
+
+    def startPushing(self):
+        """Starts the factory, with a fake reactor to push changes from.
+
+        """
+        self.clock = self.factory.reactor = Clock()
+        self.factory.startFactory()
+        self.addCleanup(self.factory.stopFactory)
+
+
+    def makeExercise(self, identifier):
+        return exercise.Exercise(store=self.store, identifier=identifier,
+                                 title=u"Exercise", description=u"")
+
+
+    def test_secretQueued(self):
+        """When the user is found, and there's a write queue, the user's
+        secret is created through it.
+
+        """
+        queue = self.factory.writeQueue = WriteQueue(self.store,
+                                                     reactor=Clock())
+        user = self.makeUser(b"user@example.com")
+        self.connect(user)
+        self.assertIdentical(exercise.Secret._find(user), None)
+
+        queue.flush()
+        self.assertNotIdentical(exercise.Secret._find(user), None)
+
+
+    def test_noSecretWithoutWriteQueue(self):
+        """Without a write queue, secrets are only created when needed.
+
+        """
+        user = self.makeUser(b"user@example.com")
+        self.connect(user)
+        self.assertIdentical(exercise.Secret._find(user), None)
+
+
+    def test_subscribe(self):
+        """Connections can subscribe to changes, and get the latest version.
+        They are unsubscribed when they unsubscribe, or when the
+        connection is lost.
+
+        """
+        self.makeExercise(b"1")
+        first = self.connect(self.makeUser(b"user@example.com"))
+        second = self.connect(self.makeUser(b"other@example.com"))
+        for proto in first, second:
+            response = proto.subscribe()
+            self.assertEqual(response, {
+                "version": exercise._latestVersion(self.store)
+            })
+        self.assertEqual(self.factory._subscribers, set([first, second]))
+
+        self.assertEqual(first.unsubscribe(), {})
+        second.connectionLost(connectionDone)
+        self.assertEqual(self.factory._subscribers, set())
+
+
+    def test_subscribeFromStoreThread(self):
+        """If there's a store thread, the latest version is read in it.
+
+        """
+        storeThread = self.factory.storeThread = FakeLocatorStoreThread(
+            self.store)
+        self.makeExercise(b"1")
+        proto = self.connect(self.makeUser(b"user@example.com"))
+        d = proto.subscribe()
+        self.assertNoResult(d)
+        self.assertEqual(self.factory._subscribers, set([proto]))
+
+        storeThread.runPending()
+        self.assertEqual(self.successResultOf(d), {
+            "version": exercise._latestVersion(self.store)
+        })
+
+
+    def test_pushExercises(self):
+        """New exercises are pushed to subscribed connections, once per
+        reactor iteration.
+
+        """
+        self.startPushing()
+        subscribed = self.connect(self.makeUser(b"user@example.com"))
+        subscribed.subscribe()
+        unsubscribed = self.connect(self.makeUser(b"other@example.com"))
+
+        self.makeExercise(b"1")
+        self.makeExercise(b"2")
+        self.assertEqual(subscribed.remoteCalls, [])
+
+        self.clock.advance(0)
+        self.assertEqual(subscribed.remoteCalls, [(exercise.NotifyChanged, {
+            "exercises": [
+                {b"identifier": b"1", b"title": u"Exercise", b"solved": False},
+                {b"identifier": b"2", b"title": u"Exercise", b"solved": False}
+            ],
+            "version": exercise._latestVersion(self.store)
+        })])
+        self.assertEqual(unsubscribed.remoteCalls, [])
+
+        self.clock.advance(0)
+        self.assertEqual(len(subscribed.remoteCalls), 1)
+
+
+    def test_pushSolutions(self):
+        """Solutions are pushed to the solver's subscribed connections, and
+        added to the cached solved exercises of all of their
+        connections.
+
+        """
+        self.startPushing()
+        ex = self.makeExercise(b"1")
+        self.clock.advance(0)
+
+        user = self.makeUser(b"user@example.com")
+        subscribed, unsubscribed = self.connect(user), self.connect(user)
+        subscribed.subscribe()
+        unsubscribed._solvedIDs = set()
+        otherUser = self.makeUser(b"other@example.com")
+        other = self.connect(otherUser)
+        other.subscribe()
+
+        ex.solvedBy(user)
+        self.clock.advance(0)
+        self.assertEqual(subscribed.remoteCalls, [(exercise.NotifyChanged, {
+            "exercises": [
+                {b"identifier": b"1", b"title": u"Exercise", b"solved": True}
+            ],
+            "version": exercise._latestVersion(self.store)
+        })])
+        self.assertEqual(unsubscribed.remoteCalls, [])
+        self.assertEqual(unsubscribed._solvedIDs, set([ex.storeID]))
+        self.assertEqual(other.remoteCalls, [])
+
+
+    def test_pushPages(self):
+        """Large changes are pushed a page at a time. Only the last page has
+        the latest version.
+
+        """
+        self.patch(exercise, "maxPageSize", 1)
+        self.startPushing()
+        proto = self.connect(self.makeUser(b"user@example.com"))
+        proto.subscribe()
+
+        first, _second = self.makeExercise(b"1"), self.makeExercise(b"2")
+        self.clock.advance(0)
+        pages = [(kwargs["exercises"][0][b"identifier"], kwargs["version"])
+                 for _command, kwargs in proto.remoteCalls]
+        self.assertEqual(pages, [
+            (b"1", first.version),
+            (b"2", exercise._latestVersion(self.store))
+        ])
+
+
+    def test_stopFactory(self):
+        """Once the factory is stopped, changes are no longer pushed.
+
+        """
+        clock = self.factory.reactor = Clock()
+        self.factory.startFactory()
+        proto = self.connect(self.makeUser(b"user@example.com"))
+        proto.subscribe()
+
+        self.makeExercise(b"1")
+        self.factory.stopFactory()
+        self.makeExercise(b"2")
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(proto.remoteCalls, [])
+
+
+    def test_pushFromStoreThread(self):
+        """If there's a store thread, changes are found in it, and pushed
+        once the subscribers' solved exercises have been fetched in it.
+
+        """
+        storeThread = self.factory.storeThread = FakeLocatorStoreThread(
+            self.store)
+        self.startPushing()
+        proto = self.connect(self.makeUser(b"user@example.com"))
+        proto.subscribe()
+        storeThread.runPending()
+
+        self.makeExercise(b"1")
+        self.clock.advance(0)
+        self.assertEqual(len(storeThread.pending), 1)
+
+        storeThread.runPending()
+        self.assertEqual(len(storeThread.pending), 1)
+        self.assertEqual(proto.remoteCalls, [])
+
+        storeThread.runPending()
+        self.assertEqual(proto.remoteCalls, [(exercise.NotifyChanged, {
+            "exercises": [
+                {b"identifier": b"1", b"title": u"Exercise", b"solved": False}
+            ],
+            "version": exercise._latestVersion(self.store)
+        })])
+
+
+    def test_pushAgain(self):
+        """Changes made while changes are being pushed are pushed once that
+        is done.
+
+        """
+        storeThread = self.factory.storeThread = FakeLocatorStoreThread(
+            self.store)
+        self.startPushing()
+        proto = self.connect(self.makeUser(b"user@example.com"))
+        proto._solvedIDs = set()
+        proto.subscribe()
+        storeThread.runPending()
+
+        def changesSince(store, since, userIDs):
+            changes = exercise._changesSince(store, since, userIDs)
+            self.makeExercise(b"2")
+            return changes
+
+        self.makeExercise(b"1")
+        self.clock.advance(0)
+        storeThread.runPending(changesSince)
+        self.assertEqual(len(proto.remoteCalls), 1)
+        self.assertEqual(storeThread.pending, [])
+
+        self.clock.advance(0)
+        storeThread.runPending()
+        self.assertEqual(len(proto.remoteCalls), 2)
+        self.assertEqual(proto.remoteCalls[-1][1]["version"],
+                         exercise._latestVersion(self.store))
+
+
+    def test_pushFails(self):
+        """If changes can't be found, the failure is logged, and later changes
+        are still pushed.
+
+        """
+        storeThread = self.factory.storeThread = FakeLocatorStoreThread(
+            self.store)
+        self.startPushing()
+        proto = self.connect(self.makeUser(b"user@example.com"))
+        proto._solvedIDs = set()
+        proto.subscribe()
+        storeThread.runPending()
+
+        self.makeExercise(b"1")
+        self.clock.advance(0)
+        storeThread.runPending(lambda store, since, userIDs: 1 // 0)
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+        self.assertEqual(proto.remoteCalls, [])
+
+        self.makeExercise(b"2")
+        self.clock.advance(0)
+        storeThread.runPending()
+        self.assertEqual(len(proto.remoteCalls), 1)
+
+
     def test_factoryHasStore(self):
         """The factory exposes its store as the ``store`` attribute.
 
@@ -38,6 +470,32 @@ class AMPTests(SynchronousTestCase):
         self.assertIdentical(self.factory.store, self.store)
 
 
+    def test_storeThread(self):
+        """The factory and its protocols have a store thread, which is
+        ``None`` by default.
+
+        """
+        self.assertIdentical(self.factory.storeThread, None)
+
+        storeThread = object()
+        factory = service.Factory(self.store, storeThread)
+        proto = factory.buildProtocol(None)
+        self.assertIdentical(proto.storeThread, storeThread)
+
+
+    def test_writeQueue(self):
+        """The factory and its protocols have a write queue, which is
+        ``None`` by default.
+
+        """
+        self.assertIdentical(self.factory.writeQueue, None)
+
+        writeQueue = object()
+        factory = service.Factory(self.store, writeQueue=writeQueue)
+        proto = factory.buildProtocol(None)
+        self.assertIdentical(proto.writeQueue, writeQueue)
+
+
     def test_protocolsHaveStore(self):
         """Protocols have a reference to a store, which is the factory's store.
 
@@ -47,33 +505,380 @@ class AMPTests(SynchronousTestCase):
 
 
 
+def _fakeContexts(testCase):
+    """Makes context factories return a plain context, instead of reading
+    TLS files that the tests don't have.
+
+    """
+    getContext = lambda self: Context(SSLv23_METHOD)
+    testCase.patch(auth.ContextFactory, "getContext", getContext)
+
+
+
+class SubscribeResponderTests(ResponderTestMixin, SynchronousTestCase):
+    command = exercise.Subscribe
+    locator = service.Protocol()
+
+
+
+class UnsubscribeResponderTests(ResponderTestMixin, SynchronousTestCase):
+    command = exercise.Unsubscribe
+    locator = service.Protocol()
+
+
+
 class ServiceTests(SynchronousTestCase):
     def setUp(self):
+        _fakeContexts(self)
         self.store = Store()
-        self.reactor = MemoryReactor()
+        self.reactor = MemoryReactorClock()
         self.service = service.Service(self.store, reactor=self.reactor)
 
 
+    def test_contextFactoryKwargs(self):
+        """Extra keyword arguments are passed to the context factory.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor,
+                              certificatePath="c.pem")
+        svc.startService()
+        _port, tlsFactory, _backlog, _interface = self.reactor.tcpServers[0]
+        ctxFactory = tlsFactory._connectionCreator._oldStyleContextFactory
+        self.assertEqual(ctxFactory._wrapped.certificatePath, "c.pem")
+
+
     def test_startService(self):
-        """The service starts an AMP factory as well as a manhole.
+        """The service starts an AMP factory, served over TLS, as well as a
+        manhole.
 
         """
         self.service.startService()
 
-        ampListenEvent, = self.reactor.sslServers
-        port, factory, ctxFactory, _backlog, interface = ampListenEvent
+        ampListenEvent, manholeListenEvent = self.reactor.tcpServers
+        port, tlsFactory, _backlog, interface = ampListenEvent
         self.assertEqual(port, 4430)
+        self.assertTrue(isinstance(tlsFactory, TLSMemoryBIOFactory))
+        factory = tlsFactory.wrappedFactory
         self.assertTrue(isinstance(factory, service.Factory))
+        self.assertIdentical(self.service.ampFactory, factory)
+        ctxFactory = tlsFactory._connectionCreator._oldStyleContextFactory
         self.assertTrue(isinstance(ctxFactory, auth.ContextFactory))
         self.assertEqual(interface, "")
+        self.assertEqual(ctxFactory._wrapped.certificatePath, "cert.pem")
 
-        manholeListenEvent, = self.reactor.tcpServers
         port, factory, _backlog, interface = manholeListenEvent
         self.assertEqual(port, 8888)
         self.assertTrue(isinstance(factory, ConchFactory))
         self.assertEqual(interface, "localhost")
 
 
+    def test_contextFactoryStarted(self):
+        """While the service runs, its context factory is started, so that
+        it periodically checks the TLS files for modifications, and logs
+        summaries of suppressed verifications.
+
+        """
+        self.service.startService()
+        ctxFactory = self.service.contextFactory
+        self.assertTrue(isinstance(ctxFactory, auth.ContextFactory))
+        self.assertIdentical(ctxFactory._wrapped.reactor, self.reactor)
+        self.assertNotEqual(self.reactor.getDelayedCalls(), [])
+
+        self.service.stopService()
+        self.assertEqual(self.reactor.getDelayedCalls(), [])
+
+
+    def test_endpoints(self):
+        """The AMP factory can listen on several endpoints, all over TLS,
+        with the given backlogs. The manhole endpoint can be configured
+        too.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor,
+                              ampEndpoints=["tcp:4431:backlog=128",
+                                            "unix:merlyn.sock"],
+                              manholeEndpoint="tcp:8889:interface=127.0.0.1")
+        svc.startService()
+
+        ampListenEvent, manholeListenEvent = self.reactor.tcpServers
+        port, tlsFactory, backlog, _interface = ampListenEvent
+        self.assertEqual((port, backlog), (4431, 128))
+        self.assertIdentical(tlsFactory.wrappedFactory, svc.ampFactory)
+
+        (address, unixFactory, _backlog, _mode, _wantPID), = \
+            self.reactor.unixServers
+        self.assertEqual(address, "merlyn.sock")
+        self.assertIdentical(unixFactory, tlsFactory)
+
+        port, _factory, _backlog, interface = manholeListenEvent
+        self.assertEqual((port, interface), (8889, "127.0.0.1"))
+
+
+    def test_metrics(self):
+        """The service can serve metrics over HTTP. By default, it doesn't.
+
+        """
+        self.service.startService()
+        self.assertEqual(len(self.reactor.tcpServers), 2)
+
+        svc = service.Service(self.store, reactor=self.reactor,
+                              metricsEndpoint="tcp:9100:interface=127.0.0.1")
+        svc.startService()
+        port, factory, _backlog, interface = self.reactor.tcpServers[-1]
+        self.assertEqual((port, interface), (9100, "127.0.0.1"))
+        self.assertTrue(isinstance(factory, Site))
+        self.assertTrue(isinstance(factory.resource, metrics.MetricsResource))
+
+
+    def test_listenFails(self):
+        """When the service can't listen, it fails to start.
+
+        """
+        def listenTCP(port, factory, backlog, interface):
+            raise CannotListenError(interface, port, None)
+        self.patch(self.reactor, "listenTCP", listenTCP)
+        self.assertRaises(CannotListenError, self.service.startService)
+
+
+
+class FakeStoreThread(object):
+    def __init__(self, dbdir, reactor):
+        self.dbdir = dbdir
+        self.reactor = reactor
+        self.running = False
+
+
+    def start(self):
+        self.running = True
+
+
+    def stop(self):
+        self.running = False
+        return succeed(None)
+
+
+
+class PreloadServiceTests(SynchronousTestCase):
+    def setUp(self):
+        _fakeContexts(self)
+        self.store = Store()
+        self.reactor = MemoryReactorClock()
+        self.preloaded = []
+        self.patch(multiplexing, "preload", self.preload)
+
+
+    def preload(self, store):
+        self.preloaded.append(store)
+        if self.bogus:
+            raise AttributeError("bogus")
+        return [("test", 0.5)]
+
+
+    def test_noPreload(self):
+        """By default, the service doesn't preload factories.
+
+        """
+        self.bogus = False
+        service.Service(self.store, reactor=self.reactor).startService()
+        self.assertEqual(self.preloaded, [])
+
+
+    def test_preload(self):
+        """The service can preload all factories before it starts
+        listening.
+
+        """
+        self.bogus = False
+        svc = service.Service(self.store, reactor=self.reactor,
+                              preloadFactories=True)
+        svc.startService()
+        self.assertEqual(self.preloaded, [self.store])
+        self.assertEqual(len(self.reactor.tcpServers), 2)
+
+
+    def test_preloadFails(self):
+        """When a factory can't be preloaded, the service fails to start, and
+        doesn't listen.
+
+        """
+        self.bogus = True
+        svc = service.Service(self.store, reactor=self.reactor,
+                              preloadFactories=True)
+        self.assertRaises(AttributeError, svc.startService)
+        self.assertEqual(self.reactor.tcpServers, [])
+
+
+
+class FakeWorkerPool(object):
+    def __init__(self, count, arguments, reactor):
+        self.count = count
+        self.arguments = arguments
+        self.running = False
+
+
+    def start(self):
+        self.running = True
+
+
+    def stop(self):
+        self.running = False
+        return succeed(None)
+
+
+
+class FakeChangeWatcher(FakeWorkerPool):
+    def __init__(self, store, ampFactory, reactor):
+        self.store = store
+        self.ampFactory = ampFactory
+        self.running = False
+
+
+
+class WorkersServiceTests(SynchronousTestCase):
+    def setUp(self):
+        _fakeContexts(self)
+        self.store = Store()
+        self.reactor = MemoryReactorClock()
+        self.reusableReactor = MemoryReactorClock()
+        self.patch(workers, "ReusablePortReactor", self.wrapReactor)
+        self.patch(workers, "WorkerPool", FakeWorkerPool)
+        self.patch(workers, "ChangeWatcher", FakeChangeWatcher)
+
+
+    def wrapReactor(self, reactor):
+        self.assertIdentical(reactor, self.reactor)
+        return self.reusableReactor
+
+
+    def test_workers(self):
+        """The service can start worker processes. It listens on ports that
+        they can share, and watches the store for their changes. The
+        workers are stopped when the service stops.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor, workers=3,
+                              workerArguments=["merlyn"])
+        svc.startService()
+
+        (port, tlsFactory, _backlog, _interface), = \
+            self.reusableReactor.tcpServers
+        self.assertEqual(port, 4430)
+        self.assertIdentical(tlsFactory.wrappedFactory, svc.ampFactory)
+        self.assertEqual(len(self.reactor.tcpServers), 1)
+
+        pool = svc.workerPool
+        self.assertEqual(pool.count, 2)
+        self.assertEqual(pool.arguments, ["merlyn"])
+        self.assertTrue(pool.running)
+
+        watcher = svc.changeWatcher
+        self.assertIdentical(watcher.ampFactory, svc.ampFactory)
+        self.assertTrue(watcher.running)
+
+        self.successResultOf(svc.stopService())
+        self.assertFalse(pool.running)
+        self.assertFalse(watcher.running)
+
+
+    def test_worker(self):
+        """Worker processes listen on shared TCP ports, watch the store for
+        changes, and don't serve a manhole or metrics. Other endpoints are
+        left to the main process.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor,
+                              isWorker=True,
+                              ampEndpoints=["tcp:4430", "unix:merlyn.sock"],
+                              metricsEndpoint="tcp:9100")
+        svc.startService()
+        self.assertEqual(len(self.reusableReactor.tcpServers), 1)
+        self.assertEqual(self.reusableReactor.unixServers, [])
+        self.assertEqual(self.reactor.tcpServers, [])
+        self.assertIdentical(svc.workerPool, None)
+        self.assertTrue(svc.changeWatcher.running)
+
+
+
+class StoreThreadServiceTests(SynchronousTestCase):
+    def setUp(self):
+        _fakeContexts(self)
+        self.patch(storethread, "StoreThread", FakeStoreThread)
+        self.store = Store(self.mktemp())
+        self.reactor = MemoryReactorClock()
+
+
+    def test_noStoreThread(self):
+        """By default, the service doesn't use a store thread.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor)
+        svc.startService()
+        self.assertIdentical(svc.storeThread, None)
+        factory = svc.ampFactory
+        self.assertIdentical(factory.storeThread, None)
+        svc.stopService()
+
+
+    def test_storeThread(self):
+        """The service can start a store thread for its store, which is used
+        by the AMP factory. It is stopped when the service stops.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor,
+                              useStoreThread=True)
+        svc.startService()
+        storeThread = svc.storeThread
+        self.assertTrue(storeThread.running)
+        self.assertEqual(storeThread.dbdir, self.store.dbdir)
+        self.assertIdentical(storeThread.reactor, self.reactor)
+
+        factory = svc.ampFactory
+        self.assertIdentical(factory.storeThread, storeThread)
+
+        svc.stopService()
+        self.assertFalse(storeThread.running)
+
+
+
+class WriteQueueServiceTests(SynchronousTestCase):
+    def setUp(self):
+        _fakeContexts(self)
+        self.store = Store()
+        self.reactor = MemoryReactorClock()
+
+
+    def test_noWriteQueue(self):
+        """By default, the service doesn't group writes.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor)
+        svc.startService()
+        self.assertIdentical(svc.writeQueue, None)
+        factory = svc.ampFactory
+        self.assertIdentical(factory.writeQueue, None)
+
+
+    def test_writeQueue(self):
+        """The service can group writes with a write queue, which is used by
+        the AMP factory. Queued writes are committed when the service
+        stops.
+
+        """
+        svc = service.Service(self.store, reactor=self.reactor,
+                              commitInterval=20, commitBatchSize=10)
+        svc.startService()
+        queue = svc.writeQueue
+        self.assertEqual(queue.maxDelay, 0.02)
+        self.assertEqual(queue.maxSize, 10)
+
+        factory = svc.ampFactory
+        self.assertIdentical(factory.writeQueue, queue)
+
+        d = queue.write(lambda: "done")
+        svc.stopService()
+        self.assertEqual(self.successResultOf(d), "done")
+
+
 
 class ServiceMakerTests(SynchronousTestCase):
     def test_options(self):
@@ -97,6 +902,135 @@ class ServiceMakerTests(SynchronousTestCase):
         """
         maker = service.ServiceMaker()
         store = Store()
-        svc = maker.makeService({"store": store})
+        options = service.Options()
+        options["store"] = store
+        svc = maker.makeService(options)
         self.assertTrue(isinstance(svc, service.Service))
         self.assertIdentical(svc.store, store)
+        self.assertFalse(svc.useStoreThread)
+        self.assertIdentical(svc.commitInterval, None)
+        self.assertFalse(svc.preloadFactories)
+        self.assertEqual(svc.workers, 1)
+        self.assertFalse(svc.isWorker)
+        self.assertIdentical(svc.workerArguments, None)
+
+
+    def test_makeServiceEndpoints(self):
+        """The service maker passes the endpoint descriptions to the service.
+        AMP listens on port 4430 by default, and can listen on several
+        endpoints.
+
+        """
+        options = service.Options()
+        options.parseOptions(["--store", self.mktemp()])
+        svc = service.ServiceMaker().makeService(options)
+        self.assertEqual(svc.ampEndpoints, ["tcp:4430"])
+        self.assertEqual(svc.manholeEndpoint, "tcp:8888:interface=localhost")
+        self.assertIdentical(svc.metricsEndpoint, None)
+
+        options = service.Options()
+        options.parseOptions(["--store", self.mktemp(),
+                              "--listen", "tcp:4431:backlog=128",
+                              "--listen", "unix:merlyn.sock",
+                              "--manhole", "tcp:8889",
+                              "--metrics", "tcp:9100"])
+        svc = service.ServiceMaker().makeService(options)
+        self.assertEqual(svc.ampEndpoints,
+                         ["tcp:4431:backlog=128", "unix:merlyn.sock"])
+        self.assertEqual(svc.manholeEndpoint, "tcp:8889")
+        self.assertEqual(svc.metricsEndpoint, "tcp:9100")
+
+
+    def test_makeServiceWorkers(self):
+        """The service maker can make a service with worker processes, which
+        run with the same options, except that they are workers.
+
+        """
+        path = self.mktemp()
+        options = service.Options()
+        options.parseOptions(["--store", path, "--workers", "3",
+                              "--store-thread", "--key", "k.pem",
+                              "--listen", "tcp:4431", "--listen", "tcp:4432"])
+        svc = service.ServiceMaker().makeService(options)
+        self.assertEqual(svc.workers, 3)
+        self.assertFalse(svc.isWorker)
+
+        arguments = svc.workerArguments
+        self.assertIn("merlyn", arguments)
+        self.assertIn("--nodaemon", arguments)
+        self.assertIn("--store=" + options["store"].dbdir.path, arguments)
+        self.assertIn("--key=k.pem", arguments)
+        self.assertIn("--store-thread", arguments)
+        self.assertIn("--worker", arguments)
+        self.assertIn("--listen=tcp:4431", arguments)
+        self.assertIn("--listen=tcp:4432", arguments)
+        self.assertFalse([a for a in arguments if a.startswith("--workers")])
+
+        options = service.Options()
+        options.parseOptions(arguments[arguments.index("merlyn") + 1:])
+        self.assertTrue(options["worker"])
+        self.assertEqual(options["workers"], 1)
+        self.assertEqual(options["listen"], ["tcp:4431", "tcp:4432"])
+
+
+    def test_makeServicePreload(self):
+        """The service maker can make a service that preloads factories.
+
+        """
+        options = service.Options()
+        options.parseOptions(["--store", self.mktemp(),
+                              "--preload-factories"])
+        svc = service.ServiceMaker().makeService(options)
+        self.assertTrue(svc.preloadFactories)
+
+
+    def test_makeServiceWriteQueue(self):
+        """The service maker passes the write grouping options to the
+        service.
+
+        """
+        options = service.Options()
+        options.parseOptions(["--store", self.mktemp(),
+                              "--commit-interval", "20",
+                              "--commit-batch-size", "10"])
+        svc = service.ServiceMaker().makeService(options)
+        self.assertEqual(svc.commitInterval, 20)
+        self.assertEqual(svc.commitBatchSize, 10)
+
+
+    def test_makeServiceStoreThread(self):
+        """The service maker tells the service to use a store thread if
+        asked to.
+
+        """
+        options = service.Options()
+        options.parseOptions(["--store", self.mktemp(), "--store-thread"])
+        svc = service.ServiceMaker().makeService(options)
+        self.assertTrue(svc.useStoreThread)
+
+
+    def test_makeServiceTLSOptions(self):
+        """The service maker passes the paths of the TLS certificate, key and
+        DH parameters, as well as the session and logging options, to the
+        service.
+
+        """
+        options = service.Options()
+        options.parseOptions(["--store", self.mktemp(),
+                              "--certificate", "c.pem",
+                              "--key", "k.pem",
+                              "--dh-parameters", "dh.pem",
+                              "--session-timeout", "10",
+                              "--ticket-key-lifetime", "20",
+                              "--elliptic-curve", "secp384r1",
+                              "--verify-log-limit", "5"])
+        svc = service.ServiceMaker().makeService(options)
+        self.assertEqual(svc.contextFactoryKwargs, {
+            "certificatePath": "c.pem",
+            "keyPath": "k.pem",
+            "dhParametersPath": "dh.pem",
+            "sessionTimeout": 10,
+            "ticketKeyLifetime": 20,
+            "ellipticCurve": "secp384r1",
+            "verifyLogLimit": 5
+        })
@@ -0,0 +1,64 @@
+import threading
+
+from axiom.store import Store
+from merlyn.auth import User
+from merlyn.storethread import StoreThread
+from twisted.trial.unittest import TestCase
+
+
+class StoreThreadTests(TestCase):
+    def setUp(self):
+        self.store = Store(self.mktemp())
+        self.user = User(store=self.store, email=b"user@example.com")
+        self.storeThread = StoreThread(self.store.dbdir)
+        self.storeThread.start()
+        self.addCleanup(self.storeThread.stop)
+
+
+    def test_run(self):
+        """Functions are called with a store on the same database, in a
+        different thread, and their result is returned in a Deferred.
+
+        """
+        def getEmail(store, userID):
+            email = store.getItemByID(userID).email
+            return email, store, threading.currentThread()
+
+        d = self.storeThread.run(getEmail, self.user.storeID)
+
+        @d.addCallback
+        def check(result):
+            email, store, thread = result
+            self.assertEqual(email, self.user.email)
+            self.assertNotIdentical(store, self.store)
+            self.assertEqual(store.dbdir, self.store.dbdir)
+            self.assertNotIdentical(thread, threading.currentThread())
+
+        return d
+
+
+    def test_sameStore(self):
+        """Functions are always called with the same store.
+
+        """
+        stores = []
+        d = self.storeThread.run(stores.append)
+        d.addCallback(lambda _: self.storeThread.run(stores.append))
+
+        @d.addCallback
+        def check(_):
+            first, second = stores
+            self.assertIdentical(first, second)
+
+        return d
+
+
+    def test_failure(self):
+        """When the function raises an exception, the Deferred fails.
+
+        """
+        def fail(store):
+            raise ZeroDivisionError()
+
+        d = self.storeThread.run(fail)
+        return self.assertFailure(d, ZeroDivisionError)
@@ -0,0 +1,424 @@
+from axiom.store import Store
+from merlyn import auth, batching, workers
+from merlyn.exercise import Exercise, getCatalog
+from merlyn.exercise import addChangeListener, removeChangeListener
+from merlyn.multiplexing import _PersistedFactory, addToStore
+from merlyn.multiplexing import getFactoryDict
+from merlyn.test.test_auth import FakeLogObserver
+from twisted.internet import reactor
+from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import ServerFactory
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.python.log import addObserver, removeObserver
+from twisted.trial.unittest import SynchronousTestCase, TestCase
+
+
+class ReusablePortReactorTests(TestCase):
+    def listen(self, description):
+        reusableReactor = workers.ReusablePortReactor(reactor)
+        endpoint = serverFromString(reusableReactor, description)
+        d = endpoint.listen(ServerFactory())
+        d.addCallback(lambda port: self.addCleanup(port.stopListening) or port)
+        return d
+
+
+    def test_reusable(self):
+        """Several TCP endpoints can listen on the same port number.
+
+        """
+        d = self.listen("tcp:0:interface=127.0.0.1")
+
+        @d.addCallback
+        def listenAgain(listeningPort):
+            self.port = listeningPort.getHost().port
+            description = "tcp:{0}:interface=127.0.0.1".format(self.port)
+            return self.listen(description)
+
+        @d.addCallback
+        def check(listeningPort):
+            self.assertEqual(listeningPort.getHost().port, self.port)
+
+        return d
+
+
+    def test_backlog(self):
+        """The backlog of TCP endpoints is used.
+
+        """
+        d = self.listen("tcp:0:interface=127.0.0.1:backlog=7")
+        d.addCallback(lambda port: self.assertEqual(port.backlog, 7))
+        return d
+
+
+    def test_otherEndpoints(self):
+        """Other endpoints use the wrapped reactor.
+
+        """
+        reusableReactor = workers.ReusablePortReactor(reactor)
+        self.assertEqual(reusableReactor.listenUNIX, reactor.listenUNIX)
+
+
+
+class FakeProcessTransport(object):
+    def __init__(self):
+        self.signals = []
+
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+
+
+class FakeProcessReactor(object):
+    def __init__(self):
+        self.spawned = []
+
+
+    def spawnProcess(self, processProtocol, executable, args, **kwargs):
+        processProtocol.makeConnection(FakeProcessTransport())
+        self.spawned.append((processProtocol, executable, args, kwargs))
+
+
+
+class WorkerPoolTests(SynchronousTestCase):
+    def setUp(self):
+        self.reactor = FakeProcessReactor()
+        self.arguments = ["python", "-c", "pass"]
+        self.pool = workers.WorkerPool(2, self.arguments, self.reactor)
+
+        self.observer = FakeLogObserver()
+        addObserver(self.observer)
+        self.addCleanup(removeObserver, self.observer)
+
+
+    def getLogMessages(self):
+        return [e["message"][0] for e in self.observer.events
+                if e.get("message")]
+
+
+    def test_start(self):
+        """Starting the pool spawns the workers with the given command line.
+
+        """
+        self.pool.start()
+        self.assertEqual(len(self.reactor.spawned), 2)
+        for _proto, executable, args, _kwargs in self.reactor.spawned:
+            self.assertEqual(executable, "python")
+            self.assertEqual(args, self.arguments)
+
+
+    def test_output(self):
+        """The output of workers is logged, one line at a time.
+
+        """
+        self.pool.start()
+        proto = self.reactor.spawned[1][0]
+        proto.childDataReceived(1, b"Hello, ")
+        proto.childDataReceived(1, b"world!\nGoodbye")
+        self.assertEqual(self.getLogMessages(), ["[worker 2] Hello, world!"])
+
+
+    def test_stop(self):
+        """Stopping the pool asks the workers to stop. The returned Deferred
+        fires when they have.
+
+        """
+        self.pool.start()
+        d = self.pool.stop()
+        self.assertNoResult(d)
+
+        for proto, _executable, _args, _kwargs in self.reactor.spawned:
+            self.assertEqual(proto.transport.signals, ["TERM"])
+            proto.processEnded(Failure(Exception("terminated")))
+        self.successResultOf(d)
+
+
+    def test_stopEnded(self):
+        """Workers that already ended aren't asked to stop.
+
+        """
+        self.pool.start()
+        ended = self.reactor.spawned[0][0]
+        ended.processEnded(Failure(Exception("crashed")))
+        self.assertIn("Worker 1 ended: crashed", self.getLogMessages())
+
+        self.pool.stop()
+        self.assertEqual(ended.transport.signals, [])
+
+
+
+class FakeAMPFactory(object):
+    def __init__(self):
+        self.invalidated = []
+
+
+    def invalidateSolved(self, user=None):
+        self.invalidated.append(user)
+
+
+
+class ChangeWatcherTests(SynchronousTestCase):
+    def setUp(self):
+        path = self.mktemp()
+        self.store = Store(path)
+        self.user = auth.User(store=self.store, email=b"user@example.com")
+        self.exercise = self.makeExercise(self.store, b"first")
+
+        self.otherStore = Store(path)
+
+        self.ampFactory = FakeAMPFactory()
+        self.clock = Clock()
+        self.watcher = workers.ChangeWatcher(self.store, self.ampFactory,
+                                             reactor=self.clock)
+
+        self.catalog = getCatalog(self.store)
+        self.catalog._load()
+
+
+    def makeExercise(self, store, identifier):
+        return Exercise(store=store, identifier=identifier,
+                        title=u"Title", description=u"Description")
+
+
+    def test_noChanges(self):
+        """When the store didn't change, nothing is invalidated.
+
+        """
+        self.watcher.check()
+        self.assertNotIdentical(self.catalog._exercises, None)
+
+
+    def test_ownChanges(self):
+        """Changes made by this process aren't changes by another process.
+
+        """
+        self.makeExercise(self.store, b"second")
+        self.catalog._load()
+        self.watcher.check()
+        self.assertNotIdentical(self.catalog._exercises, None)
+
+
+    def primeCaches(self):
+        """Builds a factory for a persisted factory, and verifies the user.
+
+        Returns the factory dict, the factory and the verified users.
+
+        """
+        factoryDict = getFactoryDict(self.store)
+        addToStore(self.store, b"test", b"merlyn.service.Factory")
+        factory = factoryDict[b"test"]
+        self.user.digest = b"digest"
+        verifiedUsers = auth.getVerifiedUsers(self.store)
+        verifiedUsers[b"digest"] = self.user
+        self.watcher = workers.ChangeWatcher(self.store, self.ampFactory)
+        return factoryDict, factory, verifiedUsers
+
+
+    def test_newExercise(self):
+        """When another process added an exercise, the catalog is
+        invalidated, but the factory dict and verified users aren't.
+
+        """
+        factoryDict, factory, verifiedUsers = self.primeCaches()
+
+        self.makeExercise(self.otherStore, b"second")
+        self.watcher.check()
+
+        self.assertIdentical(self.catalog._exercises, None)
+        self.assertEqual(len(self.catalog), 2)
+        self.assertIdentical(factoryDict[b"test"], factory)
+        self.assertIdentical(verifiedUsers.get(b"digest"), self.user)
+        self.assertEqual(self.ampFactory.invalidated, [])
+
+
+    def test_changedExercise(self):
+        """When another process changed or deleted an exercise, the catalog
+        is invalidated.
+
+        """
+        otherExercise = self.otherStore.getItemByID(self.exercise.storeID)
+        otherExercise.title = u"New title"
+        self.watcher.check()
+        self.assertIdentical(self.catalog._exercises, None)
+        self.assertEqual(self.catalog[b"first"].title, u"New title")
+
+        self.catalog._load()
+        otherExercise.deleteFromStore()
+        self.watcher.check()
+        self.assertIdentical(self.catalog._exercises, None)
+        self.assertEqual(len(self.catalog), 0)
+
+
+    def test_foreignSolve(self):
+        """When another process recorded a solution, the catalog, factory
+        dict and verified users are kept.
+
+        """
+        factoryDict, factory, verifiedUsers = self.primeCaches()
+
+        otherUser = self.otherStore.getItemByID(self.user.storeID)
+        otherExercise = self.otherStore.getItemByID(self.exercise.storeID)
+        otherExercise.solvedBy(otherUser)
+        self.watcher.check()
+
+        self.assertNotIdentical(self.catalog._exercises, None)
+        self.assertIdentical(factoryDict[b"test"], factory)
+        self.assertIdentical(verifiedUsers.get(b"digest"), self.user)
+        self.assertEqual(self.ampFactory.invalidated, [self.user])
+
+
+    def test_changedFactories(self):
+        """When another process added, changed, renamed or deleted a
+        persisted factory, its factories are invalidated under its old
+        and new identifiers. Other factories are kept.
+
+        """
+        factoryDict, factory, _verifiedUsers = self.primeCaches()
+        addToStore(self.store, b"other", b"merlyn.service.Factory")
+        otherFactory = factoryDict[b"other"]
+        self.watcher = workers.ChangeWatcher(self.store, self.ampFactory)
+
+        addToStore(self.otherStore, b"test", b"merlyn.exercise.Catalog")
+        self.watcher.check()
+        newFactory = factoryDict[b"test"]
+        self.assertNotIdentical(newFactory, factory)
+        self.assertIdentical(factoryDict[b"other"], otherFactory)
+
+        PF = _PersistedFactory
+        otherPersisted = self.otherStore.findUnique(PF, PF.identifier == b"test")
+        otherPersisted.identifier = b"renamed"
+        self.watcher.check()
+        self.assertRaises(KeyError, lambda: factoryDict[b"test"])
+        self.assertNotIdentical(factoryDict[b"renamed"], newFactory)
+        self.assertIdentical(factoryDict[b"other"], otherFactory)
+
+        self.otherStore.findUnique(PF, PF.identifier == b"other") \
+            .deleteFromStore()
+        self.watcher.check()
+        self.assertRaises(KeyError, lambda: factoryDict[b"other"])
+
+
+    def test_changedUsers(self):
+        """When another process replaced the digest or e-mail address of a
+        verified user, or deleted them, the user is forgotten. Other
+        verified users are kept.
+
+        """
+        _factoryDict, _factory, verifiedUsers = self.primeCaches()
+        users = []
+        for number in range(3):
+            user = auth.User(store=self.store,
+                             email=b"user{0}@example.com".format(number),
+                             digest=b"digest{0}".format(number))
+            verifiedUsers[user.digest] = user
+            users.append(user)
+
+        otherUsers = [self.otherStore.getItemByID(u.storeID) for u in users]
+        otherUsers[0].digest = b"repinned"
+        otherUsers[1].email = b"renamed@example.com"
+        otherUsers[2].deleteFromStore()
+        self.watcher.check()
+
+        self.assertEqual(verifiedUsers.items(), [(b"digest", self.user)])
+
+
+    def test_reloadedUsers(self):
+        """Users that are loaded in this process, for example by a connection,
+        are reloaded when another process changes them.
+
+        """
+        otherUser = self.otherStore.getItemByID(self.user.storeID)
+        otherUser.digest = b"repinned"
+        self.watcher.check()
+
+        self.assertEqual(self.user.digest, b"repinned")
+        user = self.store.findUnique(auth.User,
+                                     auth.User.email == b"user@example.com")
+        self.assertIdentical(user, self.user)
+        self.assertEqual(user.digest, b"repinned")
+
+
+    def test_manyVerifiedUsers(self):
+        """Verified users are checked in batches that SQLite accepts.
+
+        """
+        def makeUsers():
+            return [auth.User(store=self.store,
+                              email=b"user{0}@example.com".format(number),
+                              digest=b"digest{0}".format(number))
+                    for number in range(batching.maxVariables + 1)]
+        users = self.store.transact(makeUsers)
+
+        verifiedUsers = auth.getVerifiedUsers(self.store)
+        for user in users:
+            verifiedUsers[user.digest] = user
+
+        self.makeExercise(self.otherStore, b"second")
+        self.watcher.check()
+        self.assertEqual(len(verifiedUsers), batching.maxVariables + 1)
+
+
+    def test_newSolutions(self):
+        """When another process recorded solutions, the solved exercises of
+        those users are invalidated, once.
+
+        """
+        otherUser = self.otherStore.getItemByID(self.user.storeID)
+        otherExercise = self.otherStore.getItemByID(self.exercise.storeID)
+        otherExercise.solvedBy(otherUser)
+        self.makeExercise(self.otherStore, b"second").solvedBy(otherUser)
+
+        self.watcher.check()
+        self.assertEqual(self.ampFactory.invalidated, [self.user])
+
+        self.makeExercise(self.otherStore, b"third")
+        self.watcher.check()
+        self.assertEqual(self.ampFactory.invalidated, [self.user])
+
+
+    def test_notifyChanged(self):
+        """When another process changed the store, the store's change
+        listeners are notified.
+
+        """
+        calls = []
+        listener = lambda: calls.append(None)
+        addChangeListener(self.store, listener)
+        self.addCleanup(removeChangeListener, self.store, listener)
+
+        self.watcher.check()
+        self.assertEqual(calls, [])
+
+        self.makeExercise(self.otherStore, b"second")
+        self.watcher.check()
+        self.assertEqual(calls, [None])
+
+
+    def test_oldSolutions(self):
+        """Solutions recorded before the watcher was made don't cause
+        invalidations.
+
+        """
+        self.exercise.solvedBy(self.user)
+        watcher = workers.ChangeWatcher(self.store, self.ampFactory)
+        self.makeExercise(self.otherStore, b"second")
+        watcher.check()
+        self.assertEqual(self.ampFactory.invalidated, [])
+
+
+    def test_startStop(self):
+        """Once started, the watcher checks for changes at its interval,
+        until it is stopped.
+
+        """
+        self.watcher.start()
+        self.makeExercise(self.otherStore, b"second")
+        self.clock.advance(self.watcher.interval)
+        self.assertIdentical(self.catalog._exercises, None)
+
+        self.catalog._load()
+        self.watcher.stop()
+        self.makeExercise(self.otherStore, b"third")
+        self.clock.advance(self.watcher.interval)
+        self.assertNotIdentical(self.catalog._exercises, None)
@@ -0,0 +1,90 @@
+from axiom.store import Store
+from merlyn.auth import User
+from merlyn.writequeue import WriteQueue
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SynchronousTestCase
+
+
+class WriteQueueTests(SynchronousTestCase):
+    def setUp(self):
+        self.store = Store()
+        self.clock = Clock()
+        self.queue = WriteQueue(self.store, maxDelay=1.0, maxSize=3,
+                                reactor=self.clock)
+
+        self.transactions = []
+        transact = self.store.transact
+        def countingTransact(f, *args, **kwargs):
+            if self.store.transaction is None:
+                self.transactions.append(f)
+            return transact(f, *args, **kwargs)
+        self.patch(self.store, "transact", countingTransact)
+
+
+    def addUser(self, email):
+        return self.queue.write(User, store=self.store, email=email)
+
+
+    def test_delayed(self):
+        """Writes are committed once the maximum delay has passed since the
+        first one was queued.
+
+        """
+        first = self.addUser(b"first@example.com")
+        self.clock.advance(0.5)
+        second = self.addUser(b"second@example.com")
+        self.assertNoResult(first)
+        self.assertNoResult(second)
+        self.assertEqual(self.transactions, [])
+
+        self.clock.advance(0.5)
+        self.assertEqual(self.successResultOf(first).email,
+                         b"first@example.com")
+        self.assertEqual(self.successResultOf(second).email,
+                         b"second@example.com")
+        self.assertEqual(len(self.transactions), 1)
+
+
+    def test_full(self):
+        """Writes are committed as soon as the maximum number of writes is
+        queued.
+
+        """
+        ds = [self.addUser(b"{0}@example.com".format(i)) for i in range(3)]
+        for d in ds:
+            self.successResultOf(d)
+        self.assertEqual(len(self.transactions), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_flush(self):
+        """Queued writes can be committed right away.
+
+        """
+        d = self.addUser(b"user@example.com")
+        self.queue.flush()
+        self.successResultOf(d)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_flushEmpty(self):
+        """Flushing an empty queue doesn't start a transaction.
+
+        """
+        self.queue.flush()
+        self.assertEqual(self.transactions, [])
+
+
+    def test_failure(self):
+        """When a write fails, the others in its group still succeed, each in
+        their own transaction.
+
+        """
+        good = self.addUser(b"good@example.com")
+        bad = self.queue.write(lambda: 1 // 0)
+        self.queue.flush()
+
+        self.assertEqual(self.successResultOf(good).email, b"good@example.com")
+        self.failureResultOf(bad, ZeroDivisionError)
+        self.assertEqual(self.store.query(User).count(), 1)
+        self.assertEqual(len(self.transactions), 3)
@@ -0,0 +1,340 @@
+"""Serving from several processes that share one store.
+
+The main process starts worker processes, which each run their own
+reactor. Every process listens on the same TCP ports with
+``SO_REUSEPORT``, so the kernel spreads connections (and the TLS
+handshakes that come with them) over all of them.
+
+Writes that have to be consistent across processes (pinning
+certificate digests, creating secrets) happen in transactions. Things
+that are cached in memory are refreshed by a ``ChangeWatcher`` when
+another process changes the store.
+
+"""
+import socket
+
+from merlyn.auth import User, getVerifiedUsers
+from merlyn.batching import inBatches
+from merlyn.exercise import Exercise, _Solution, getCatalog, notifyChanged
+from merlyn.multiplexing import _PersistedFactory, getFactoryDict
+from twisted.internet import defer, protocol, reactor, task, tcp
+from twisted.python import log
+
+
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+
+
+class _ReusablePort(tcp.Port):
+    """A TCP port that other processes can listen on too.
+
+    """
+    def createInternetSocket(self):
+        skt = tcp.Port.createInternetSocket(self)
+        skt.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        return skt
+
+
+
+class ReusablePortReactor(object):
+    """Wraps a reactor, so that the TCP ports it listens on can be
+    listened on by other processes too.
+
+    Pass this to ``endpoints.serverFromString`` to make TCP endpoints
+    that share their port with the other workers.
+
+    """
+    def __init__(self, reactor):
+        self._reactor = reactor
+
+
+    def listenTCP(self, port, factory, backlog=50, interface=""):
+        listeningPort = _ReusablePort(port, factory, backlog, interface,
+                                      reactor=self._reactor)
+        listeningPort.startListening()
+        return listeningPort
+
+
+    def __getattr__(self, name):
+        return getattr(self._reactor, name)
+
+
+
+class _WorkerProtocol(protocol.ProcessProtocol):
+    """Logs the output of a worker process, and notices when it ends.
+
+    """
+    def __init__(self, number):
+        self.number = number
+        self.ended = defer.Deferred()
+        self._buffers = {}
+
+
+    def childDataReceived(self, childFD, data):
+        lines = (self._buffers.get(childFD, b"") + data).split(b"\n")
+        self._buffers[childFD] = lines.pop()
+        for line in lines:
+            log.msg("[worker {0}] {1}".format(self.number, line))
+
+
+    def processEnded(self, reason):
+        log.msg("Worker {0} ended: {1}".format(self.number,
+                                               reason.getErrorMessage()))
+        self.ended.callback(None)
+
+
+
+class WorkerPool(object):
+    """Starts and stops worker processes.
+
+    Every worker runs the given command line. Their output is logged
+    by this process.
+
+    """
+    def __init__(self, count, arguments, reactor=reactor):
+        self.count = count
+        self.arguments = arguments
+        self.reactor = reactor
+        self._workers = []
+
+
+    def start(self):
+        """Starts the workers.
+
+        """
+        for number in xrange(1, self.count + 1):
+            proto = _WorkerProtocol(number)
+            self.reactor.spawnProcess(proto, self.arguments[0],
+                                      self.arguments, env=None,
+                                      childFDs={0: "w", 1: "r", 2: "r"})
+            self._workers.append(proto)
+
+
+    def stop(self):
+        """Asks all workers to stop.
+
+        Returns a Deferred that fires when they have.
+
+        """
+        workers, self._workers = self._workers, []
+        ended = []
+        for proto in workers:
+            if not proto.ended.called:
+                proto.transport.signalProcess("TERM")
+            ended.append(proto.ended)
+        return defer.gatherResults(ended)
+
+
+
+class ChangeWatcher(object):
+    """Notices when other processes change the store, and refreshes what
+    this process caches from it.
+
+    Every ``interval`` seconds, this asks SQLite if another connection
+    has committed anything. If so, only what changed is invalidated:
+
+    - the exercise catalog, if the number of exercises or their latest
+      version changed;
+    - the factories of persisted factories that were added, changed or
+      deleted, in the factory dict;
+    - the verified users whose e-mail address or digest changed, or
+      who were deleted;
+    - the solved exercises cached by connections to ``ampFactory`` of
+      users who have new solutions.
+
+    Exercises, persisted factories and users that are loaded in this
+    process are reloaded when they might have changed, since Axiom
+    keeps handing out the same loaded items, for example to
+    connections that hold on to their user.
+
+    If exercises or solutions changed, the store's change listeners
+    are notified too, so that the changes are pushed to subscribed
+    connections.
+
+    """
+    def __init__(self, store, ampFactory, interval=1.0, reactor=reactor):
+        self.store = store
+        self.ampFactory = ampFactory
+        self.interval = interval
+        self.reactor = reactor
+
+        self._dataVersion = self._getDataVersion()
+        self._exercisesVersion = self._getExercisesVersion()
+        self._persistedFactories = self._getPersistedFactories()
+        self._lastSolutionID = self._getLastSolutionID()
+        self._call = None
+
+
+    def start(self):
+        self._call = task.LoopingCall(self.check)
+        self._call.clock = self.reactor
+        self._call.start(self.interval, now=False)
+
+
+    def stop(self):
+        if self._call is not None:
+            call, self._call = self._call, None
+            call.stop()
+
+
+    def _getDataVersion(self):
+        (version,), = self.store.querySQL("PRAGMA data_version")
+        return version
+
+
+    def _getExercisesVersion(self):
+        """Gets the number of exercises, and the latest exercise version.
+
+        """
+        query = self.store.query(Exercise, sort=Exercise.version.descending,
+                                 limit=1)
+        latest = next(iter(query.getColumn("version")), 0)
+        return self.store.query(Exercise).count(), latest
+
+
+    def _getPersistedFactories(self):
+        """Gets the identifier and name of every persisted factory, by
+        store ID.
+
+        The rows are read directly, since persisted factories that are
+        loaded in this process don't see changes by other processes.
+
+        """
+        PF = _PersistedFactory
+        sql = "SELECT oid, {0}, {1} FROM {2}".format(
+            PF.identifier.getShortColumnName(self.store),
+            PF.name.getShortColumnName(self.store),
+            self.store.getTableName(PF))
+        return dict((storeID, (_bytes(identifier), _bytes(name)))
+                    for storeID, identifier, name
+                    in self.store.querySQL(sql))
+
+
+    def _getLastSolutionID(self):
+        query = self.store.query(_Solution, sort=_Solution.storeID.descending,
+                                 limit=1)
+        for storeID in query.getColumn("storeID"):
+            return storeID
+        return 0
+
+
+    def check(self):
+        """Refreshes caches if another process changed the store since the
+        last check.
+
+        """
+        version = self._getDataVersion()
+        if version == self._dataVersion:
+            return
+        self._dataVersion = version
+
+        exercisesVersion = self._getExercisesVersion()
+        exercisesChanged = exercisesVersion != self._exercisesVersion
+        if exercisesChanged:
+            self._exercisesVersion = exercisesVersion
+            _reload(self.store, Exercise)
+            getCatalog(self.store).invalidate()
+
+        self._invalidateFactories()
+        self._invalidateVerifiedUsers()
+
+        newSolutions = self.store.query(
+            _Solution, _Solution.storeID > self._lastSolutionID)
+        users = set()
+        for solution in newSolutions:
+            users.add(solution.who)
+            self._lastSolutionID = max(self._lastSolutionID, solution.storeID)
+
+        for user in users:
+            self.ampFactory.invalidateSolved(user)
+
+        if exercisesChanged or users:
+            notifyChanged(self.store)
+
+
+    def _invalidateFactories(self):
+        """Invalidates the factories of persisted factories that were added,
+        changed or deleted since the last check, under their old and
+        new identifiers.
+
+        """
+        old, new = self._persistedFactories, self._getPersistedFactories()
+        if new == old:
+            return
+        self._persistedFactories = new
+        _reload(self.store, _PersistedFactory)
+
+        factoryDict = getFactoryDict(self.store)
+        for storeID in set(old) | set(new):
+            before, after = old.get(storeID), new.get(storeID)
+            if before != after:
+                for identifier, _name in filter(None, [before, after]):
+                    factoryDict.invalidate(identifier)
+
+
+    def _invalidateVerifiedUsers(self):
+        """Reloads the users that are loaded in this process, and forgets
+        the verified users whose e-mail address or digest changed, or
+        who were deleted.
+
+        """
+        verifiedUsers = getVerifiedUsers(self.store)
+        entries = [(digest, user, user.email)
+                   for digest, user in verifiedUsers.items()]
+        users = _reload(self.store, User)
+        for digest, user, email in entries:
+            if (user.storeID not in users
+                or (user.email, user.digest) != (email, digest)):
+                verifiedUsers.discard(digest)
+
+
+
+def _loadedItems(store, itemClass):
+    """Gets the items of the given class that are loaded in this process,
+    by store ID.
+
+    """
+    items = {}
+    for storeID in list(store.objectCache.data):
+        try:
+            item = store.objectCache.get(storeID)
+        except KeyError:
+            continue
+        if isinstance(item, itemClass):
+            items[storeID] = item
+    return items
+
+
+
+def _reload(store, itemClass):
+    """Re-reads the rows of the items of the given class that are loaded
+    in this process into those items.
+
+    Axiom keeps giving out the same loaded item for as long as anything
+    refers to it, and loaded items don't see changes by other
+    processes. Returns the reloaded items by store ID; items whose
+    rows were deleted are left out.
+
+    """
+    items = _loadedItems(store, itemClass)
+    schema = itemClass.getSchema()
+    sql = "SELECT oid, {0} FROM {1} WHERE oid IN ({{0}})".format(
+        ", ".join(attr.getShortColumnName(store) for _name, attr in schema),
+        store.getTableName(itemClass))
+
+    reloaded = {}
+    for batch in inBatches(items):
+        query = sql.format(", ".join("?" * len(batch)))
+        for row in store.querySQL(query, batch):
+            item = reloaded[row[0]] = items[row[0]]
+            for (_name, attr), value in zip(schema, row[1:]):
+                attr.loaded(item, value)
+    return reloaded
+
+
+
+def _bytes(value):
+    """Converts a raw bytes column value to bytes.
+
+    """
+    return None if value is None else bytes(value)
@@ -0,0 +1,94 @@
+"""Grouping writes to a store into transactions.
+
+"""
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+
+class WriteQueue(object):
+    """Groups writes to a store into transactions.
+
+    Every SQLite transaction ends with an fsync, so writing many small
+    things (like solutions) in their own transactions is slow. Writes
+    are queued instead, and committed together in one transaction,
+    once ``maxSize`` writes are queued, or ``maxDelay`` seconds after
+    the first one was queued, whichever comes first.
+
+    If the group's transaction fails, every write in the group is
+    retried in its own transaction, so that one bad write doesn't
+    take the others down with it.
+
+    """
+    def __init__(self, store, maxDelay=0.01, maxSize=100, reactor=reactor):
+        self.store = store
+        self.maxDelay = maxDelay
+        self.maxSize = maxSize
+        self.reactor = reactor
+
+        self._pending = []
+        self._delayedFlush = None
+
+
+    def write(self, f, *args, **kwargs):
+        """Queues a call to ``f`` with the given arguments.
+
+        Returns a Deferred that fires with the result of ``f`` once it
+        has been committed.
+
+        """
+        d = Deferred()
+        self._pending.append((d, f, args, kwargs))
+
+        if len(self._pending) >= self.maxSize:
+            self.flush()
+        elif self._delayedFlush is None:
+            self._delayedFlush = self.reactor.callLater(self.maxDelay,
+                                                        self.flush)
+
+        return d
+
+
+    def flush(self):
+        """Commits all queued writes now.
+
+        """
+        if self._delayedFlush is not None:
+            if self._delayedFlush.active():
+                self._delayedFlush.cancel()
+            self._delayedFlush = None
+
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        try:
+            results = self.store.transact(self._runAll, pending)
+        except Exception:
+            results = [self._runOne(f, args, kwargs)
+                       for _d, f, args, kwargs in pending]
+
+        for (d, _f, _args, _kwargs), result in zip(pending, results):
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+
+    def _runAll(self, pending):
+        """Runs all of the given writes. Any exception aborts the group's
+        transaction.
+
+        """
+        return [f(*args, **kwargs) for _d, f, args, kwargs in pending]
+
+
+    def _runOne(self, f, args, kwargs):
+        """Runs a single write in its own transaction, returning a Failure if
+        it fails.
+
+        """
+        try:
+            return self.store.transact(f, *args, **kwargs)
+        except Exception:
+            return Failure()
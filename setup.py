@@ -12,6 +12,7 @@ dependencies = [
     # Base requirements, Twisted, TLS, AMP etc
     "twisted>=13.2.0",
     "pyOpenSSL>=0.13.1",
+    "cryptography>=0.5", # (for HKDF)
     "txampext>=0.0.10",
     "pycrypto", # (for manhole)
     "pyasn1", # (for manhole)
@@ -57,9 +58,13 @@ setup(name=packageName,
       author_email='_@lvh.io',
 
       packages=find_packages() + ['twisted.plugins'],
+      package_data={packageName + ".test.historic": ["*.tbz2"]},
       test_suite=packageName + ".test",
 
       install_requires=dependencies,
+      entry_points={
+          "console_scripts": ["merlyn-admin = merlyn.admin:main"]
+      },
 
       cmdclass={'test': Tox},
       zip_safe=True,